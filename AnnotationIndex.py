@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A collection of functions designed to load GTF and GFF3 annotations, such as the reference
+annotation or the merged transcripts of cuffmerge, into a compact, column-wise form, to store it
+as a binary index (.gai) next to the annotation and to find the features overlapping a region.
+    -Inputs:    [1] Directory of a GTF or GFF3 file, plain or gzip compressed.
+                [2-N] Regions to query, given as <seqid>:<start>-<end> or <seqid>, optional.
+    -Outputs:   [1] The index, saved next to the annotation as <annotation_file>.gai.
+                [2] The features overlapping the regions, printed as GTF/GFF3 lines.
+
+The file is read once. Every feature is stored as a row of arrays: the seqid, source and feature
+type as numbers of strings in a single table of interned strings, the start and end, the strand,
+and a slice of two arrays holding the interned keys and values of its attributes, so identifiers
+shared by the exons of a transcript are stored once. The rows are ordered by seqid and start, and
+the rows of every seqid form an implicit interval tree, as in cgranges: the rows are the in-order
+nodes of a complete binary tree, the node at row i of level k covering the block of 2^(k+1) - 1
+rows around it, and every node keeps the largest end within its block. A query descends only into
+blocks that start before the end of the region and reach its start, so the features overlapping a
+region are found in O(log n + k) for k overlapping features, however long some features are.
+Coordinates are 1-based and inclusive, as in the annotation files.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+from array import array
+import struct
+import time
+import gzip
+import sys
+import os
+import re
+
+
+INDEX_MAGIC = b'GAI2'
+INDEX_HEADER = '<4sQQQdQ'
+INDEX_EXTENSION = '.gai'
+STRANDS = '+-.?'
+SCAN_LEVEL = 3
+GTF_ATTRIBUTE_PATTERN = re.compile(r'(\S+) "([^"]*)"')
+REGION_PATTERN = re.compile(r'^(.+?)(?::([\d,]+)-([\d,]+))?$')
+ROW_ARRAYS = (('seqids', 'I'), ('sources', 'I'), ('types', 'I'), ('starts', 'Q'),
+              ('ends', 'Q'), ('strands', 'B'), ('max_ends', 'Q'))
+ATTRIBUTE_ARRAYS = (('attribute_offsets', 'Q'), ('attribute_keys', 'I'),
+                    ('attribute_values', 'I'), ('scaffold_bounds', 'Q'))
+
+
+def get_command_line_arguments(default_variable_values):
+    """
+    Function to get a variable number of input arguments from the command line, but use default
+    values if none were given.
+
+    :param default_variable_values: A list of default values given in order of their appearance in
+    the command line.
+    :return: A list of input variables.
+    """
+    assert isinstance(default_variable_values, list), \
+        'The given default input variables values must be a list.'
+    input_variables = [0]*len(default_variable_values)
+    for index, default_value in enumerate(default_variable_values):
+        try:
+            input_variables[index] = sys.argv[index + 1]
+        except IndexError:
+            if default_value != '':
+                input_variables[index] = default_value
+            else:
+                exit('Not enough command line input arguments. Critical Input Missing.')
+    return input_variables
+
+
+def open_annotation(annotation_path):
+    """
+    Function to open a plain or gzip compressed GTF/GFF3 file for reading text.
+
+    :param annotation_path: The path of the annotation file, given as a string.
+    :return: The opened file.
+    """
+    if annotation_path.endswith('.gz'):
+        return gzip.open(annotation_path, 'rt')
+    return open(annotation_path)
+
+
+def get_index_path(annotation_path):
+    """
+    Function to generate the path of the index belonging to an annotation file.
+
+    :param annotation_path: The path of the annotation file, given as a string.
+    :return: The path of the index file, given as a string.
+    """
+    return '%s%s' % (annotation_path, INDEX_EXTENSION)
+
+
+def parse_attributes(attribute_column):
+    """
+    Function to parse the attribute column of a GTF line, key "value";, or of a GFF3 line,
+    key=value;.
+
+    :param attribute_column: The ninth column of the line, given as a string.
+    :return: A list of (key, value) tuples, in the order of the line.
+    """
+    if '"' in attribute_column:
+        return GTF_ATTRIBUTE_PATTERN.findall(attribute_column)
+    return [tuple(pair.strip().split('=', 1)) for pair in attribute_column.split(';')
+            if '=' in pair]
+
+
+def get_tree_max_ends(ends):
+    """
+    Function to compute the largest end within the block of every node of the implicit interval
+    tree over the features of a single seqid, ordered by start.
+
+    :param ends: The ends of the features, given as a sequence in order of their start.
+    :return: The largest end within the block of every row, given as a list.
+    """
+    count = len(ends)
+    max_ends = list(ends)
+    if not count:
+        return max_ends
+    last_row = count - 1 - (count - 1) % 2
+    last_end = max_ends[last_row]
+    level = 1
+    while 1 << level <= count:
+        half_width = 1 << (level - 1)
+        for row in range((half_width << 1) - 1, count, half_width << 2):
+            right_end = max_ends[row + half_width] if row + half_width < count else last_end
+            max_ends[row] = max(max_ends[row], max_ends[row - half_width], right_end)
+        last_row = last_row - half_width if last_row >> level & 1 else last_row + half_width
+        if last_row < count:
+            last_end = max(last_end, max_ends[last_row])
+        level += 1
+    return max_ends
+
+
+class AnnotationIndexBuilder(object):
+    """
+    Collects the features of an annotation, line by line, into interned columns.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self.string_numbers = {}
+        self.rows = dict((name, array(typecode)) for name, typecode in ROW_ARRAYS[:-1])
+        self.attribute_offsets = array('Q', [0])
+        self.attribute_keys = array('I')
+        self.attribute_values = array('I')
+
+    def intern(self, string):
+        """
+        Function to get the number of a string in the string table, adding it if it is new.
+
+        :param string: The string, given as a string.
+        :return: The number of the string, given as an int.
+        """
+        number = self.string_numbers.get(string)
+        if number is None:
+            number = self.string_numbers[string] = len(self.strings)
+            self.strings.append(string)
+        return number
+
+    def add_line(self, line):
+        """
+        Method to add the feature of a line of a GTF/GFF3 file; comment lines are ignored.
+
+        :param line: The line, given as a string.
+        """
+        fields = line.rstrip('\r\n').split('\t')
+        if len(fields) < 9 or line.startswith('#'):
+            return
+        self.rows['seqids'].append(self.intern(fields[0]))
+        self.rows['sources'].append(self.intern(fields[1]))
+        self.rows['types'].append(self.intern(fields[2]))
+        self.rows['starts'].append(int(fields[3]))
+        self.rows['ends'].append(int(fields[4]))
+        self.rows['strands'].append(STRANDS.find(fields[6]) % len(STRANDS))
+        for key, value in parse_attributes(fields[8]):
+            self.attribute_keys.append(self.intern(key))
+            self.attribute_values.append(self.intern(value))
+        self.attribute_offsets.append(len(self.attribute_keys))
+
+    def get_index(self, file_size, file_time):
+        """
+        Function to order the collected features by seqid and start and return them as an index.
+
+        :param file_size: The size of the annotation file in bytes, given as an int.
+        :param file_time: The modification time of the annotation file, given as a float.
+        :return: The AnnotationIndex of the collected features.
+        """
+        rows, offsets = self.rows, self.attribute_offsets
+        order = sorted(range(len(rows['starts'])),
+                       key=lambda row: (rows['seqids'][row], rows['starts'][row]))
+        columns = dict((name, array(column.typecode, (column[row] for row in order)))
+                       for name, column in rows.items())
+        columns['attribute_offsets'] = array('Q', [0])
+        columns['attribute_keys'], columns['attribute_values'] = array('I'), array('I')
+        for row in order:
+            columns['attribute_keys'].extend(
+                self.attribute_keys[offsets[row]:offsets[row + 1]])
+            columns['attribute_values'].extend(
+                self.attribute_values[offsets[row]:offsets[row + 1]])
+            columns['attribute_offsets'].append(len(columns['attribute_keys']))
+        seqids = columns['seqids']
+        columns['scaffold_bounds'] = array('Q', [row for row, seqid in enumerate(seqids)
+                                                 if row == 0 or seqid != seqids[row - 1]])
+        columns['scaffold_bounds'].append(len(order))
+        columns['max_ends'] = array('Q')
+        for first, last in zip(columns['scaffold_bounds'][:-1], columns['scaffold_bounds'][1:]):
+            columns['max_ends'].extend(get_tree_max_ends(columns['ends'][first:last]))
+        return AnnotationIndex(self.strings, columns, file_size, file_time)
+
+
+class AnnotationIndex(object):
+    """
+    The features of a GTF/GFF3 file in interned columns, ordered by seqid and start.
+    """
+
+    def __init__(self, strings, columns, file_size=0, file_time=0.0):
+        """
+        :param strings: The table of interned strings, given as a list.
+        :param columns: A dictionary of the arrays named in ROW_ARRAYS and ATTRIBUTE_ARRAYS.
+        :param file_size: The size of the annotation file in bytes, given as an int.
+        :param file_time: The modification time of the annotation file, given as a float.
+        """
+        self.strings = strings
+        self.columns = columns
+        self.file_size = file_size
+        self.file_time = file_time
+        self.string_numbers = dict((string, number) for number, string in enumerate(strings))
+        self.scaffolds = {}
+        for index, bound in enumerate(columns['scaffold_bounds'][:-1]):
+            self.scaffolds[strings[columns['seqids'][bound]]] = \
+                (bound, columns['scaffold_bounds'][index + 1])
+
+    def __len__(self):
+        return len(self.columns['starts'])
+
+    def save(self, index_path):
+        """
+        Method to write the index to disk, as a fixed header followed by the string table and all
+        arrays.
+
+        :param index_path: The path of the index file, given as a string.
+        """
+        strings = '\0'.join(self.strings).encode('utf-8')
+        temporary_path = '%s.tmp' % index_path
+        with open(temporary_path, 'wb') as index_file:
+            index_file.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, len(self),
+                                         len(self.columns['attribute_keys']), self.file_size,
+                                         self.file_time, len(strings)))
+            index_file.write(strings)
+            index_file.write(struct.pack('<Q', len(self.columns['scaffold_bounds'])))
+            for name, typecode in ROW_ARRAYS + ATTRIBUTE_ARRAYS:
+                column = array(typecode, self.columns[name])
+                if sys.byteorder != 'little':
+                    column.byteswap()
+                column.tofile(index_file)
+        os.rename(temporary_path, index_path)
+
+    @staticmethod
+    def load(index_path):
+        """
+        Function to read an index from disk.
+
+        :param index_path: The path of the index file, given as a string.
+        :return: The loaded AnnotationIndex.
+        """
+        with open(index_path, 'rb') as index_file:
+            header = index_file.read(struct.calcsize(INDEX_HEADER))
+            magic, rows, attributes, file_size, file_time, strings_size = \
+                struct.unpack(INDEX_HEADER, header)
+            assert magic == INDEX_MAGIC, '%s is not an annotation index.' % index_path
+            strings = index_file.read(strings_size).decode('utf-8').split('\0')
+            scaffold_bounds = struct.unpack('<Q', index_file.read(8))[0]
+            lengths = {'attribute_offsets': rows + 1, 'attribute_keys': attributes,
+                       'attribute_values': attributes, 'scaffold_bounds': scaffold_bounds}
+            columns = {}
+            for name, typecode in ROW_ARRAYS + ATTRIBUTE_ARRAYS:
+                columns[name] = array(typecode)
+                columns[name].fromfile(index_file, lengths.get(name, rows))
+                if sys.byteorder != 'little':
+                    columns[name].byteswap()
+        return AnnotationIndex(strings, columns, file_size, file_time)
+
+    def is_current(self, annotation_path):
+        """
+        Function to check whether the index still matches the size and time of its annotation.
+
+        :param annotation_path: The path of the annotation file, given as a string.
+        :return: True if the annotation is unchanged since it was indexed, False otherwise.
+        """
+        file_stat = os.stat(annotation_path)
+        return file_stat.st_size == self.file_size and file_stat.st_mtime == self.file_time
+
+    def get_attributes(self, row):
+        """
+        Function to get the attributes of a feature.
+
+        :param row: The row of the feature, given as an int.
+        :return: A dictionary of the attribute keys and values.
+        """
+        first, last = self.columns['attribute_offsets'][row:row + 2]
+        return dict((self.strings[key], self.strings[value]) for key, value in
+                    zip(self.columns['attribute_keys'][first:last],
+                        self.columns['attribute_values'][first:last]))
+
+    def get_attribute(self, row, key, default=None):
+        """
+        Function to get the value of a single attribute of a feature.
+
+        :param row: The row of the feature, given as an int.
+        :param key: The attribute key, such as 'gene_id', given as a string.
+        :param default: The value returned if the feature lacks the attribute.
+        :return: The value of the attribute, given as a string.
+        """
+        key_number = self.string_numbers.get(key)
+        first, last = self.columns['attribute_offsets'][row:row + 2]
+        for index in range(first, last):
+            if self.columns['attribute_keys'][index] == key_number:
+                return self.strings[self.columns['attribute_values'][index]]
+        return default
+
+    def get_feature(self, row):
+        """
+        Function to get a feature as a tuple of its columns.
+
+        :param row: The row of the feature, given as an int.
+        :return: A (seqid, source, type, start, end, strand, attributes) tuple.
+        """
+        columns = self.columns
+        return (self.strings[columns['seqids'][row]], self.strings[columns['sources'][row]],
+                self.strings[columns['types'][row]], columns['starts'][row],
+                columns['ends'][row], STRANDS[columns['strands'][row]],
+                self.get_attributes(row))
+
+    def format_feature(self, row):
+        """
+        Function to format a feature as a GFF3 line, its attributes as key=value pairs.
+
+        :param row: The row of the feature, given as an int.
+        :return: The line, without a newline character, given as a string.
+        """
+        seqid, source, feature_type, start, end, strand, attributes = self.get_feature(row)
+        return '\t'.join([seqid, source, feature_type, str(start), str(end), '.', strand, '.',
+                          ';'.join('%s=%s' % pair for pair in sorted(attributes.items()))])
+
+    def query(self, seqid, start=1, end=None, feature_type=None):
+        """
+        Function to find the features overlapping a region.
+
+        :param seqid: The scaffold of the region, given as a string.
+        :param start: The first position of the region, 1-based.
+        :param end: The last position of the region, inclusive, or None for the scaffold's end.
+        :param feature_type: Only return features of this type, such as 'transcript', or None.
+        :return: The rows of the overlapping features, given as a list in order of their start.
+        """
+        type_number = self.string_numbers.get(feature_type)
+        if seqid not in self.scaffolds or (feature_type is not None and type_number is None):
+            return []
+        first, last = self.scaffolds[seqid]
+        starts, ends, max_ends = \
+            self.columns['starts'], self.columns['ends'], self.columns['max_ends']
+        count = last - first
+        if end is None:
+            end = sys.maxsize
+        rows = []
+        # Nodes are visited in order: a node is pushed again, marked, before its left child, and
+        # is reported and replaced by its right child once its left child is done.
+        top_level = count.bit_length() - 1
+        stack = [(top_level, (1 << top_level) - 1, False)] if count else []
+        while stack:
+            level, row, left_done = stack.pop()
+            if level <= SCAN_LEVEL:
+                first_row = row >> level << level
+                last_row = min(first_row + (1 << (level + 1)) - 1, count)
+                for row in range(first + first_row, first + last_row):
+                    if starts[row] > end:
+                        break
+                    if ends[row] >= start:
+                        rows.append(row)
+            elif not left_done:
+                left_row = row - (1 << (level - 1))
+                stack.append((level, row, True))
+                if left_row >= count or max_ends[first + left_row] >= start:
+                    stack.append((level - 1, left_row, False))
+            elif row < count and starts[first + row] <= end:
+                if ends[first + row] >= start:
+                    rows.append(first + row)
+                stack.append((level - 1, row + (1 << (level - 1)), False))
+        if type_number is None:
+            return rows
+        return [row for row in rows if self.columns['types'][row] == type_number]
+
+    def get_locations(self, key='gene_id', feature_type=None):
+        """
+        Function to get the span of every value of an attribute, such as the coordinates of every
+        gene, for joining tables such as the fpkm_tracking files to the annotation.
+
+        :param key: The attribute key, such as 'gene_id', given as a string.
+        :param feature_type: Only use features of this type, such as 'exon', or None.
+        :return: A dictionary of the values and their (seqid, start, end, strand) tuples.
+        """
+        locations = {}
+        columns = self.columns
+        type_number = self.string_numbers.get(feature_type)
+        for row in range(len(self)):
+            if feature_type is not None and columns['types'][row] != type_number:
+                continue
+            value = self.get_attribute(row, key)
+            if value is None:
+                continue
+            location = locations.get(value)
+            if location is None:
+                locations[value] = (self.strings[columns['seqids'][row]], columns['starts'][row],
+                                    columns['ends'][row], STRANDS[columns['strands'][row]])
+            else:
+                locations[value] = (location[0], min(location[1], columns['starts'][row]),
+                                    max(location[2], columns['ends'][row]), location[3])
+        return locations
+
+
+def build_annotation_index(annotation_path):
+    """
+    Function to build the index of a GTF/GFF3 file in a single pass over the file, stopping at
+    the sequences a GFF3 file may hold after a ##FASTA line.
+
+    :param annotation_path: The path of the annotation file, given as a string.
+    :return: The built AnnotationIndex.
+    """
+    builder = AnnotationIndexBuilder()
+    file_stat = os.stat(annotation_path)
+    with open_annotation(annotation_path) as annotation_file:
+        for line in annotation_file:
+            if line.startswith('##FASTA'):
+                break
+            builder.add_line(line)
+    return builder.get_index(file_stat.st_size, file_stat.st_mtime)
+
+
+def is_index_file(index_path):
+    """
+    Function to check whether a file is an index in the current format, so that indices written
+    in an earlier format are rebuilt.
+
+    :param index_path: The path of the index file, given as a string.
+    :return: True if the file exists and starts with the current magic, False otherwise.
+    """
+    if not os.path.exists(index_path):
+        return False
+    with open(index_path, 'rb') as index_file:
+        return index_file.read(len(INDEX_MAGIC)) == INDEX_MAGIC
+
+
+def load_annotation_index(annotation_path, save=True):
+    """
+    Function to load the index of an annotation, building and saving it if there is no index or
+    the annotation changed since it was indexed.
+
+    :param annotation_path: The path of the annotation file, given as a string.
+    :param save: Whether to save a newly built index next to the annotation.
+    :return: The AnnotationIndex.
+    """
+    index_path = get_index_path(annotation_path)
+    if is_index_file(index_path):
+        index = AnnotationIndex.load(index_path)
+        if index.is_current(annotation_path):
+            return index
+    index = build_annotation_index(annotation_path)
+    if save:
+        try:
+            index.save(index_path)
+        except (IOError, OSError):
+            print('Could not save the annotation index %s.' % index_path)
+    return index
+
+
+def parse_region(region):
+    """
+    Function to parse a region given as <seqid>:<start>-<end> or <seqid>.
+
+    :param region: The region, given as a string.
+    :return: The seqid, start and end of the region, the end None for a whole scaffold.
+    """
+    seqid, start, end = REGION_PATTERN.match(region).groups()
+    if start is None:
+        return seqid, 1, None
+    return seqid, int(start.replace(',', '')), int(end.replace(',', ''))
+
+
+def main():
+    """
+    Method designed to index an annotation and print the features overlapping the given regions.
+    """
+    annotation_path, = get_command_line_arguments([''])
+    assert os.path.exists(annotation_path), 'Annotation path "%s" not found.' % annotation_path
+    start_time = time.time()
+    index = load_annotation_index(annotation_path)
+    print('Loaded %s features of %s on %s scaffolds in %.3f seconds.' % (
+        len(index), annotation_path, len(index.scaffolds), time.time() - start_time))
+    for region in sys.argv[2:]:
+        start_time = time.time()
+        rows = index.query(*parse_region(region))
+        query_time = time.time() - start_time
+        for row in rows:
+            print(index.format_feature(row))
+        print('%s features overlap %s, found in %.3f ms.' % (len(rows), region,
+                                                             1000 * query_time))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,7 +9,19 @@ A script designed to run the command line tool cuffdiff.
     inputs:     -reference annotation file
                 -output folder path
                 -overwrite option [True/False]
-                -sorted sam files
+                -number of threads
+                -sorted sam files, or comma-separated groups of the replicates of a condition
+
+Within the pipeline, cuffdiff is driven by a sample sheet, a tab-separated file with a line per
+sample giving its name, condition and, optionally, replicate number:
+    S1  control 1
+    S2  control 2
+    S3  treated 1
+Empty lines, lines starting with '#' and a header line starting with 'sample' are ignored. The
+replicates of a condition are passed to cuffdiff as one comma-separated group, ordered by their
+replicate numbers, and every contrast is run by its own cuffdiff, so that contrasts can run side
+by side. A contrast 'treated:control' compares treated to control, log2 fold changes being
+treated over control.
 
 In order to provide readable and understandable code, the right indentation margin has been
 increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
@@ -18,19 +30,11 @@ and function names, as well as more extensive doc-strings.
 """
 
 
-import subprocess
+import collections
 import sys
 import os
 
-
-def execute_on_command_line(cmd_string):
-    """
-    Method to parse a formatted string to the command line and execute it.
-
-    :param cmd_string: The formatted string to be executed.
-    """
-    assert isinstance(cmd_string, str), 'Command Line String must be of type string.'
-    subprocess.check_call(cmd_string, shell=True)
+import StageResult
 
 
 def get_command_line_arguments(default_variable_values):
@@ -70,38 +74,118 @@ def get_variable_command_line_arguments(start_index):
     return variable_inputs
 
 
-def run_cuff_diff(sorted_sam_paths, annotation, output_path, overwrite=False):
+def read_sample_sheet(sample_sheet_path):
+    """
+    Function to read the conditions and their replicates from a sample sheet.
+
+    :param sample_sheet_path: Path leading to the tab-separated sample sheet.
+    :return: An ordered dictionary of the conditions, in order of their first appearance, and
+    their sample names, ordered by replicate number.
+    """
+    replicates = collections.OrderedDict()
+    with open(sample_sheet_path) as sample_sheet:
+        for line_number, line in enumerate(sample_sheet):
+            fields = line.split()
+            if not fields or fields[0].startswith('#') or \
+                    (line_number == 0 and fields[0].lower() == 'sample'):
+                continue
+            assert len(fields) in (2, 3), 'Line %s of sample sheet "%s" is malformed: %s' % (
+                line_number + 1, sample_sheet_path, line.strip())
+            replicate = int(fields[2]) if len(fields) == 3 else line_number
+            replicates.setdefault(fields[1], []).append((replicate, fields[0]))
+    samples = [sample for condition in replicates.values() for replicate, sample in condition]
+    assert len(samples) == len(set(samples)), \
+        'Sample sheet "%s" lists a sample more than once.' % sample_sheet_path
+    return collections.OrderedDict((condition, [sample for replicate, sample in sorted(group)])
+                                   for condition, group in replicates.items())
+
+
+def get_contrasts(conditions, contrast_string=''):
+    """
+    Function to parse the contrasts to test, defaulting to every condition against the first.
+
+    :param conditions: The conditions of the sample sheet, given as a list in sheet order.
+    :param contrast_string: Comma-separated contrasts 'treated:control', or '' for the default.
+    :return: A list of (condition, reference condition) tuples.
+    """
+    if not contrast_string:
+        return [(condition, conditions[0]) for condition in conditions[1:]]
+    contrasts = [tuple(contrast.split(':')) for contrast in contrast_string.split(',')]
+    for contrast in contrasts:
+        assert len(contrast) == 2 and contrast[0] != contrast[1], \
+            'Contrast "%s" must be given as treated:control.' % ':'.join(contrast)
+        for condition in contrast:
+            assert condition in conditions, 'Condition "%s" not in the sample sheet.' % condition
+    return contrasts
+
+
+def get_contrast_name(contrast):
     """
-    Method to run CuffDiff on the Command line.
+    Function to generate the name of a contrast, used for its stage and output folder.
 
-    :param sorted_sam_paths: A list of sam file paths, one for each condition to be tested.
-    :param annotation: A reference annotation gtf/gff file.
-    :param output_path: The
-    :return:
+    :param contrast: The (condition, reference condition) tuple.
+    :return: The name <condition>_vs_<reference>, given as a string.
+    """
+    return '%s_vs_%s' % contrast
+
+
+def get_replicate_groups(replicates, contrast, sample_paths):
+    """
+    Function to build the comma-separated replicate groups of a contrast, reference first.
+
+    :param replicates: The conditions and their sample names, as returned by read_sample_sheet.
+    :param contrast: The (condition, reference condition) tuple.
+    :param sample_paths: A dictionary of sample names and their quantified input files.
+    :return: The replicate groups, given as a list of strings, and the matching labels.
+    """
+    labels = [contrast[1], contrast[0]]
+    return [','.join(sample_paths[sample] for sample in replicates[label])
+            for label in labels], labels
+
+
+def run_cuff_diff(sorted_sam_paths, annotation, output_path, overwrite=False, threads=8,
+                  labels=None):
+    """
+    Function to run CuffDiff on the Command line.
+
+    :param sorted_sam_paths: A list of sorted sam/bam files, or of cuffquant abundances.cxb files,
+    one for each condition to be tested; the replicates of a condition are given as a list or as
+    one comma-separated string. Reading the .cxb files of samples quantified once avoids another
+    pass over their alignments.
+    :param annotation: The merged transcripts gtf file the samples were quantified against.
+    :param output_path: The path of the cuffdiff output folder.
+    :param threads: The number of threads cuffdiff may use, given as an int.
+    :param labels: The names of the conditions, given as a list, or None for cuffdiff's defaults.
+    :return: The StageResult of cuffdiff, listing the output folder.
     """
     if not os.path.exists(output_path) or overwrite:
         print('Running Cuffdiff on {0}'.format(sorted_sam_paths))
-        cmd = 'cuffdiff -p 8 -g %s -l' % annotation
+        cmd = 'cuffdiff -p %s -o %s ' % (threads, output_path)
+        if labels:
+            cmd += '-L %s ' % ','.join(labels)
+        cmd += annotation
         for sam_file in sorted_sam_paths:
-            cmd += '%s ' % sam_file
-        cmd += '-o %s' % output_path
-        execute_on_command_line(cmd)
+            cmd += ' %s' % (sam_file if isinstance(sam_file, str) else ','.join(sam_file))
+        result = StageResult.run_command('cuffdiff', cmd, [output_path])
         print('Cuffdiff output saved to %s' % output_path)
-    else:
-        print('Directory %s already present. Not overwritten.' % output_path)
+        return result
+    print('Directory %s already present. Not overwritten.' % output_path)
+    return StageResult.skip_stage('cuffdiff', [output_path])
 
 
 def main():
     """
     Method designed to run the command line tool cuffdiff.
     """
-    annotation, output_folder_path, overwrite = get_command_line_arguments(['', '', ''])
-    sorted_sam_paths = get_variable_command_line_arguments(4)
+    annotation, output_folder_path, overwrite, threads = \
+        get_command_line_arguments(['', '', '', ''])
+    sorted_sam_paths = get_variable_command_line_arguments(5)
     assert os.path.exists(annotation), 'Annotation file path "%s" does not exist.' % annotation
     assert os.path.exists(output_folder_path), 'Output path "%s" not found.' % output_folder_path
-    for sam_file in sorted_sam_paths:
+    for sam_file in ','.join(sorted_sam_paths).split(','):
         assert os.path.exists(sam_file), 'SAM file path "%s" no found.' % sam_file
-    run_cuff_diff(sorted_sam_paths, annotation, output_folder_path, overwrite)
+    run_cuff_diff(sorted_sam_paths, annotation, output_folder_path, str(overwrite) == 'True',
+                  int(threads))
 
 
 if __name__ == '__main__':
@@ -10,6 +10,7 @@ A script designed to run the command line tool cufflinks.
                 -reference annotation file
                 -output folder path
                 -overwrite option [True/False]
+                -number of threads [default 4]
 
 In order to provide readable and understandable code, the right indentation margin has been
 increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
@@ -18,19 +19,10 @@ and function names, as well as more extensive doc-strings.
 """
 
 
-import subprocess
 import sys
 import os
 
-
-def execute_on_command_line(cmd_string):
-    """
-    Method to parse a formatted string to the command line and execute it.
-
-    :param cmd_string: The formatted string to be executed.
-    """
-    assert isinstance(cmd_string, str), 'Command Line String must be of type string.'
-    subprocess.check_call(cmd_string, shell=True)
+import StageResult
 
 
 def get_command_line_arguments(default_variable_values):
@@ -56,34 +48,39 @@ def get_command_line_arguments(default_variable_values):
     return input_variables
 
 
-def run_cuff_links(sam_sorted_path, annotation, cuff_links_output, overwrite=False):
+def run_cuff_links(sam_sorted_path, annotation, cuff_links_output, overwrite=False, threads=4):
     """
-    Method for running Cufflinks on the command line using the provided input arguments.
+    Function for running Cufflinks on the command line using the provided input arguments.
 
     :param sam_sorted_path: Path leading to the sorted sam file to be run through cufflinks,
     given as a string.
     :param annotation: Path leading to the reference annotation gtf/gff file to be run through
     cufflinks, given as a string.
     :param cuff_links_output: Path leading to the desired folder to contain the cufflinks output.
+    :param threads: The number of threads cufflinks may use, given as an int.
+    :return: The StageResult of cufflinks, listing the output folder.
     """
     if not os.path.exists(cuff_links_output) or overwrite:
         print('Running Cufflinks on %s.' % sam_sorted_path)
-        cmd = 'cufflinks -p 4 %s -g %s -o %s' % (sam_sorted_path, annotation, cuff_links_output)
-        execute_on_command_line(cmd)
+        cmd = 'cufflinks -p %s %s -g %s -o %s' % (threads, sam_sorted_path, annotation,
+                                                   cuff_links_output)
+        result = StageResult.run_command('cufflinks', cmd, [cuff_links_output])
         print('Saved SAM output to %s' % cuff_links_output)
-    else:
-        print('Directory %s already there. Not overwritten.' % cuff_links_output)
+        return result
+    print('Directory %s already there. Not overwritten.' % cuff_links_output)
+    return StageResult.skip_stage('cufflinks', [cuff_links_output])
 
 
 def main():
     """
     Method designed to run the command line tool cufflinks.
     """
-    sorted_sam_path, annotation, output_folder_path, overwrite = \
-        get_command_line_arguments(['', '', '', False])
+    sorted_sam_path, annotation, output_folder_path, overwrite, threads = \
+        get_command_line_arguments(['', '', '', False, 4])
     assert os.path.exists(sorted_sam_path), 'Directory to Sorted Sam file does not exist.'
     assert os.path.exists(annotation), 'Directory to Annotation file does not exist.'
-    run_cuff_links(sorted_sam_path, annotation, output_folder_path, overwrite)
+    run_cuff_links(sorted_sam_path, annotation, output_folder_path, str(overwrite) == 'True',
+                   int(threads))
 
 
 if __name__ == '__main__':
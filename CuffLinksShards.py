@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A script designed to run cufflinks on a sorted, indexed BAM file in scaffold shards, as cufflinks
+scales poorly beyond a few threads while a genome of thousands of small scaffolds divides well.
+    -Inputs:    [1] Directory of the sorted, indexed BAM file.
+                [2] Directory of the reference annotation gtf/gff file.
+                [3] Directory of the cufflinks output folder.
+                [4] Overwrite: True/False - overwrite an existing output folder.
+                [5] Number of threads all shards may use together, default 4.
+                [6] Number of shards, default 4.
+    -Outputs:   [1] transcripts.gtf, skipped.gtf, genes.fpkm_tracking and isoforms.fpkm_tracking,
+                saved in the output folder as if cufflinks had run on the whole BAM file.
+
+The scaffolds are divided into shards of about equal read counts, as counted by samtools idxstats,
+and every shard gets its own BAM file and the part of the annotation on its scaffolds; scaffolds
+without reads, and annotated scaffolds missing from the BAM file, join a shard all the same, so
+their reference transcripts are reported with an FPKM of 0. There are no more shards than
+threads, and the shards run side by side, each with an equal part of the threads. Their outputs
+are concatenated, the CUFF gene and transcript and TSS identifiers renumbered so they are unique
+over all shards, and the FPKM values and their confidence bounds rescaled from the fragments of
+the shard to the fragments of the whole file, counted as the primary alignments of mapped reads,
+as cufflinks counts them. The output is written into <output folder>.partial, which replaces the
+output folder once all shards are merged.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import subprocess
+import shutil
+import heapq
+import time
+import sys
+import os
+import re
+
+import StageResult
+import CuffLinks
+
+
+GTF_FILES = ('transcripts.gtf', 'skipped.gtf')
+TRACKING_FILES = ('genes.fpkm_tracking', 'isoforms.fpkm_tracking')
+ID_FIELDS = ('gene_id', 'transcript_id', 'tss_id', 'tracking_id')
+FPKM_FIELDS = ('FPKM', 'conf_lo', 'conf_hi', 'FPKM_conf_lo', 'FPKM_conf_hi')
+CUFF_ID_PATTERN = re.compile(r'^CUFF\.(\d+)((?:\.\d+)?)$')
+TSS_ID_PATTERN = re.compile(r'^TSS(\d+)$')
+ATTRIBUTE_PATTERN = re.compile(r'(\S+) "([^"]*)";')
+
+
+def get_command_line_arguments(default_variable_values):
+    """
+    Function to get a variable number of input arguments from the command line, but use default
+    values if none were given.
+
+    :param default_variable_values: A list of default values given in order of their appearance in
+    the command line.
+    :return: A list of input variables.
+    """
+    assert isinstance(default_variable_values, list), \
+        'The given default input variables values must be a list.'
+    input_variables = [0]*len(default_variable_values)
+    for index, default_value in enumerate(default_variable_values):
+        try:
+            input_variables[index] = sys.argv[index + 1]
+        except IndexError:
+            if default_value != '':
+                input_variables[index] = default_value
+            else:
+                exit('Not enough command line input arguments. Critical Input Missing.')
+    return input_variables
+
+
+def get_scaffold_counts(sorted_bam_path):
+    """
+    Function to count the mapped reads of every scaffold of an indexed BAM file.
+
+    :param sorted_bam_path: Path leading to the sorted, indexed BAM file.
+    :return: A list of (scaffold, length, mapped reads) tuples, in the order of the BAM header.
+    """
+    output = subprocess.check_output('samtools idxstats %s' % sorted_bam_path, shell=True)
+    scaffold_counts = []
+    for line in output.decode('utf-8').splitlines():
+        fields = line.split('\t')
+        if len(fields) >= 3 and fields[0] != '*':
+            scaffold_counts.append((fields[0], int(fields[1]), int(fields[2])))
+    return scaffold_counts
+
+
+def count_primary_alignments(bam_path):
+    """
+    Function to count the primary alignments of the mapped reads of a BAM file, leaving out
+    unmapped reads and secondary and supplementary alignments.
+
+    :param bam_path: Path leading to the BAM file.
+    :return: The number of primary alignments, given as an int.
+    """
+    return int(subprocess.check_output('samtools view -c -F 0x904 %s' % bam_path, shell=True))
+
+
+def balance_scaffolds(scaffold_counts, shards):
+    """
+    Function to divide the scaffolds into shards of about equal read counts, giving every
+    scaffold, most reads first, to the shard with the fewest reads so far. Shards left without
+    reads are added to the lightest shard holding reads, so every scaffold is in a shard.
+
+    :param scaffold_counts: A list of (scaffold, length, mapped reads) tuples.
+    :param shards: The largest number of shards, given as an int.
+    :return: A list of shards holding reads, each a list of (scaffold, length, mapped reads)
+    tuples in the order of the BAM header, heaviest shard first, or a single shard of all
+    scaffolds if none holds reads.
+    """
+    heap = [(0, index, []) for index in range(shards)]
+    for order, scaffold in sorted(enumerate(scaffold_counts), key=lambda item: -item[1][2]):
+        reads, index, group = heapq.heappop(heap)
+        group.append((order, scaffold))
+        heapq.heappush(heap, (reads + scaffold[2], index, group))
+    heap.sort(reverse=True)
+    groups = [group for reads, index, group in heap if reads > 0] or [[]]
+    for reads, index, group in heap:
+        if reads == 0:
+            groups[-1].extend(group)
+    return [[scaffold for order, scaffold in sorted(group)] for group in groups]
+
+
+def write_shard_inputs(groups, annotation, shard_folders):
+    """
+    Method to write the region BED file of every shard, and the lines of the annotation on its
+    scaffolds, in a single pass over the annotation. Lines on scaffolds missing from the BAM file
+    go to the first shard.
+
+    :param groups: The shards, as returned by balance_scaffolds.
+    :param annotation: Path leading to the reference annotation gtf/gff file.
+    :param shard_folders: The folders of the shards, given as a list of strings.
+    """
+    shard_of_scaffold = {}
+    for index, group in enumerate(groups):
+        with open('%s/regions.bed' % shard_folders[index], 'w') as bed_file:
+            for scaffold, length, reads in group:
+                bed_file.write('%s\t0\t%s\n' % (scaffold, length))
+                shard_of_scaffold[scaffold] = index
+    extension = os.path.splitext(annotation)[1]
+    annotation_files = [open('%s/annotation%s' % (shard_folder, extension), 'w')
+                        for shard_folder in shard_folders]
+    try:
+        with open(annotation) as annotation_file:
+            for line in annotation_file:
+                if line.startswith('#'):
+                    for shard_file in annotation_files:
+                        shard_file.write(line)
+                    continue
+                annotation_files[shard_of_scaffold.get(line.split('\t', 1)[0], 0)].write(line)
+    finally:
+        for shard_file in annotation_files:
+            shard_file.close()
+
+
+class IdentifierRenumberer(object):
+    """
+    Renumbers the CUFF gene and transcript and the TSS identifiers of the shards, so they are
+    unique over all shards while an identifier keeps its number across the files of its shard.
+    Reference identifiers, unique already, are kept.
+    """
+
+    def __init__(self):
+        self.numbers = {}
+        self.next_numbers = {'CUFF': 1, 'TSS': 1}
+
+    def get_number(self, kind, shard, number):
+        """
+        Function to get the new number of an identifier of a shard, numbering it if it is new.
+
+        :param kind: The kind of identifier, 'CUFF' or 'TSS'.
+        :param shard: The index of the shard, given as an int.
+        :param number: The number of the identifier within the shard, given as a string.
+        :return: The number of the identifier over all shards, given as an int.
+        """
+        key = (kind, shard, number)
+        if key not in self.numbers:
+            self.numbers[key] = self.next_numbers[kind]
+            self.next_numbers[kind] += 1
+        return self.numbers[key]
+
+    def renumber(self, shard, identifiers):
+        """
+        Function to renumber a comma-separated list of identifiers of a shard.
+
+        :param shard: The index of the shard, given as an int.
+        :param identifiers: The identifiers, given as a string.
+        :return: The renumbered identifiers, given as a string.
+        """
+        renumbered = []
+        for identifier in identifiers.split(','):
+            match = CUFF_ID_PATTERN.match(identifier)
+            if match:
+                identifier = 'CUFF.%s%s' % (self.get_number('CUFF', shard, match.group(1)),
+                                            match.group(2))
+            match = TSS_ID_PATTERN.match(identifier)
+            if match:
+                identifier = 'TSS%s' % self.get_number('TSS', shard, match.group(1))
+            renumbered.append(identifier)
+        return ','.join(renumbered)
+
+
+def scale_value(value, factor):
+    """
+    Function to scale a numeric value written by cufflinks, leaving anything else unchanged.
+
+    :param value: The value, given as a string.
+    :param factor: The factor to scale it by, given as a float.
+    :return: The scaled value, given as a string.
+    """
+    try:
+        return '%.10g' % (float(value) * factor)
+    except ValueError:
+        return value
+
+
+def merge_gtf_files(shard_paths, factors, renumberer, output_path):
+    """
+    Method to concatenate the gtf files of the shards, renumbering their identifiers and scaling
+    their FPKM values.
+
+    :param shard_paths: The paths of the gtf files of the shards, given as a list of strings.
+    :param factors: The factor of every shard, its share of the fragments, given as a list of
+    floats.
+    :param renumberer: The IdentifierRenumberer shared by all files of the shards.
+    :param output_path: The path of the merged gtf file.
+    """
+    with open(output_path, 'w') as output_file:
+        for shard, (shard_path, factor) in enumerate(zip(shard_paths, factors)):
+            with open(shard_path) as shard_file:
+                for line in shard_file:
+                    fields = line.rstrip('\n').split('\t')
+                    if len(fields) < 9:
+                        output_file.write(line)
+                        continue
+                    attributes = []
+                    for name, value in ATTRIBUTE_PATTERN.findall(fields[8]):
+                        if name in ID_FIELDS:
+                            value = renumberer.renumber(shard, value)
+                        elif name in FPKM_FIELDS:
+                            value = scale_value(value, factor)
+                        attributes.append('%s "%s";' % (name, value))
+                    fields[8] = ' '.join(attributes)
+                    output_file.write('\t'.join(fields) + '\n')
+
+
+def merge_tracking_files(shard_paths, factors, renumberer, output_path):
+    """
+    Method to concatenate the fpkm_tracking files of the shards under a single header,
+    renumbering their identifiers and scaling their FPKM values.
+
+    :param shard_paths: The paths of the tracking files of the shards, given as a list of strings.
+    :param factors: The factor of every shard, its share of the fragments, given as a list of
+    floats.
+    :param renumberer: The IdentifierRenumberer shared by all files of the shards.
+    :param output_path: The path of the merged tracking file.
+    """
+    with open(output_path, 'w') as output_file:
+        for shard, (shard_path, factor) in enumerate(zip(shard_paths, factors)):
+            with open(shard_path) as shard_file:
+                header = shard_file.readline()
+                if shard == 0:
+                    output_file.write(header)
+                columns = header.rstrip('\n').split('\t')
+                for line in shard_file:
+                    fields = line.rstrip('\n').split('\t')
+                    for index, column in enumerate(columns[:len(fields)]):
+                        if column in ID_FIELDS:
+                            fields[index] = renumberer.renumber(shard, fields[index])
+                        elif column in FPKM_FIELDS:
+                            fields[index] = scale_value(fields[index], factor)
+                    output_file.write('\t'.join(fields) + '\n')
+
+
+def merge_shard_outputs(shard_outputs, factors, output_folder_path):
+    """
+    Function to merge the cufflinks outputs of the shards into a single cufflinks output.
+
+    :param shard_outputs: The cufflinks output folders of the shards, given as a list of strings.
+    :param factors: The factor of every shard, its share of the fragments, given as a list of
+    floats.
+    :param output_folder_path: Path leading to the merged cufflinks output folder.
+    :return: The paths of the merged files, given as a list of strings.
+    """
+    renumberer = IdentifierRenumberer()
+    output_paths = []
+    for file_name in GTF_FILES + TRACKING_FILES:
+        shard_paths = ['%s/%s' % (shard_output, file_name) for shard_output in shard_outputs]
+        if not all(os.path.exists(shard_path) for shard_path in shard_paths):
+            continue
+        output_paths.append('%s/%s' % (output_folder_path, file_name))
+        if file_name in GTF_FILES:
+            merge_gtf_files(shard_paths, factors, renumberer, output_paths[-1])
+        else:
+            merge_tracking_files(shard_paths, factors, renumberer, output_paths[-1])
+    return output_paths
+
+
+def run_sharded_cuff_links(sorted_bam_path, annotation, cuff_links_output, overwrite=False,
+                           threads=4, shards=4):
+    """
+    Function to run cufflinks on the scaffold shards of a sorted, indexed BAM file side by side,
+    and merge their outputs, through a partial output folder. A BAM file holding reads on a
+    single scaffold, or a single thread, is run whole.
+
+    :param sorted_bam_path: Path leading to the sorted BAM file, indexed if <bam>.bai exists and
+    indexed first otherwise.
+    :param annotation: Path leading to the reference annotation gtf/gff file.
+    :param cuff_links_output: Path leading to the desired folder to contain the cufflinks output.
+    :param overwrite: [True/False] statement that determines whether output is overwritten.
+    :param threads: The number of threads all shards may use together, given as an int.
+    :param shards: The largest number of shards, given as an int, capped at the threads.
+    :return: The StageResult of the shards, listing the output folder.
+    """
+    if os.path.exists(cuff_links_output) and not overwrite:
+        print('Directory %s already there. Not overwritten.' % cuff_links_output)
+        return StageResult.skip_stage('cufflinks', [cuff_links_output])
+    start_time = time.time()
+    if not os.path.exists('%s.bai' % sorted_bam_path):
+        StageResult.run_command('samtools index', 'samtools index %s' % sorted_bam_path,
+                                ['%s.bai' % sorted_bam_path])
+    scaffold_counts = get_scaffold_counts(sorted_bam_path)
+    groups = balance_scaffolds(scaffold_counts, max(1, min(shards, int(threads))))
+    if len(groups) < 2:
+        return CuffLinks.run_cuff_links(sorted_bam_path, annotation, cuff_links_output, True,
+                                        threads)
+    print('Running Cufflinks on %s in %s shards.' % (sorted_bam_path, len(groups)))
+    partial_output = '%s.partial' % cuff_links_output
+    if os.path.exists(partial_output):
+        shutil.rmtree(partial_output)
+    shard_folders = ['%s/shards/%s' % (partial_output, index) for index in range(len(groups))]
+    for shard_folder in shard_folders:
+        if not os.path.exists(shard_folder):
+            os.makedirs(shard_folder)
+    write_shard_inputs(groups, annotation, shard_folders)
+    StageResult.run_parallel('cufflinks shard', [
+        'samtools view -b -M -L %s/regions.bed -o %s/shard.bam %s' % (
+            shard_folder, shard_folder, sorted_bam_path) for shard_folder in shard_folders],
+        ['%s/shard.bam' % shard_folder for shard_folder in shard_folders])
+    shard_threads = max(1, int(threads) // len(groups))
+    extension = os.path.splitext(annotation)[1]
+    result = StageResult.run_parallel('cufflinks', [
+        'cufflinks -p %s %s/shard.bam -g %s/annotation%s -o %s/output' % (
+            shard_threads, shard_folder, shard_folder, extension, shard_folder)
+        for shard_folder in shard_folders], [cuff_links_output])
+    # Every scaffold is in exactly one shard, so the shards' fragments add up to the file's.
+    fragments = [count_primary_alignments('%s/shard.bam' % shard_folder)
+                 for shard_folder in shard_folders]
+    factors = [shard_fragments / float(max(1, sum(fragments))) for shard_fragments in fragments]
+    merge_shard_outputs(['%s/output' % shard_folder for shard_folder in shard_folders], factors,
+                        partial_output)
+    shutil.rmtree('%s/shards' % partial_output)
+    if os.path.exists(cuff_links_output):
+        shutil.rmtree(cuff_links_output)
+    os.rename(partial_output, cuff_links_output)
+    result.elapsed_time = time.time() - start_time
+    print('Saved sharded Cufflinks output to %s' % cuff_links_output)
+    return result
+
+
+def main():
+    """
+    Method designed to run cufflinks on the scaffold shards of a sorted, indexed BAM file.
+    """
+    sorted_bam_path, annotation, output_folder_path, overwrite, threads, shards = \
+        get_command_line_arguments(['', '', '', False, 4, 4])
+    assert os.path.exists(sorted_bam_path), 'Directory to Sorted BAM file does not exist.'
+    assert os.path.exists(annotation), 'Directory to Annotation file does not exist.'
+    run_sharded_cuff_links(sorted_bam_path, annotation, output_folder_path,
+                           str(overwrite) == 'True', int(threads), int(shards))
+
+
+if __name__ == '__main__':
+    main()
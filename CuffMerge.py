@@ -5,10 +5,13 @@
 Author: Henry Ehlers, Samin Hosseini, Ronald de Jongh
 WUR_Number: 921013218060, ?, 930323409080
 
-A script designed to run the command line tool cuffdiff.
+A script designed to run the command line tool cuffmerge.
     inputs:     -list of directories to check
                 -output folder path
+                -run name, naming the manifest <output folder>/<run name>.txt
                 -overwrite option [True/False]
+                -number of threads
+                -incremental option [True/False]
 
 In order to provide readable and understandable code, the right indentation margin has been
 increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
@@ -17,24 +20,27 @@ and function names, as well as more extensive doc-strings.
 
 CuffMerge now checks the directories in the list itself, then appends those to the command string
 
+The content fingerprints of the transcripts.gtf files that went into merged.gtf are kept next to
+it, in <output folder>/<run name>.fingerprints.json. When no assembly changed, the previous
+merged.gtf is kept as it is, so the stages reading it stay up to date; this skip is the only
+incremental part of the merge. Any change to the assemblies, including added ones, merges all
+assemblies anew: merging added assemblies into a previous merged.gtf would renumber its XLOC and
+TCONS identifiers, invalidating the stages reading it anyway, and make the transcripts depend on
+the order in which the assemblies were added. The incremental option False always merges anew.
+
 """
 
 
-import subprocess
+import hashlib
+import shutil
+import json
 import sys
 import os
 
+import StageResult
 
-def execute_on_command_line(cmd_string):
-    """
-    Method to parse a formatted string to the command line and execute it.
 
-    :param cmd_string: The formatted string to be executed.
-    """
-    assert isinstance(cmd_string, str), 'Command Line String must be of type string.'
-    exit_code = subprocess.check_call(cmd_string, shell=True)
-    if exit_code == 1:
-        exit('Critical Command Line Error: %s' % cmd_string)
+HASH_BLOCK_SIZE = 1 << 20
 
 
 def get_command_line_arguments(default_variable_values):
@@ -92,37 +98,152 @@ def get_variable_command_line_arguments(start_index):
 #         execute_on_command_line(cmd)
 
 
-def run_cuff_merge2(manifest_path, output_path, overwrite=False):
+def run_cuff_merge2(manifest_path, output_path, overwrite=False, threads=1):
     """
-    Method to run CuffMerge on command line.
+    Function to run CuffMerge on command line.
 
     :param transcripts:
     :param annotation:
     :param sorted_sam_files:
     :param output_path:
-    :return:
+    :param threads: The number of threads cuffmerge may use, given as an int.
+    :return: The StageResult of cuffmerge, listing the merged transcripts.
     """
+    output_paths = ['%s/merged.gtf' % output_path]
     if not os.path.exists(output_path) or overwrite:
-        cmd = 'cuffmerge -o %s %s' % (output_path, manifest_path)
-        execute_on_command_line(cmd)
+        cmd = 'cuffmerge -p %s -o %s %s' % (threads, output_path, manifest_path)
+        return StageResult.run_command('cuffmerge', cmd, output_paths)
+    return StageResult.skip_stage('cuffmerge', output_paths)
+
+
+def hash_file(file_path):
+    """
+    Function to fingerprint a file by its full content, so that an assembly rewritten unchanged
+    keeps its fingerprint.
+
+    :param file_path: The path of the file, given as a string.
+    :return: The hexadecimal SHA-1 hash of the file, given as a string.
+    """
+    digest = hashlib.sha1()
+    with open(file_path, 'rb') as input_file:
+        block = input_file.read(HASH_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = input_file.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
 
 
-def make_manifest_text_file(cuff_links_path, file_name):
+def list_assemblies(cuff_links_path):
+    """
+    Function to list the transcripts.gtf files of all finished cufflinks output folders.
+
+    :param cuff_links_path: Path leading to the folder of per-sample cufflinks output folders.
+    :return: The paths of the assemblies, given as a sorted list of strings.
+    """
+    return ['%s/%s/transcripts.gtf' % (cuff_links_path, folder)
+            for folder in sorted(os.listdir(cuff_links_path))
+            if not folder.endswith('.partial') and
+            os.path.isfile('%s/%s/transcripts.gtf' % (cuff_links_path, folder))]
+
+
+def make_manifest_text_file(assembly_paths, file_name):
     with open(file_name, 'w') as text_file:
-        for folder in os.listdir(cuff_links_path):
-            text_file.write('%s/%s/transcripts.gtf\n' % (cuff_links_path, folder))
+        for assembly_path in assembly_paths:
+            text_file.write('%s\n' % assembly_path)
+
+
+def get_fingerprints_path(output_folder_path, run_name):
+    """
+    Function to generate the path of the fingerprints of the assemblies merged into merged.gtf.
+
+    :param output_folder_path: Path leading to the cuffmerge output folder.
+    :param run_name: The name of the run.
+    :return: The path <output_folder_path>/<run_name>.fingerprints.json, given as a string.
+    """
+    return '%s/%s.fingerprints.json' % (output_folder_path, run_name)
+
+
+def load_fingerprints(output_folder_path, run_name):
+    """
+    Function to read the fingerprints of a previous merge, provided its merged.gtf is unchanged.
+
+    :param output_folder_path: Path leading to the cuffmerge output folder of the previous merge.
+    :param run_name: The name of the run.
+    :return: A dictionary of the merged assemblies and their fingerprints, or None if there is no
+    usable previous merge.
+    """
+    fingerprints_path = get_fingerprints_path(output_folder_path, run_name)
+    if not os.path.exists(fingerprints_path):
+        return None
+    with open(fingerprints_path) as fingerprints_file:
+        fingerprints = json.load(fingerprints_file)
+    merged_path = '%s/merged.gtf' % output_folder_path
+    if not os.path.exists(merged_path) or hash_file(merged_path) != fingerprints['merged']:
+        return None
+    return fingerprints['assemblies']
+
+
+def save_fingerprints(output_folder_path, run_name, assemblies):
+    """
+    Method to save the fingerprints of the merged assemblies and of merged.gtf itself.
+
+    :param output_folder_path: Path leading to the cuffmerge output folder.
+    :param run_name: The name of the run.
+    :param assemblies: A dictionary of the merged assemblies and their fingerprints.
+    """
+    with open(get_fingerprints_path(output_folder_path, run_name), 'w') as fingerprints_file:
+        json.dump({'assemblies': assemblies,
+                   'merged': hash_file('%s/merged.gtf' % output_folder_path)},
+                  fingerprints_file, indent=2, sort_keys=True)
+
+
+def merge_assemblies(cuff_links_path, output_folder_path, run_name, overwrite=False, threads=1,
+                     previous_folder_path=None, incremental=True):
+    """
+    Function to write the manifest of the cufflinks assemblies of a run and merge them, keeping
+    the previous merged.gtf if none of the assemblies changed since it was merged.
+
+    :param cuff_links_path: Path leading to the folder of per-sample cufflinks output folders.
+    :param output_folder_path: Path leading to the cuffmerge output folder.
+    :param run_name: The name of the run, used to name the manifest <run_name>.txt.
+    :param overwrite: Whether to overwrite existing cuffmerge output.
+    :param threads: The number of threads cuffmerge may use, given as an int.
+    :param previous_folder_path: Path leading to the output folder of the previous merge, if it
+    is not the output folder itself.
+    :param incremental: Whether to keep an up to date previous merge, or merge all assemblies
+    anew.
+    :return: The StageResult of cuffmerge, listing the merged transcripts.
+    """
+    previous_folder_path = previous_folder_path or output_folder_path
+    manifest_path = '%s/%s.txt' % (output_folder_path, run_name)
+    assemblies = dict((assembly_path, hash_file(assembly_path))
+                      for assembly_path in list_assemblies(cuff_links_path))
+    previous_assemblies = load_fingerprints(previous_folder_path, run_name) if incremental \
+        else None
+    if assemblies == previous_assemblies:
+        print('No assemblies changed since the previous merge. Keeping merged.gtf.')
+        if previous_folder_path != output_folder_path:
+            for file_name in ('merged.gtf', '%s.txt' % run_name,
+                              os.path.basename(get_fingerprints_path('', run_name))):
+                shutil.copy2('%s/%s' % (previous_folder_path, file_name), output_folder_path)
+        return StageResult.skip_stage('cuffmerge', ['%s/merged.gtf' % output_folder_path])
+    make_manifest_text_file(sorted(assemblies), manifest_path)
+    result = run_cuff_merge2(manifest_path, output_folder_path, overwrite, threads)
+    if not result.skipped:
+        save_fingerprints(output_folder_path, run_name, assemblies)
+    return result
 
 
 def main():
     """
     Method designed to run the command line tool cuffmerge.
     """
-    cuff_links_path, output_folder_path, run_name, overwrite = get_command_line_arguments(['']*4)
+    cuff_links_path, output_folder_path, run_name, overwrite, threads, incremental = \
+        get_command_line_arguments(['', '', '', '', 1, True])
     assert os.path.exists(output_folder_path), 'Folder "%s" does not exist.' % output_folder_path
     assert os.path.exists(cuff_links_path), 'Folder "%s" does not exist.' % cuff_links_path
-    manifest_name = '%s.txt' % run_name
-    make_manifest_text_file(cuff_links_path, manifest_name)
-    run_cuff_merge2(manifest_name, output_folder_path, overwrite)
+    merge_assemblies(cuff_links_path, output_folder_path, run_name, str(overwrite) == 'True',
+                     int(threads), incremental=str(incremental) == 'True')
 
 
 if __name__ == '__main__':
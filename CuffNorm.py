@@ -9,6 +9,7 @@ A script designed to run the command line tool cuffdiff.
     inputs:     -reference annotation file
                 -output folder path
                 -overwrite option [True/False]
+                -number of threads
                 -sorted sam files
 
 In order to provide readable and understandable code, the right indentation margin has been
@@ -18,19 +19,10 @@ and function names, as well as more extensive doc-strings.
 """
 
 
-import subprocess
 import sys
 import os
 
-
-def execute_on_command_line(cmd_string):
-    """
-    Method to parse a formatted string to the command line and execute it.
-
-    :param cmd_string: The formatted string to be executed.
-    """
-    assert isinstance(cmd_string, str), 'Command Line String must be of type string.'
-    subprocess.check_call(cmd_string, shell=True)
+import StageResult
 
 
 def get_command_line_arguments(default_variable_values):
@@ -70,33 +62,42 @@ def get_variable_command_line_arguments(start_index):
     return variable_inputs
 
 
-def run_cuff_norm(transcripts, sorted_sam_paths, output_path, overwrite=False):
+def run_cuff_norm(transcripts, sorted_sam_paths, output_path, overwrite=False, threads=4,
+                  labels=None):
     """
-    Method to run Cuffnorm on command line.
-
-    :param transcripts:
-    :param sorted_sam_paths:
-    :param output_path:
-    :return:
+    Function to run Cuffnorm on command line.
+
+    :param transcripts: The merged transcripts gtf file the samples were quantified against.
+    :param sorted_sam_paths: A list of sorted sam/bam files, or of cuffquant abundances.cxb files,
+    one for each sample.
+    :param output_path: The path of the cuffnorm output folder.
+    :param threads: The number of threads cuffnorm may use, given as an int.
+    :param labels: The names of the samples, given as a list, or None for cuffnorm's defaults.
+    :return: The StageResult of cuffnorm, listing the output folder.
     """
     if not os.path.exists(output_path) or overwrite:
-        cmd = 'cuffnorm -p 4 -o %s %s ' % (output_path, transcripts)
+        cmd = 'cuffnorm -p %s -o %s ' % (threads, output_path)
+        if labels:
+            cmd += '-L %s ' % ','.join(labels)
+        cmd += '%s ' % transcripts
         for sam_file in sorted_sam_paths:
             cmd += '%s ' % sam_file
-        execute_on_command_line(cmd)
+        return StageResult.run_command('cuffnorm', cmd, [output_path])
+    return StageResult.skip_stage('cuffnorm', [output_path])
 
 
 def main():
     """
     Method designed to run the command line tool cuffnorm.
     """
-    transcripts, output_folder_path, overwrite = get_command_line_arguments(['']*3)
-    sorted_sam_paths = get_variable_command_line_arguments(4)
+    transcripts, output_folder_path, overwrite, threads = get_command_line_arguments(['']*4)
+    sorted_sam_paths = get_variable_command_line_arguments(5)
     assert os.path.exists(transcripts), 'Transcripts file path "%s" does not exist.' % transcripts
     assert os.path.exists(output_folder_path), 'Folder "%s" does not exist.' % output_folder_path
     for sam_file in sorted_sam_paths:
         assert os.path.exists(sam_file), 'SAM file path "%s" no found.' % sam_file
-    run_cuff_norm(transcripts, sorted_sam_paths, output_folder_path, overwrite)
+    run_cuff_norm(transcripts, sorted_sam_paths, output_folder_path, str(overwrite) == 'True',
+                  int(threads))
 
 
 if __name__ == '__main__':
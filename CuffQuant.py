@@ -14,21 +14,10 @@ and function names, as well as more extensive doc-strings.
 """
 
 
-import subprocess
 import sys
 import os
 
-
-def execute_on_command_line(cmd_string):
-    """
-    Method to parse a formatted string to the command line and execute it.
-
-    :param cmd_string: The formatted string to be executed.
-    """
-    assert isinstance(cmd_string, str), 'Command Line String must be of type string.'
-    exit_code = subprocess.check_call(cmd_string, shell=True)
-    if exit_code == 1:
-        exit('Critical Command Line Error: %s' % cmd_string)
+import StageResult
 
 
 def get_command_line_arguments(default_variable_values):
@@ -54,32 +43,39 @@ def get_command_line_arguments(default_variable_values):
     return input_variables
 
 
-def run_cuff_quant(sorted_sam_file, annotation, output_folder_path, overwrite):
+def run_cuff_quant(sorted_sam_file, annotation, output_folder_path, overwrite, threads=1):
     """
-    Method to run CuffQuant on command line using the provided input arguments.
+    Function to run CuffQuant on command line using the provided input arguments.
 
     :param sorted_sam_file: Path leading to the sorted SAM file to be quantified, given as a
     string.
-    :param annotation: Path leading to the annotation.gtf file.
+    :param annotation: Path leading to the annotation.gtf file, such as the merged transcripts
+    of all samples, against which every sample is quantified.
     :param output_folder_path: Path leading to the desired output folder.
+    :param threads: The number of threads cuffquant may use, given as an int.
+    :return: The StageResult of cuffquant, listing the abundances file.
     """
-    if not os.path.exists('%s/abundances.cxb' % output_folder_path) or overwrite:
+    output_paths = ['%s/abundances.cxb' % output_folder_path]
+    if not os.path.exists(output_paths[0]) or overwrite:
         print('CuffQuant started on %s' % sorted_sam_file)
-        cmd = 'cuffquant %s -g %s -o %s' % (sorted_sam_file, annotation, output_folder_path)
+        cmd = 'cuffquant -p %s -o %s %s %s' % (threads, output_folder_path, annotation,
+                                                sorted_sam_file)
+        result = StageResult.run_command('cuffquant', cmd, output_paths)
         print('CuffQuant output saved to %s/abundances.cxb' % output_folder_path)
-        execute_on_command_line(cmd)
-    else:
-        print('Cuffquant output directory %s already exists. Not overwritten.' %
-              '%s/abundances.cxb' % output_folder_path)
+        return result
+    print('Cuffquant output directory %s already exists. Not overwritten.' %
+          '%s/abundances.cxb' % output_folder_path)
+    return StageResult.skip_stage('cuffquant', output_paths)
 
 
 def main():
-    sorted_sam_path, annotation, output_folder_path, overwrite = \
-        get_command_line_arguments(['', '', '', False])
+    sorted_sam_path, annotation, output_folder_path, overwrite, threads = \
+        get_command_line_arguments(['', '', '', False, 1])
     assert os.path.exists(sorted_sam_path), 'SAM file path "%s" not found.' % sorted_sam_path
     assert os.path.exists(annotation), 'Annotation file path "%s" not found.' % annotation
     assert os.path.exists(output_folder_path), 'Output path "%s" not found.' % output_folder_path
-    run_cuff_quant(sorted_sam_path, annotation, output_folder_path, overwrite)
+    run_cuff_quant(sorted_sam_path, annotation, output_folder_path, str(overwrite) == 'True',
+                   int(threads))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A collection of functions designed to build, store and query a FASTQ record offset index (.fqi),
+giving random access to records of a FASTQ file without scanning it.
+    -Inputs:    [1] Directory of a FASTQ file.
+                [2] Sampling interval: every N-th record is indexed, default 4096.
+    -Outputs:   [1] The index, saved next to the FASTQ file as <fastq_file>.fqi.
+
+The index stores the record number and byte offset of every N-th record in two arrays. A record
+is reached by jumping to the nearest indexed record and reading at most N-1 records forward.
+Offsets refer to the uncompressed data, so compressed files are indexed and queried through a
+(slow) decompressing seek.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+from array import array
+import bisect
+import struct
+import gzip
+import sys
+import os
+
+
+INDEX_MAGIC = b'FQI1'
+INDEX_HEADER = '<4sIQQQ'
+INDEX_EXTENSION = '.fqi'
+DEFAULT_INTERVAL = 4096
+BLOCK_SIZE = 1 << 22
+
+
+def get_command_line_arguments(default_variable_values):
+    """
+    Function to get a variable number of input arguments from the command line, but use default
+    values if none were given.
+
+    :param default_variable_values: A list of default values given in order of their appearance in
+    the command line.
+    :return: A list of input variables.
+    """
+    assert isinstance(default_variable_values, list), \
+        'The given default input variables values must be a list.'
+    input_variables = [0]*len(default_variable_values)
+    for index, default_value in enumerate(default_variable_values):
+        try:
+            input_variables[index] = sys.argv[index + 1]
+        except IndexError:
+            if default_value != '':
+                input_variables[index] = default_value
+            else:
+                exit('Not enough command line input arguments. Critical Input Missing.')
+    return input_variables
+
+
+def open_fastq(fastq_path):
+    """
+    Function to open a plain or gzip/BGZF compressed FASTQ file for binary reading.
+
+    :param fastq_path: The path of the FASTQ file, given as a string.
+    :return: The opened file.
+    """
+    if fastq_path.endswith(('.gz', '.bgz')):
+        return gzip.open(fastq_path, 'rb')
+    return open(fastq_path, 'rb')
+
+
+def get_index_path(fastq_path):
+    """
+    Function to generate the path of the index belonging to a FASTQ file.
+
+    :param fastq_path: The path of the FASTQ file, given as a string.
+    :return: The path of the index file, given as a string.
+    """
+    return '%s%s' % (fastq_path, INDEX_EXTENSION)
+
+
+class FastqIndexBuilder(object):
+    """
+    Collects the offsets of every N-th record from blocks of raw FASTQ lines, as they are read by
+    the indexer or the block-level splitting engine.
+    """
+
+    def __init__(self, interval=DEFAULT_INTERVAL, start_offset=0):
+        """
+        :param interval: The sampling interval N, given as an int.
+        :param start_offset: The byte offset of the first record that will be added.
+        """
+        self.interval = interval
+        self.position = start_offset
+        self.record_count = 0
+        self.record_numbers = array('Q')
+        self.offsets = array('Q')
+
+    def add_lines(self, lines):
+        """
+        Method to add a block of complete FASTQ records, recording the offsets of the sampled
+        records among them.
+
+        :param lines: The raw lines of a whole number of records, without their newline
+        characters, given as a list of bytes.
+        """
+        block_records = len(lines) // 4
+        record = -self.record_count % self.interval
+        line, position = 0, self.position
+        while record < block_records:
+            position += sum(map(len, lines[line:record * 4])) + record * 4 - line
+            line = record * 4
+            self.record_numbers.append(self.record_count + record)
+            self.offsets.append(position)
+            record += self.interval
+        self.position += sum(map(len, lines)) + len(lines)
+        self.record_count += block_records
+
+    def get_index(self, file_size):
+        """
+        Function to return the index collected so far.
+
+        :param file_size: The size of the indexed data in bytes, given as an int.
+        :return: The collected FastqIndex.
+        """
+        return FastqIndex(self.interval, self.record_count, file_size, self.record_numbers,
+                          self.offsets)
+
+
+class FastqIndex(object):
+    """
+    An index of the record numbers and byte offsets of every N-th record of a FASTQ file.
+    """
+
+    def __init__(self, interval, record_count, file_size, record_numbers, offsets):
+        """
+        :param interval: The sampling interval N, given as an int.
+        :param record_count: The total number of records in the file, given as an int.
+        :param file_size: The size of the indexed data in bytes, given as an int.
+        :param record_numbers: The numbers of the indexed records, given as an array('Q').
+        :param offsets: The byte offsets of the indexed records, given as an array('Q').
+        """
+        assert len(record_numbers) == len(offsets), 'Index arrays must be of equal length.'
+        self.interval = interval
+        self.record_count = record_count
+        self.file_size = file_size
+        self.record_numbers = record_numbers
+        self.offsets = offsets
+
+    @staticmethod
+    def merge(indices):
+        """
+        Function to join the indices of consecutive byte ranges of one file, each built with its
+        record numbers counted from zero, into the index of the whole file.
+
+        :param indices: The indices of the byte ranges, given as a list in file order.
+        :return: The FastqIndex of the whole file.
+        """
+        record_numbers, offsets, record_count = array('Q'), array('Q'), 0
+        for index in indices:
+            record_numbers.extend(number + record_count for number in index.record_numbers)
+            offsets.extend(index.offsets)
+            record_count += index.record_count
+        return FastqIndex(indices[0].interval, record_count, indices[-1].file_size,
+                          record_numbers, offsets)
+
+    def save(self, index_path):
+        """
+        Method to write the index to disk, as a fixed header followed by both arrays.
+
+        :param index_path: The path of the index file, given as a string.
+        """
+        record_numbers, offsets = array('Q', self.record_numbers), array('Q', self.offsets)
+        if sys.byteorder != 'little':
+            record_numbers.byteswap()
+            offsets.byteswap()
+        temporary_path = '%s.tmp' % index_path
+        with open(temporary_path, 'wb') as index_file:
+            index_file.write(struct.pack(INDEX_HEADER, INDEX_MAGIC, self.interval,
+                                         self.record_count, self.file_size, len(offsets)))
+            record_numbers.tofile(index_file)
+            offsets.tofile(index_file)
+        os.rename(temporary_path, index_path)
+
+    @staticmethod
+    def load(index_path):
+        """
+        Function to read an index from disk.
+
+        :param index_path: The path of the index file, given as a string.
+        :return: The loaded FastqIndex.
+        """
+        with open(index_path, 'rb') as index_file:
+            header = index_file.read(struct.calcsize(INDEX_HEADER))
+            magic, interval, record_count, file_size, entries = struct.unpack(INDEX_HEADER,
+                                                                              header)
+            assert magic == INDEX_MAGIC, '%s is not a FASTQ index.' % index_path
+            record_numbers, offsets = array('Q'), array('Q')
+            record_numbers.fromfile(index_file, entries)
+            offsets.fromfile(index_file, entries)
+        if sys.byteorder != 'little':
+            record_numbers.byteswap()
+            offsets.byteswap()
+        return FastqIndex(interval, record_count, file_size, record_numbers, offsets)
+
+    def seek_record(self, fastq_file, record_number):
+        """
+        Function to move an open FASTQ file to the start of a given record.
+
+        :param fastq_file: The open FASTQ file, opened in binary mode.
+        :param record_number: The number of the record, counted from zero.
+        :return: The byte offset of the record.
+        """
+        assert 0 <= record_number < self.record_count, 'Record %s not in index.' % record_number
+        entry = bisect.bisect_right(self.record_numbers, record_number) - 1
+        fastq_file.seek(self.offsets[entry])
+        for _ in range((record_number - self.record_numbers[entry]) * 4):
+            fastq_file.readline()
+        return fastq_file.tell()
+
+    def seek_offset(self, fastq_file, byte_offset):
+        """
+        Function to move an open FASTQ file to the first record starting at or after a given byte
+        offset.
+
+        :param fastq_file: The open FASTQ file, opened in binary mode.
+        :param byte_offset: The byte offset to search from, given as an int.
+        :return: The number and byte offset of the record, or the record count and file size if
+        no record starts after the offset.
+        """
+        entry = bisect.bisect_right(self.offsets, byte_offset) - 1
+        if entry < 0:
+            fastq_file.seek(0)
+            return 0, 0
+        record_number, position = self.record_numbers[entry], self.offsets[entry]
+        fastq_file.seek(position)
+        while position < byte_offset and record_number < self.record_count:
+            for _ in range(4):
+                position += len(fastq_file.readline())
+            record_number += 1
+        if record_number == self.record_count:
+            position = self.file_size
+        fastq_file.seek(position)
+        return record_number, position
+
+    def get_chunk_boundaries(self, chunk_count):
+        """
+        Function to divide the indexed file into byte ranges holding roughly equal numbers of
+        records, using only indexed record offsets.
+
+        :param chunk_count: The number of byte ranges to divide the file into, given as an int.
+        :return: A list of (start, end) byte offsets, given in file order.
+        """
+        starts = set([0])
+        for chunk in range(1, chunk_count):
+            entry = bisect.bisect_left(self.record_numbers,
+                                       self.record_count * chunk // chunk_count)
+            if entry < len(self.offsets):
+                starts.add(self.offsets[entry])
+        boundaries = sorted(starts) + [self.file_size]
+        return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def build_fastq_index(fastq_path, interval=DEFAULT_INTERVAL):
+    """
+    Function to build the index of a FASTQ file in a single pass over the file.
+
+    :param fastq_path: The path of the FASTQ file, given as a string.
+    :param interval: The sampling interval N, given as an int.
+    :return: The built FastqIndex.
+    """
+    builder = FastqIndexBuilder(interval)
+    remainder, file_size = b'', 0
+    with open_fastq(fastq_path) as fastq_file:
+        while True:
+            block = fastq_file.read(BLOCK_SIZE)
+            if not block:
+                break
+            file_size += len(block)
+            lines = (remainder + block).split(b'\n')
+            usable = (len(lines) - 1) // 4 * 4
+            remainder = b'\n'.join(lines[usable:])
+            builder.add_lines(lines[0:usable])
+    lines = [line for line in remainder.split(b'\n') if line.strip()]
+    assert len(lines) % 4 == 0, 'Truncated FASTQ record at the end of %s.' % fastq_path
+    builder.add_lines(lines)
+    return builder.get_index(file_size)
+
+
+def load_fastq_index(fastq_path):
+    """
+    Function to load the index of a FASTQ file, if one exists and still matches the file size.
+
+    :param fastq_path: The path of the FASTQ file, given as a string.
+    :return: The FastqIndex, or None if there is no valid index.
+    """
+    index_path = get_index_path(fastq_path)
+    if not os.path.exists(index_path):
+        return None
+    index = FastqIndex.load(index_path)
+    if not fastq_path.endswith(('.gz', '.bgz')) and index.file_size != os.path.getsize(fastq_path):
+        return None
+    return index
+
+
+def main():
+    """
+    Method designed to build and save the index of a FASTQ file.
+    """
+    fastq_path, interval = get_command_line_arguments(['', DEFAULT_INTERVAL])
+    assert os.path.exists(fastq_path), 'FASTQ file path "%s" not found.' % fastq_path
+    index = build_fastq_index(fastq_path, int(interval))
+    index.save(get_index_path(fastq_path))
+    print('Indexed %s records of %s.' % (index.record_count, fastq_path))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A script designed to manage hisat2 genome indexes in a shared cache folder, so that an index is
+built once per genome rather than once per working directory or run.
+    -Inputs:    [1] Directory of the genome FASTA file.
+                [2] Directory of the index cache folder.
+                [3] Number of threads hisat2-build may use, default 4.
+                [4] Overwrite: True/False - rebuild an index already present in the cache.
+    -Outputs:   [1] The index files, saved as <cache_folder>/<genome>_<hash>/<genome>.*.ht2, and
+                printed base string of the index.
+
+Every index is stored in a folder named after the genome and a hash of its full content, so a
+changed genome is indexed anew while the same genome, wherever it is read from, shares one index.
+An index is built in a temporary folder that is renamed into place once hisat2-build succeeded,
+and builds of the same genome are serialised with a lock file, so concurrent samples and runs
+never build the same index twice and never see a partial index. The aligners open the index
+memory-mapped (hisat2 --mm), so concurrent alignments share a single resident copy of it.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import hashlib
+import shutil
+import fcntl
+import sys
+import os
+import re
+
+import StageResult
+import Mapping
+
+
+INDEX_FILE_COUNT = 8
+HASH_BLOCK_SIZE = 1 << 20
+HASH_LENGTH = 16
+FASTA_EXTENSION = r'\.(fa|fasta|fna)(\.gz)?$'
+
+
+def get_command_line_arguments(default_variable_values):
+    """
+    Function to get a variable number of input arguments from the command line, but use default
+    values if none were given.
+
+    :param default_variable_values: A list of default values given in order of their appearance in
+    the command line.
+    :return: A list of input variables.
+    """
+    assert isinstance(default_variable_values, list), \
+        'The given default input variables values must be a list.'
+    input_variables = [0]*len(default_variable_values)
+    for index, default_value in enumerate(default_variable_values):
+        try:
+            input_variables[index] = sys.argv[index + 1]
+        except IndexError:
+            if default_value != '':
+                input_variables[index] = default_value
+            else:
+                exit('Not enough command line input arguments. Critical Input Missing.')
+    return input_variables
+
+
+def hash_genome(genome_path):
+    """
+    Function to hash the full content of a genome file.
+
+    :param genome_path: Directory of the genome FASTA file.
+    :return: The hexadecimal SHA-1 hash of the file, given as a string.
+    """
+    digest = hashlib.sha1()
+    with open(genome_path, 'rb') as genome_file:
+        block = genome_file.read(HASH_BLOCK_SIZE)
+        while block:
+            digest.update(block)
+            block = genome_file.read(HASH_BLOCK_SIZE)
+    return digest.hexdigest()
+
+
+def get_genome_name(genome_path):
+    """
+    Function to get the name of a genome from its file name, without its FASTA extension.
+
+    :param genome_path: Directory of the genome FASTA file.
+    :return: The name of the genome, given as a string.
+    """
+    return re.sub(FASTA_EXTENSION, '', os.path.basename(genome_path))
+
+
+def get_index_base(genome_path, cache_folder, genome_hash=None):
+    """
+    Function to generate the base string of the cached index of a genome.
+
+    :param genome_path: Directory of the genome FASTA file.
+    :param cache_folder: Directory of the index cache folder.
+    :param genome_hash: The content hash of the genome, computed if not given.
+    :return: The base string <cache_folder>/<genome>_<hash>/<genome>, given as a string.
+    """
+    genome_name = get_genome_name(genome_path)
+    genome_hash = genome_hash or hash_genome(genome_path)
+    return '%s/%s_%s/%s' % (os.path.abspath(cache_folder), genome_name,
+                            genome_hash[:HASH_LENGTH], genome_name)
+
+
+def get_index_paths(index_base):
+    """
+    Function to list the files of a hisat2 index.
+
+    :param index_base: The base string of the index.
+    :return: The paths of the index files, given as a list of strings.
+    """
+    return ['%s.%s.ht2' % (index_base, number) for number in range(1, INDEX_FILE_COUNT + 1)]
+
+
+def is_index_complete(index_base):
+    """
+    Function to check whether all files of a hisat2 index are present.
+
+    :param index_base: The base string of the index.
+    :return: True if the index is complete, False otherwise.
+    """
+    return all(os.path.isfile(path) for path in get_index_paths(index_base))
+
+
+def build_index(genome_path, cache_folder, threads=4, overwrite=False, genome_hash=None):
+    """
+    Function to build the hisat2 index of a genome in the cache, unless it is already present.
+    Concurrent builds of the same genome wait on a lock file, and find the index built by the
+    first.
+
+    :param genome_path: Directory of the genome FASTA file.
+    :param cache_folder: Directory of the index cache folder.
+    :param threads: The number of threads hisat2-build may use, given as an int.
+    :param overwrite: [True/False] statement that determines whether the index is rebuilt or not.
+    :param genome_hash: The content hash of the genome, computed if not given.
+    :return: The StageResult of hisat2-build, listing the index files.
+    """
+    index_base = get_index_base(genome_path, cache_folder, genome_hash)
+    index_folder = os.path.dirname(index_base)
+    if not os.path.exists(cache_folder):
+        try:
+            os.makedirs(cache_folder)
+        except OSError:
+            if not os.path.isdir(cache_folder):
+                raise
+    with open('%s.lock' % index_folder, 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            if is_index_complete(index_base) and not overwrite:
+                print('Index %s already exists. Not rebuilt.' % index_base)
+                return StageResult.skip_stage('hisat2-build', get_index_paths(index_base))
+            building_folder = '%s.building.%s' % (index_folder, os.getpid())
+            if os.path.exists(building_folder):
+                shutil.rmtree(building_folder)
+            os.makedirs(building_folder)
+            try:
+                result = Mapping.hisat2_builder(
+                    genome_path, '%s/%s' % (building_folder, os.path.basename(index_base)),
+                    threads, True)
+            except BaseException:
+                shutil.rmtree(building_folder)
+                raise
+            if os.path.exists(index_folder):
+                shutil.rmtree(index_folder)
+            os.rename(building_folder, index_folder)
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+    result.output_paths = get_index_paths(index_base)
+    print('Index saved to %s' % index_base)
+    return result
+
+
+def main():
+    """
+    Method designed to build the hisat2 index of a genome in the index cache.
+    """
+    genome_path, cache_folder, threads, overwrite = \
+        get_command_line_arguments(['', '', 4, False])
+    assert os.path.exists(genome_path), 'Genome path "%s" not found.' % genome_path
+    genome_hash = hash_genome(genome_path)
+    build_index(genome_path, cache_folder, int(threads), str(overwrite) == 'True', genome_hash)
+    print(get_index_base(genome_path, cache_folder, genome_hash))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,214 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A script designed to collect the metrics of hisat2 alignments into a structured time series, so
+that throughput regressions and slow nodes can be spotted across samples and runs.
+    -Inputs:    [1-N] Base strings of hisat2 runs, <base>.met.txt and <base>.hisat2.log being the
+                periodic metrics (--met-file) and the standard error output of hisat2.
+    -Outputs:   [1] Per run, a JSON summary saved as <base>.hisat2.json.
+                [2] A table comparing the runs, printed to the command line.
+
+The periodic metrics rows count the reads processed in every interval; the final row hisat2 writes
+on exit counts the whole run and is used as the total. The standard error output holds the timed
+phases (-t) and the alignment summary, from which the alignment rates are taken.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import socket
+import json
+import sys
+import os
+import re
+
+
+METRICS_INTERVAL = 120
+PHASE_PATTERN = re.compile(r'^(.+?): (\d+):(\d\d):(\d\d)$')
+SUMMARY_PATTERNS = [
+    ('reads', re.compile(r'^(\d+) reads; of these:$')),
+    ('paired', re.compile(r'^(\d+) \([\d.]+%\) were paired; of these:$')),
+    ('concordant_none', re.compile(r'^(\d+) \([\d.]+%\) aligned concordantly 0 times$')),
+    ('concordant_unique', re.compile(r'^(\d+) \([\d.]+%\) aligned concordantly exactly 1 time$')),
+    ('concordant_multiple', re.compile(r'^(\d+) \([\d.]+%\) aligned concordantly >1 times$')),
+    ('discordant', re.compile(r'^(\d+) \([\d.]+%\) aligned discordantly 1 time$')),
+    ('overall_alignment_rate', re.compile(r'^([\d.]+)% overall alignment rate$'))]
+
+
+def get_metrics_path(metrics_base):
+    """
+    Function to generate the path of the periodic hisat2 metrics of a run.
+
+    :param metrics_base: The base string of the run, given as a string.
+    :return: The path <base>.met.txt, given as a string.
+    """
+    return '%s.met.txt' % metrics_base
+
+
+def get_log_path(metrics_base):
+    """
+    Function to generate the path of the standard error output of a hisat2 run.
+
+    :param metrics_base: The base string of the run, given as a string.
+    :return: The path <base>.hisat2.log, given as a string.
+    """
+    return '%s.hisat2.log' % metrics_base
+
+
+def get_summary_path(metrics_base):
+    """
+    Function to generate the path of the JSON summary of a hisat2 run.
+
+    :param metrics_base: The base string of the run, given as a string.
+    :return: The path <base>.hisat2.json, given as a string.
+    """
+    return '%s.hisat2.json' % metrics_base
+
+
+def read_metrics_rows(metrics_path):
+    """
+    Function to read the rows of a hisat2 metrics file as dictionaries of its numeric columns.
+
+    :param metrics_path: The path of the metrics file, given as a string.
+    :return: A list of dictionaries of column names and numbers, in the order of the file.
+    """
+    rows, header = [], None
+    with open(metrics_path) as metrics_file:
+        for line in metrics_file:
+            fields = line.rstrip('\n').split('\t')
+            if header is None or fields[0] == header[0]:
+                header = fields
+                continue
+            row = {}
+            for name, value in zip(header, fields):
+                try:
+                    row[name] = float(value)
+                except ValueError:
+                    pass
+            rows.append(row)
+    return rows
+
+
+def get_timeline(rows):
+    """
+    Function to turn the interval rows of a metrics file into a throughput time series. A final
+    row holding at least the reads of all intervals before it is taken as the run's total.
+
+    :param rows: The rows of the metrics file, as returned by read_metrics_rows.
+    :return: A list of dictionaries of the elapsed seconds, the reads of the interval, the reads
+    processed so far and the reads per second of the interval, and the total row or None.
+    """
+    rows = [row for row in rows if 'Time' in row and 'Read' in row]
+    total = None
+    if len(rows) > 1 and rows[-1]['Read'] >= sum(row['Read'] for row in rows[:-1]) > 0:
+        total = rows.pop()
+    timeline, processed = [], 0
+    for index, row in enumerate(rows):
+        previous_time = rows[index - 1]['Time'] if index else row['Time'] - METRICS_INTERVAL
+        seconds = max(row['Time'] - previous_time, 1.0)
+        processed += row['Read']
+        timeline.append({'elapsed_time': row['Time'] - rows[0]['Time'] + METRICS_INTERVAL,
+                         'reads': int(row['Read']), 'processed_reads': int(processed),
+                         'reads_per_second': round(row['Read'] / seconds, 1)})
+    return timeline, total
+
+
+def parse_log(log_path):
+    """
+    Function to parse the timed phases and the alignment summary of a hisat2 standard error file.
+
+    :param log_path: The path of the standard error output, given as a string.
+    :return: A dictionary of phase names and their seconds, and a dictionary of the summary.
+    """
+    phases, summary = {}, {}
+    with open(log_path) as log_file:
+        for line in log_file:
+            line = line.strip()
+            match = PHASE_PATTERN.match(line)
+            if match:
+                hours, minutes, seconds = [int(value) for value in match.groups()[1:]]
+                phases[match.group(1)] = hours * 3600 + minutes * 60 + seconds
+                continue
+            for name, pattern in SUMMARY_PATTERNS:
+                match = pattern.match(line)
+                if match and name not in summary:
+                    summary[name] = float(match.group(1)) if '.' in match.group(1) else \
+                        int(match.group(1))
+                    break
+    return phases, summary
+
+
+def summarise_run(metrics_base):
+    """
+    Function to summarise a hisat2 run from its metrics and standard error files, either of which
+    may be missing.
+
+    :param metrics_base: The base string of the run, given as a string.
+    :return: A JSON-compatible dictionary of the run's host, phases, alignment summary,
+    throughput and time series.
+    """
+    metrics_path, log_path = get_metrics_path(metrics_base), get_log_path(metrics_base)
+    timeline, total, phases, summary = [], None, {}, {}
+    if os.path.exists(metrics_path):
+        timeline, total = get_timeline(read_metrics_rows(metrics_path))
+    if os.path.exists(log_path):
+        phases, summary = parse_log(log_path)
+    reads = summary.get('reads') or (total or {}).get('Read') or \
+        sum(point['reads'] for point in timeline)
+    seconds = phases.get('Overall time') or phases.get('Time searching') or \
+        (timeline[-1]['elapsed_time'] if timeline else 0)
+    return {'run': os.path.basename(metrics_base), 'host': socket.gethostname(),
+            'reads': int(reads), 'seconds': seconds,
+            'reads_per_second': round(reads / float(seconds), 1) if seconds else None,
+            'phases': phases, 'summary': summary, 'timeline': timeline}
+
+
+def save_run_summary(metrics_base):
+    """
+    Function to summarise a hisat2 run and save the summary as <base>.hisat2.json.
+
+    :param metrics_base: The base string of the run, given as a string.
+    :return: The summary, given as a dictionary.
+    """
+    run_summary = summarise_run(metrics_base)
+    with open(get_summary_path(metrics_base), 'w') as summary_file:
+        json.dump(run_summary, summary_file, indent=2, sort_keys=True)
+    return run_summary
+
+
+def format_run_table(run_summaries):
+    """
+    Function to format a table comparing hisat2 runs, slowest throughput first.
+
+    :param run_summaries: The summaries of the runs, as returned by summarise_run.
+    :return: The table, given as a string.
+    """
+    lines = ['%-24s %-16s %12s %10s %12s %10s' % ('Run', 'Host', 'Reads', 'Seconds', 'Reads/s',
+                                                  'Aligned')]
+    for run in sorted(run_summaries, key=lambda run: run['reads_per_second'] or 0):
+        rate = run['summary'].get('overall_alignment_rate')
+        lines.append('%-24s %-16s %12s %10s %12s %10s' % (
+            run['run'], run['host'], run['reads'], run['seconds'], run['reads_per_second'],
+            '-' if rate is None else '%.2f%%' % rate))
+    return '\n'.join(lines)
+
+
+def main():
+    """
+    Method designed to summarise hisat2 runs and print a table comparing them.
+    """
+    assert len(sys.argv) > 1, 'Not enough command line input arguments. Critical Input Missing.'
+    run_summaries = [save_run_summary(re.sub(r'\.(met\.txt|hisat2\.log)$', '', metrics_base))
+                     for metrics_base in sys.argv[1:]]
+    print(format_run_table(run_summaries))
+
+
+if __name__ == '__main__':
+    main()
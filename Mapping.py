@@ -3,52 +3,43 @@
 """
 Author : Linh Nguyen
 WUR Number: 940830599020
+
+Single pair:  python Mapping.py <genome> <forward reads> <reverse reads> [threads] [index cache]
+Batch:        python Mapping.py batch <cmd file> <output folder> [jobs] [threads] [index cache]
 """
 
-import subprocess
+import collections
 import sys
 import os.path
 import re
 
-
-def execute_on_command_line(cmd_string):
-    """
-    Runs a command line
-    
-    Parameter
-    cmd_string: a command line string 
-    """
-    assert isinstance(cmd_string, str),\
-    'Command Line String must be of type string.'
-    subprocess.check_call(cmd_string, shell=True)
+import StageResult
+import HisatMetrics
+import HisatIndex
+import Scheduler
+import SamSort
 
 
-def create_index_base_string(genome_file_path):
-    """
-    Returns a base string for the hisat2 genome index.
-    
-    Parameter
-    genome_file_path: the path to the genome file
-    
-    The name of the genome file will be used as base string 
-    """
-    base_string = re.findall('(\w+\.\w+\.\w+)$', genome_file_path)[0]
-    base_string = base_string.split('.')
-    base_string = base_string[0] + "." + base_string[1]
-    return base_string
+READ_FILE_EXTENSION = r'\.(fastq|fq)(\.b?gz)?$'
+MATE_LABELS = (('1', '2'), ('r1', 'r2'), ('f', 'r'), ('fwd', 'rev'), ('forward', 'reverse'))
+READ_MATE_PATTERN = r'(.*)[_.](r?[12]|f|r|fwd|rev|forward|reverse)(_\d+)?$'
 
 
-def hisat2_builder(genome_file_path, base_string):
+def hisat2_builder(genome_file_path, base_string, threads=4, overwrite=False):
     """
-    Creates an index for the hisat2 aligner.
+    Creates an index for the hisat2 aligner and returns its StageResult.
     
     Parameter
     genome_file_path: the path to the genome file
     base_string: the base string for the output files   
+    threads: the number of threads hisat2-build may use
+    overwrite: whether to rebuild an existing index
     """
-    if not os.path.isfile(base_string + '.1.ht2'):
-        cmd_string = 'hisat2-build -p 4 %s %s' % (genome_file_path, base_string)
-        execute_on_command_line(cmd_string)
+    output_paths = [base_string + '.1.ht2']
+    if overwrite or not os.path.isfile(output_paths[0]):
+        cmd_string = 'hisat2-build -p %s %s %s' % (threads, genome_file_path, base_string)
+        return StageResult.run_command('hisat2-build', cmd_string, output_paths)
+    return StageResult.skip_stage('hisat2-build', output_paths)
 
 
 def create_sam_base_string(read_file_path):
@@ -56,30 +47,121 @@ def create_sam_base_string(read_file_path):
     Returns a sam base string for the hisat2 aligner.
     
     Parameter
-    read_file_path: the path to the read file
+    read_file_path: the path to the read file, plain or gzip compressed
     """
-    
-    sam_base_string = re.findall('(\w+\.\w+)$', read_file_path)[0]
+    if read_file_path.endswith('.gz'):
+        read_file_path = read_file_path[0:-3]
+    sam_base_string = re.findall(r'(\w+\.\w+)$', read_file_path)[0]
     str_list = sam_base_string.split('_')
     sam_base_string = '_'.join(str_list[0:-1]) + '.sam'
     return sam_base_string
 
 
-def hisat2_aligner(base_string, read1_path, read2_path, sam_base_string):
+def hisat2_aligner(base_string, read1_path, read2_path, sam_base_string, threads=4,
+                   overwrite=False):
     """
-    Creates an index for the hisat2 aligner.
+    Aligns a pair of read files with hisat2 and returns its StageResult.
+    The sam file is written under a temporary name and renamed once hisat2
+    succeeded, so an interrupted alignment never leaves a truncated sam file.
     
     Parameter
     base_string: the base string of the index files
-    read1_path: the path to the forward read file
-    read2_path: the path to the reverse read file
-    sam_base_string: the base string for the output sam file
+    read1_path: the path to the forward read file, plain or gzip compressed
+    read2_path: the path to the reverse read file, plain or gzip compressed
+    sam_base_string: the base string for the output sam file, may include a folder
+    threads: the number of threads hisat2 may use
+    overwrite: whether to replace an existing sam file
     """
-    if not os.path.isfile(sam_base_string):
-        cmd_string = 'hisat2 -p 4 -t --no-unal --dta-cufflinks --met-file met.txt --met 120 -x %s -1 %s -2 %s -S %s' % (
-            base_string, read1_path, read2_path, sam_base_string)
+    if overwrite or not os.path.isfile(sam_base_string):
+        partial_path = '%s.partial' % sam_base_string
+        cmd_string = create_hisat2_command(base_string, read1_path, read2_path, partial_path,
+                                           threads, get_metrics_base(sam_base_string))
         #--sra-accession SRR1271857
-        execute_on_command_line(cmd_string)
+        try:
+            result = StageResult.run_command('hisat2', cmd_string, [sam_base_string])
+        except StageResult.StageError:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        os.rename(partial_path, sam_base_string)
+        return result
+    return StageResult.skip_stage('hisat2', [sam_base_string])
+
+
+def get_metrics_base(output_path):
+    """
+    Returns the base string of the metrics and log files of a hisat2 run,
+    the output path without its .sam or .sorted.bam extension.
+
+    Parameter
+    output_path: the path to the sam or sorted bam file of the run
+    """
+    return re.sub(r'(\.sorted\.bam|\.sam)$', '', output_path)
+
+
+def create_hisat2_command(base_string, read1_path, read2_path, sam_base_string, threads=4,
+                          metrics_base=None):
+    """
+    Returns the hisat2 command line string aligning a pair of read files.
+    The periodic metrics are written to <metrics_base>.met.txt and the timing
+    and alignment summary on stderr to <metrics_base>.hisat2.log.
+
+    Parameter
+    base_string: the base string of the index files
+    read1_path: the path to the forward read file, or a named pipe
+    read2_path: the path to the reverse read file, or a named pipe
+    sam_base_string: the base string for the output sam file, or None to write to stdout
+    threads: the number of threads hisat2 may use
+    metrics_base: the base string of the metrics files, by default taken from the sam file
+    """
+    metrics_base = metrics_base or get_metrics_base(sam_base_string or 'hisat2')
+    cmd_string = 'hisat2 -p %s -t --no-unal --dta-cufflinks --met-file %s --met %s -x %s -1 %s -2 %s' % (
+        threads, HisatMetrics.get_metrics_path(metrics_base), HisatMetrics.METRICS_INTERVAL,
+        base_string, read1_path, read2_path)
+    # Memory-mapping the index lets concurrent hisat2 processes share one resident copy of it.
+    cmd_string += ' --mm'
+    if sam_base_string is not None:
+        cmd_string += ' -S %s' % sam_base_string
+    return cmd_string + ' 2> %s' % HisatMetrics.get_log_path(metrics_base)
+
+
+def hisat2_sort_aligner(base_string, read1_path, read2_path, sorted_bam_path, threads=4,
+                        sort_threads=1, overwrite=False,
+                        sort_memory=SamSort.SORT_MEMORY_PER_THREAD, temporary_folder=None,
+                        filter_command=None):
+    """
+    Aligns a pair of read files with hisat2 and pipes the alignments straight into samtools sort,
+    so that only the sorted bam file is written. The bam file is written under a temporary name
+    and renamed when both tools succeeded; on failure no partial output is left behind.
+    Returns the StageResult of the fused stage.
+
+    Parameter
+    base_string: the base string of the index files
+    read1_path: the path to the forward read file, plain or gzip compressed
+    read2_path: the path to the reverse read file, plain or gzip compressed
+    sorted_bam_path: the path of the sorted bam file to write
+    threads: the number of threads hisat2 may use
+    sort_threads: the number of threads samtools sort may use
+    overwrite: whether to replace an existing sorted bam file
+    sort_memory: the megabytes of memory each sort thread may use before spilling
+    temporary_folder: the folder receiving the sort's spill files, by default the system's
+    filter_command: a command filtering the SAM stream between hisat2 and samtools sort, or None
+    """
+    if not overwrite and os.path.isfile(sorted_bam_path):
+        return StageResult.skip_stage('hisat2 | samtools sort', [sorted_bam_path])
+    partial_path = '%s.partial' % sorted_bam_path
+    align_string = create_hisat2_command(base_string, read1_path, read2_path, None, threads,
+                                         get_metrics_base(sorted_bam_path))
+    sort_string = SamSort.create_sort_command('-', partial_path, sort_threads, sort_memory,
+                                              temporary_folder)
+    cmd_strings = [align_string] + ([filter_command] if filter_command else []) + [sort_string]
+    try:
+        result = StageResult.run_pipe('hisat2 | samtools sort', cmd_strings, [sorted_bam_path])
+    except StageResult.StageError:
+        SamSort.remove_partial_sort(partial_path, temporary_folder)
+        raise
+    os.rename(partial_path, sorted_bam_path)
+    return result
 
 
 def parse_cmd_lines(cmd_file):
@@ -89,7 +171,7 @@ def parse_cmd_lines(cmd_file):
     
     Parameter:
     cmd_file: a file containing the path to the genome file, forward read file,
-    and reverse file
+    and reverse file; blank lines and lines starting with # are ignored
     """    
     
     input_file = open(cmd_file)
@@ -97,29 +179,123 @@ def parse_cmd_lines(cmd_file):
     genome_path = False
 
     for line in input_file:
+        if not line.strip() or line.startswith('#'):
+            continue
         if genome_path == False:
             genome_path = line.strip('\n')
         else:
-            assert len(line.split()) == 2
+            assert len(line.split()) == 2, 'Expected two read files on line: %s' % line
             read1_path, read2_path = line.split()
             yield genome_path, read1_path, read2_path
+    input_file.close()
 
 
-if __name__ == '__main__':
-    genome_path, read1_path, read2_path = sys.argv[1], sys.argv[2], sys.argv[3]
-    base_string = create_index_base_string(genome_path) 
-    hisat2_builder(genome_path, base_string)
-    sam_base_string = create_sam_base_string(read1_path)
-
-    hisat2_aligner(base_string, read1_path, read2_path, sam_base_string)
-
+def split_read_file_name(read_file_path):
+    """
+    Returns the sample name and the mate label of a read file, taken from
+    its file name <sample>_<mate>.fastq or <sample>_<mate>_<chunk>.fastq,
+    plain or gzip compressed, such as the Illumina S1_L001_R1_001.fastq.gz.
+    The chunk number is kept in the sample name. Raises a ValueError when
+    the file name holds no mate label.
 
+    Parameter
+    read_file_path: the path to the read file
+    """
+    file_name = re.sub(READ_FILE_EXTENSION, '', os.path.basename(read_file_path))
+    match = re.match(READ_MATE_PATTERN, file_name, re.IGNORECASE)
+    if match is None or not match.group(1):
+        raise ValueError('Read file %s is not named <sample>_<mate>.' % read_file_path)
+    sample_name, mate, chunk = match.groups()
+    return sample_name + (chunk or ''), mate
 
 
+def get_read_pair_sample(read1_path, read2_path):
+    """
+    Returns the sample name shared by a pair of read files and the paths of
+    the forward and reverse read files, swapped into order if the reverse
+    file was given first. Raises a ValueError when the files belong to
+    different samples or their mate labels, such as 1 and 2 or R1 and R2,
+    do not make a pair.
 
+    Parameter
+    read1_path: the path to the forward read file
+    read2_path: the path to the reverse read file
+    """
+    sample1, mate1 = split_read_file_name(read1_path)
+    sample2, mate2 = split_read_file_name(read2_path)
+    if sample1 != sample2:
+        raise ValueError('Read files %s and %s belong to different samples.' % (
+            read1_path, read2_path))
+    mates = (mate1.lower(), mate2.lower())
+    if mates[::-1] in MATE_LABELS:
+        return sample1, read2_path, read1_path
+    if mates not in MATE_LABELS:
+        raise ValueError('Read files %s and %s are not a forward and reverse mate.' % (
+            read1_path, read2_path))
+    return sample1, read1_path, read2_path
 
 
+def batch_align(cmd_file, output_folder, index_cache, jobs=1, threads=4, overwrite=False):
+    """
+    Aligns every pair of read files listed in a cmd file, building or
+    looking up the genome index once. Pairs are aligned concurrently, at most
+    jobs at a time. Returns a dictionary of sample names and StageResults.
 
+    Parameter
+    cmd_file: a file with the genome path on its first line and a forward
+    and reverse read file on every following line, see parse_cmd_lines
+    output_folder: the folder receiving the <sample>.sam files
+    index_cache: the folder holding the cached genome indexes
+    jobs: the number of pairs aligned at the same time
+    threads: the number of threads hisat2 may use per pair
+    overwrite: whether to replace existing sam files
+    """
+    pairs = collections.OrderedDict()
+    genome_paths = set()
+    for genome_path, read1_path, read2_path in parse_cmd_lines(cmd_file):
+        sample_name, read1_path, read2_path = get_read_pair_sample(read1_path, read2_path)
+        assert sample_name not in pairs, 'Sample %s is listed twice.' % sample_name
+        pairs[sample_name] = (read1_path, read2_path)
+        genome_paths.add(genome_path)
+    assert len(genome_paths) == 1, 'The cmd file %s lists no read pairs.' % cmd_file
+    genome_path = genome_paths.pop()
+    if not os.path.exists(output_folder):
+        os.makedirs(output_folder)
+    genome_hash = HisatIndex.hash_genome(genome_path)
+    index_base = HisatIndex.get_index_base(genome_path, index_cache, genome_hash)
+    graph = Scheduler.TaskGraph()
+    index_task = graph.add_task('hisat2-build', HisatIndex.build_index,
+                                (genome_path, index_cache, jobs * threads, False, genome_hash))
+    for sample_name, (read1_path, read2_path) in pairs.items():
+        graph.add_task(sample_name, hisat2_aligner,
+                       (index_base, read1_path, read2_path,
+                        '%s/%s.sam' % (output_folder, sample_name), threads, overwrite),
+                       [index_task])
+    results = graph.run(jobs)
+    return collections.OrderedDict((name, results[name]) for name in pairs)
 
 
+if __name__ == '__main__':
+    if sys.argv[1] == 'batch':
+        cmd_file, output_folder = sys.argv[2], sys.argv[3]
+        jobs = int(sys.argv[4]) if len(sys.argv) > 4 else 1
+        threads = int(sys.argv[5]) if len(sys.argv) > 5 else 4
+        index_cache = sys.argv[6] if len(sys.argv) > 6 else '%s/Hisat2_Index' % output_folder
+        for sample_name, result in batch_align(cmd_file, output_folder, index_cache, jobs,
+                                               threads).items():
+            print('%s: %r' % (sample_name, result))
+        sys.exit(0)
+    genome_path, read1_path, read2_path = sys.argv[1], sys.argv[2], sys.argv[3]
+    try:
+        sample_name, read1_path, read2_path = get_read_pair_sample(read1_path, read2_path)
+    except ValueError as error:
+        print('Warning: %s Aligning the reads in the given order.' % error)
+    threads = int(sys.argv[4]) if len(sys.argv) > 4 else 4
+    index_cache = sys.argv[5] if len(sys.argv) > 5 else \
+        '%s/Hisat2_Index' % os.path.dirname(os.path.abspath(genome_path))
+    genome_hash = HisatIndex.hash_genome(genome_path)
+    base_string = HisatIndex.get_index_base(genome_path, index_cache, genome_hash)
+    HisatIndex.build_index(genome_path, index_cache, threads, False, genome_hash)
+    sam_base_string = create_sam_base_string(read1_path)
 
+    hisat2_aligner(base_string, read1_path, read2_path, sam_base_string, threads)
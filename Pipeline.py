@@ -16,12 +16,56 @@ and function names, as well as more extensive doc-strings.
 """
 
 
+import multiprocessing
+import collections
 import subprocess
-import datetime
+import traceback
+import tempfile
+import shutil
+import signal
+import time
 import sys
 import os
 import re
 
+import ReadStatistics
+import FastqIndex
+import StageResult
+import StageTrace
+import StageCache
+import RunJournal
+import HisatMetrics
+import HisatIndex
+import Scheduler
+import CuffMerge
+import CuffQuant
+import CuffDiff
+import CuffLinks
+import CuffLinksShards
+import CuffNorm
+import SamFilter
+import Splitter
+import Mapping
+import SamSort
+
+
+FASTQ_EXTENSIONS = ('.fastq', '.fastq.gz', '.fastq.bgz')
+GENOME_FILE = 'cro_scaffolds.min_200bp.fasta'
+ANNOTATION_FILE = 'cro_std_maker_anno.final.gff3'
+STREAM_POLL_INTERVAL = 0.5
+STATISTICS_SUFFIX = '_read_statistics.json'
+MAPPING_PAIRS_PER_THREAD_SECOND = 20000.0
+RUN_PROFILES = ('full', 'quick')
+QUICK_OUTPUT_SUFFIX = '_Quick'
+INDEX_FOLDER = 'Hisat2_Index'
+SORTERS = ('auto', 'samtools', 'python')
+# Child processes are started from the scheduler's worker threads, so they must not be forked
+# from the threaded pipeline itself: a fork copies locks held by other threads, which the child
+# may then wait on forever. A fork server, or a fresh interpreter, starts them from a clean state.
+PROCESS_CONTEXT = multiprocessing.get_context(
+    'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn')
+SCHEDULING_OPTIONS = ('max_jobs', 'cores', 'memory', 'force', 'resume')
+
 
 def execute_on_command_line(cmd_string):
     """
@@ -45,10 +89,11 @@ def get_command_line_arguments(default_variable_values):
     """
     assert isinstance(default_variable_values, list), \
         'The given default input variables values must be a list.'
+    arguments = [argument for argument in sys.argv[1:] if not argument.startswith('--')]
     input_variables = ['']*len(default_variable_values)
     for index, default_value in enumerate(default_variable_values):
         try:
-            input_variables[index] = sys.argv[index + 1]
+            input_variables[index] = arguments[index]
         except IndexError:
             if default_value != '':
                 input_variables[index] = default_value
@@ -57,6 +102,29 @@ def get_command_line_arguments(default_variable_values):
     return input_variables
 
 
+def get_command_line_options(default_options):
+    """
+    Function to get optional '--name=value' arguments from the command line, but use default
+    values for options that were not given. A flag given without a value is set to True.
+
+    :param default_options: A dictionary of option names and their default values.
+    :return: A dictionary of option names and values, converted to the type of their default.
+    """
+    assert isinstance(default_options, dict), 'The given default options must be a dictionary.'
+    options = dict(default_options)
+    for argument in sys.argv[1:]:
+        if argument.startswith('--'):
+            name, _, value = argument[2:].partition('=')
+            name = name.replace('-', '_')
+            if name not in options:
+                exit('Unknown command line option "%s".' % argument)
+            if isinstance(default_options[name], bool):
+                options[name] = value in ('', 'True', 'true', '1')
+            elif value:
+                options[name] = type(default_options[name])(value)
+    return options
+
+
 def make_directory(path):
     """
 
@@ -73,6 +141,19 @@ def make_directory(path):
         return 1
 
 
+def strip_fastq_extension(file_name):
+    """
+    Function to remove the FASTQ extension, plain or compressed, from a file name.
+
+    :param file_name: The name of the FASTQ file, given as a string.
+    :return: The file name without its FASTQ extension, given as a string.
+    """
+    for extension in FASTQ_EXTENSIONS:
+        if file_name.endswith(extension):
+            return file_name[0:-len(extension)]
+    return file_name
+
+
 def get_file_of_extension(directory, extension):
     """
 
@@ -87,17 +168,88 @@ def get_file_of_extension(directory, extension):
     return found_files
 
 
-def run_splitter(rna_seq_folder, split_folder):
+def send_result(sender, function, arguments):
+    """
+    Method run in a child process, calling a function and sending its result, or the traceback of
+    its failure, back to the parent.
+
+    :param sender: The sending end of a multiprocessing.Pipe.
+    :param function: The function to call.
+    :param arguments: The arguments of the function, given as a tuple.
+    """
+    try:
+        value = function(*arguments)
+        sender.send((True, value, StageTrace.get_process_usage()))
+    except BaseException:
+        sender.send((False, traceback.format_exc(), StageTrace.get_process_usage()))
+    sender.close()
+
+
+def call_in_process(function, arguments):
+    """
+    Function to call a function in a separate process and return its result, so that stages
+    running Python code, rather than external tools, do not hold up one another.
+
+    :param function: The function to call.
+    :param arguments: The arguments of the function, given as a tuple.
+    :return: The value returned by the function.
+    """
+    receiver, sender = PROCESS_CONTEXT.Pipe(False)
+    process = PROCESS_CONTEXT.Process(target=send_result, args=(sender, function, arguments))
+    start_time = time.time()
+    process.start()
+    sender.close()
+    try:
+        succeeded, value, usage = receiver.recv()
+    except EOFError:
+        succeeded, value, usage = False, 'Process exited without a result.', None
+    process.join()
+    StageTrace.recorder.record_command(function.__name__, 'process %s' % process.pid, start_time,
+                                       time.time(), usage, process.exitcode)
+    if isinstance(value, StageResult.StageResult) and not value.usage:
+        value.usage = usage
+    if not succeeded:
+        raise RuntimeError('%s failed in process %s:\n%s' % (function.__name__, process.pid,
+                                                             value))
+    return value
+
+
+def run_splitter(rna_seq_folder, split_folder, workers=1, compress_output=False,
+                 collect_statistics=False, subsample=None, seed=0):
     """
 
     :param rna_seq_folder:
     :param split_folder:
+    :param workers: The number of processes splitting each FASTQ file in parallel.
+    :param compress_output: Whether to write BGZF compressed forward and reverse files.
+    :param collect_statistics: Whether to save a read statistics sidecar per sample.
+    :param subsample: If given, the fraction (below one) or number of read pairs to split.
+    :param seed: The seed of the subsample.
     """
     for folder_file in os.listdir(rna_seq_folder):
-        if folder_file.endswith('.fastq'):
+        if folder_file.endswith(FASTQ_EXTENSIONS):
             file_directory = '%s/%s' % (rna_seq_folder, folder_file)
-            cmd = 'python Splitter.py %s %s' % (file_directory, split_folder)
-            execute_on_command_line(cmd)
+            split_sample(file_directory, split_folder, compress_output, collect_statistics,
+                         subsample, seed, workers)
+
+
+def split_sample(fastq_path, split_folder, compress_output=False, collect_statistics=False,
+                 subsample=None, seed=0, threads=1):
+    """
+    Method to split the merged FASTQ file of a single sample.
+
+    :param fastq_path: Path leading to the merged, paired-end FASTQ file.
+    :param split_folder: Path leading to the folder receiving the split FASTQ files.
+    :param compress_output: Whether to write BGZF compressed forward and reverse files.
+    :param collect_statistics: Whether to save a read statistics sidecar.
+    :param subsample: If given, the fraction (below one) or number of read pairs to split.
+    :param seed: The seed of the subsample.
+    :param threads: The number of processes splitting the FASTQ file in parallel.
+    :return: The StageResult of the split.
+    """
+    return call_in_process(Splitter.split_merged_data_set,
+                           (fastq_path, split_folder, True, 'block', threads, compress_output,
+                            False, collect_statistics, subsample, seed))
 
 
 def run_his_hat_2(split_data_folder, genome_folder, his_hat_output):
@@ -107,15 +259,336 @@ def run_his_hat_2(split_data_folder, genome_folder, his_hat_output):
     :param genome_folder:
     :param his_hat_output:
     """
-    genome_path = '%s/cro_scaffolds.min_200bp.fasta' % genome_folder
-    forward_reads = sorted(get_file_of_extension(split_data_folder, '_forward.fastq'))
-    reverse_reads = sorted(get_file_of_extension(split_data_folder, '_reverse.fastq'))
-    for forward, reverse in zip(forward_reads, reverse_reads):
-        print('running on %s and %s' % (forward, reverse))
-        print(datetime.datetime.now())
-        cmd = 'python Mapping.py %s %s %s' % (genome_path, forward, reverse)
-        execute_on_command_line(cmd)
-    execute_on_command_line('mv *.sam %s' % his_hat_output)
+    genome_path = '%s/%s' % (genome_folder, GENOME_FILE)
+    index_cache = '%s/%s' % (os.path.dirname(his_hat_output), INDEX_FOLDER)
+    genome_hash = HisatIndex.hash_genome(genome_path)
+    index_base = HisatIndex.get_index_base(genome_path, index_cache, genome_hash)
+    build_genome_index(genome_path, index_cache, genome_hash)
+    forward_reads = sorted(get_file_of_extension(split_data_folder, '_forward.fastq') +
+                           get_file_of_extension(split_data_folder, '_forward.fastq.gz'))
+    for forward in forward_reads:
+        sample_name = os.path.basename(forward).rsplit('_forward.', 1)[0]
+        map_sample(sample_name, split_data_folder, index_base, his_hat_output)
+
+
+def find_split_reads(split_folder, sample_name):
+    """
+    Function to find the forward and reverse FASTQ files of a sample, plain or compressed.
+
+    :param split_folder: Path leading to the split FASTQ files.
+    :param sample_name: The name of the sample, given as a string.
+    :return: The paths of the forward and reverse FASTQ files, given as a list of strings.
+    """
+    for extension in ['.fastq', '.fastq.gz']:
+        read_paths = ['%s/%s_%s%s' % (split_folder, sample_name, mate, extension)
+                      for mate in ['forward', 'reverse']]
+        if all(os.path.exists(read_path) for read_path in read_paths):
+            return read_paths
+    raise IOError('No split reads of sample %s found in %s.' % (sample_name, split_folder))
+
+
+def build_genome_index(genome_path, index_cache, genome_hash=None, threads=4):
+    """
+    Function to build the hisat2 index of a genome in the shared index cache, unless it is
+    already present there.
+
+    :param genome_path: Path leading to the genome FASTA file.
+    :param index_cache: Path leading to the folder holding the cached indexes.
+    :param genome_hash: The content hash of the genome, computed if not given.
+    :param threads: The number of threads hisat2-build may use.
+    :return: The StageResult of hisat2-build.
+    """
+    return HisatIndex.build_index(genome_path, index_cache, threads, False, genome_hash)
+
+
+def map_sample(sample_name, split_folder, index_base, his_hat_output, threads=4):
+    """
+    Function to align the split reads of a single sample with hisat2, saving the SAM file in the
+    hisat2 output folder.
+
+    :param sample_name: The name of the sample, given as a string.
+    :param split_folder: Path leading to the split FASTQ files.
+    :param index_base: The base string of the cached hisat2 index.
+    :param his_hat_output: Path leading to the folder receiving the SAM file.
+    :param threads: The number of threads hisat2 may use.
+    :return: The StageResult of hisat2.
+    """
+    forward, reverse = find_split_reads(split_folder, sample_name)
+    print('running on %s and %s' % (forward, reverse))
+    result = Mapping.hisat2_aligner(index_base, forward, reverse,
+                                    '%s/%s.sam' % (his_hat_output, sample_name), threads, True)
+    return summarise_alignment(result, '%s/%s' % (his_hat_output, sample_name))
+
+
+def map_sort_sample(sample_name, split_folder, index_base, his_hat_output,
+                    sort_memory=SamSort.SORT_MEMORY_PER_THREAD, temporary_folder=None,
+                    filter_rules=None, threads=5):
+    """
+    Function to align the split reads of a single sample with hisat2 and sort the alignments in
+    the same pass, saving only <sample>.sorted.bam in the hisat2 output folder. When filter rules
+    are given, the alignments are filtered between hisat2 and samtools sort, and a summary of the
+    dropped alignments is saved as <sample>.filter_summary.json.
+
+    :param sample_name: The name of the sample, given as a string.
+    :param split_folder: Path leading to the split FASTQ files.
+    :param index_base: The base string of the cached hisat2 index.
+    :param his_hat_output: Path leading to the folder receiving the sorted BAM file.
+    :param sort_memory: The megabytes of memory each sort thread may use before spilling.
+    :param temporary_folder: The folder receiving the sort's spill files.
+    :param filter_rules: The minimum mapping quality, primary-only and proper-pair rules of the
+    filter, given as a tuple, or None to not filter.
+    :param threads: The number of threads of hisat2 and samtools sort together; samtools sort
+    takes a quarter of them, and at least one.
+    :return: The StageResult of the fused alignment and sort.
+    """
+    forward, reverse = find_split_reads(split_folder, sample_name)
+    sort_threads = max(1, threads // 4)
+    filter_command = None
+    if filter_rules:
+        filter_command = SamFilter.create_filter_command(
+            '-', *filter_rules,
+            summary_path=SamFilter.get_summary_path('%s/%s.sam' % (his_hat_output, sample_name)))
+    print('running on %s and %s' % (forward, reverse))
+    result = Mapping.hisat2_sort_aligner(index_base, forward, reverse,
+                                         '%s/%s.sorted.bam' % (his_hat_output, sample_name),
+                                         max(1, threads - sort_threads), sort_threads, True,
+                                         sort_memory, temporary_folder, filter_command)
+    return summarise_alignment(result, '%s/%s' % (his_hat_output, sample_name))
+
+
+def summarise_alignment(result, metrics_base):
+    """
+    Function to save the metrics summary of a hisat2 run as <sample>.hisat2.json and report its
+    throughput.
+
+    :param result: The StageResult of the run, to which the summary is added as an output.
+    :param metrics_base: The base string of the run's metrics files, <folder>/<sample>.
+    :return: The StageResult of the run.
+    """
+    run_summary = HisatMetrics.save_run_summary(metrics_base)
+    print('Aligned %s reads of %s at %s reads per second, %s%% overall alignment rate.' % (
+        run_summary['reads'], run_summary['run'], run_summary['reads_per_second'],
+        run_summary['summary'].get('overall_alignment_rate', '-')))
+    result.output_paths.append(HisatMetrics.get_summary_path(metrics_base))
+    return result
+
+
+def get_read_counts(split_folder):
+    """
+    Function to collect the number of read pairs per sample from the read statistics sidecars
+    written by the splitter.
+
+    :param split_folder: Path leading to the split FASTQ files and their sidecars.
+    :return: A dictionary of sample names and read pair counts.
+    """
+    read_counts = {}
+    for statistics_path in get_file_of_extension(split_folder, STATISTICS_SUFFIX):
+        sample_name = os.path.basename(statistics_path)[0:-len(STATISTICS_SUFFIX)]
+        read_counts[sample_name] = \
+            ReadStatistics.load_read_statistics(statistics_path)['read_pairs']
+    return read_counts
+
+
+def plan_mapping_threads(read_counts, total_threads):
+    """
+    Function to divide a number of threads over samples in proportion to their read pairs, giving
+    every sample at least one thread. Every sample first gets one thread, the remaining threads
+    are divided by the floor of each sample's share and the threads left over go to the samples
+    with the largest fractional parts, so the plan sums to exactly the number of threads, unless
+    there are more samples than threads, in which case every sample gets one thread.
+
+    :param read_counts: A dictionary of sample names and read pair counts.
+    :param total_threads: The number of threads to divide, given as an int.
+    :return: A dictionary of sample names and thread counts.
+    """
+    if not sum(read_counts.values()):
+        read_counts = dict((sample_name, 1) for sample_name in read_counts)
+    total_reads = sum(read_counts.values())
+    spare_threads = max(total_threads - len(read_counts), 0)
+    shares = dict((sample_name, spare_threads * float(count) / total_reads)
+                  for sample_name, count in read_counts.items())
+    thread_plan = dict((sample_name, 1 + int(share)) for sample_name, share in shares.items())
+    left_over = spare_threads - sum(int(share) for share in shares.values())
+    for sample_name in sorted(shares, key=lambda name: (int(shares[name]) - shares[name],
+                                                        name))[:left_over]:
+        thread_plan[sample_name] += 1
+    return thread_plan
+
+
+def estimate_mapping_time(read_pairs, threads):
+    """
+    Function to estimate the hisat2 wall time of a sample from its read pairs.
+
+    :param read_pairs: The number of read pairs of the sample, given as an int.
+    :param threads: The number of hisat2 threads, given as an int.
+    :return: The estimated wall time in seconds, given as a float.
+    """
+    return float(read_pairs) / (MAPPING_PAIRS_PER_THREAD_SECOND * threads)
+
+
+def report_mapping_plan(split_folder, total_threads):
+    """
+    Method to print the planned threads and estimated mapping time per sample, based on the read
+    statistics sidecars.
+
+    :param split_folder: Path leading to the split FASTQ files and their sidecars.
+    :param total_threads: The number of threads available for mapping, given as an int.
+    :return: A dictionary of sample names and their planned thread counts.
+    """
+    read_counts = get_read_counts(split_folder)
+    thread_plan = plan_mapping_threads(read_counts, total_threads)
+    for sample_name in sorted(read_counts):
+        print('%s: %s read pairs, %s threads, estimated mapping time %.0f seconds.' % (
+            sample_name, read_counts[sample_name], thread_plan[sample_name],
+            estimate_mapping_time(read_counts[sample_name], thread_plan[sample_name])))
+    return thread_plan
+
+
+def apply_mapping_plan(split_folder, total_threads, graph, map_tasks):
+    """
+    Method to divide the mapping threads over the samples by their read counts once all samples
+    are split, and hand the planned threads to their waiting map tasks.
+
+    :param split_folder: Path leading to the split FASTQ files and their sidecars.
+    :param total_threads: The number of threads to divide over all samples, given as an int.
+    :param graph: The Scheduler.TaskGraph holding the map tasks.
+    :param map_tasks: A dictionary of sample names and the names of their map tasks and the
+    threads the task needs besides hisat2's, given as (name, extra threads) tuples.
+    """
+    thread_plan = report_mapping_plan(split_folder, total_threads)
+    for sample_name, (task_name, extra_threads) in map_tasks.items():
+        if sample_name in thread_plan:
+            graph.set_threads(task_name, thread_plan[sample_name] + extra_threads,
+                              1 + extra_threads)
+
+
+def wait_for_streaming_processes(splitter, aligner, sample_name):
+    """
+    Method to wait for a splitter process and the hisat2 process reading its pipes. As soon as
+    either fails, the other is stopped, so a failing sample never hangs on a pipe nobody opens.
+
+    :param splitter: The splitter, given as a Process of PROCESS_CONTEXT.
+    :param aligner: The hisat2 process, given as a subprocess.Popen started in its own session.
+    :param sample_name: The name of the sample, used in error messages.
+    """
+    start_time = time.time()
+    while True:
+        aligner_code = aligner.returncode
+        if aligner_code is None:
+            aligner_code, usage = StageTrace.wait_for_process(aligner, os.WNOHANG)
+            if aligner_code is not None:
+                StageTrace.recorder.record_command('stream', 'hisat2 of %s' % sample_name,
+                                                   start_time, time.time(), usage, aligner_code)
+        splitter_code = splitter.exitcode
+        if splitter_code not in (None, 0) or aligner_code not in (None, 0):
+            if aligner_code is None:
+                os.killpg(aligner.pid, signal.SIGTERM)
+                aligner.wait()
+            if splitter_code is None:
+                splitter.terminate()
+            splitter.join()
+            raise RuntimeError('Streaming split and map of %s failed (splitter: %s, hisat2: %s).'
+                               % (sample_name, splitter.exitcode, aligner.returncode))
+        if aligner_code == 0 and splitter_code == 0:
+            splitter.join()
+            return
+        time.sleep(STREAM_POLL_INTERVAL)
+
+
+def resolve_sample_fraction(fastq_path, subsample):
+    """
+    Function to turn a subsample given as a number of read pairs into a fraction of the read
+    pairs of a merged FASTQ file, as a stream is sampled record by record without drawing from
+    the whole file. The read pairs are counted by the .fqi index of the file, which is built and
+    saved next to it if missing.
+
+    :param fastq_path: Path leading to the merged, paired-end FASTQ file.
+    :param subsample: The fraction (below one) or number of read pairs to keep, or None.
+    :return: The fraction of the read pairs to keep, or None to keep all of them.
+    """
+    if subsample is None or subsample < 1:
+        return subsample
+    index = FastqIndex.load_fastq_index(fastq_path)
+    if index is None:
+        index = FastqIndex.build_fastq_index(fastq_path)
+        index.save(FastqIndex.get_index_path(fastq_path))
+    if subsample >= index.record_count:
+        return None
+    return subsample / float(index.record_count)
+
+
+def run_streaming_split_map(fastq_path, base_string, his_hat_output, sample_fraction=None,
+                            seed=0, threads=5):
+    """
+    Function to split a merged FASTQ file straight into two named pipes read by hisat2, so
+    splitting and alignment overlap and the split reads never reach the disk.
+
+    :param fastq_path: Path leading to the merged, paired-end FASTQ file.
+    :param base_string: The base string of the hisat2 index files.
+    :param his_hat_output: Path leading to the folder receiving the SAM file.
+    :param sample_fraction: If given, only this fraction (below one) of the read pairs is
+    streamed, or about this number of read pairs.
+    :param seed: The seed of the subsample.
+    :param threads: The number of threads of the splitter and hisat2 together; the splitter
+    takes one of them.
+    :return: The StageResult of the streamed alignment.
+    """
+    sample_name = strip_fastq_extension(os.path.basename(fastq_path))
+    sample_fraction = resolve_sample_fraction(fastq_path, sample_fraction)
+    fifo_folder = tempfile.mkdtemp(prefix='%s_streams_' % sample_name)
+    fifo_paths = ['%s/%s_%s.fastq' % (fifo_folder, sample_name, name)
+                  for name in ['forward', 'reverse']]
+    try:
+        for fifo_path in fifo_paths:
+            os.mkfifo(fifo_path)
+        sam_path = '%s/%s.sam' % (his_hat_output, sample_name)
+        partial_path = '%s.partial' % sam_path
+        cmd = Mapping.create_hisat2_command(base_string, fifo_paths[0], fifo_paths[1],
+                                            partial_path, max(1, threads - 1),
+                                            Mapping.get_metrics_base(sam_path))
+        print('Streaming %s into hisat2.' % fastq_path)
+        start_time = time.time()
+        splitter = PROCESS_CONTEXT.Process(target=Splitter.split_file_by_block,
+                                           args=(fastq_path, fifo_paths, 0, None, 0, False,
+                                                 sample_fraction, seed))
+        splitter.start()
+        aligner = subprocess.Popen(cmd, shell=True, preexec_fn=os.setsid)
+        try:
+            wait_for_streaming_processes(splitter, aligner, sample_name)
+        except RuntimeError:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise
+        os.rename(partial_path, sam_path)
+        result = StageResult.StageResult('stream', [sam_path], time.time() - start_time, 0, cmd)
+        return summarise_alignment(result, '%s/%s' % (his_hat_output, sample_name))
+    finally:
+        shutil.rmtree(fifo_folder)
+
+
+def run_streaming(rna_seq_folder, genome_folder, his_hat_output, sample_fraction=None, seed=0,
+                  index_cache=None):
+    """
+    Method to build the hisat2 index once and stream every merged FASTQ file into hisat2.
+
+    :param rna_seq_folder: Path leading to the merged, paired-end FASTQ files.
+    :param genome_folder: Path leading to the genome folder.
+    :param his_hat_output: Path leading to the folder receiving the SAM files.
+    :param sample_fraction: If given, only this fraction (below one) of the read pairs is
+    streamed, or about this number of read pairs.
+    :param seed: The seed of the subsample.
+    :param index_cache: Path leading to the folder holding the cached indexes, by default next to
+    the hisat2 output folder.
+    """
+    genome_path = '%s/%s' % (genome_folder, GENOME_FILE)
+    index_cache = index_cache or '%s/%s' % (os.path.dirname(his_hat_output), INDEX_FOLDER)
+    genome_hash = HisatIndex.hash_genome(genome_path)
+    base_string = HisatIndex.get_index_base(genome_path, index_cache, genome_hash)
+    build_genome_index(genome_path, index_cache, genome_hash)
+    for folder_file in sorted(os.listdir(rna_seq_folder)):
+        if folder_file.endswith(FASTQ_EXTENSIONS):
+            run_streaming_split_map('%s/%s' % (rna_seq_folder, folder_file), base_string,
+                                    his_hat_output, sample_fraction, seed)
 
 
 def run_samsorter(his_hat_folder):
@@ -126,42 +599,189 @@ def run_samsorter(his_hat_folder):
     """
     for sam_file_path in os.listdir(his_hat_folder):
         if sam_file_path.endswith('.sam'):
-            cmd = 'python SamSort.py %s/%s %s' % (his_hat_folder, sam_file_path, False)
-            execute_on_command_line(cmd)
+            sort_sample('%s/%s' % (his_hat_folder, sam_file_path))
+
+
+def sort_filtered_sam_python(sam_file_path, sort_memory, temporary_folder, filter_rules,
+                             summary_path):
+    """
+    Function to filter and sort a SAM file with the Python sorter, saving the filter summary.
+
+    :param sam_file_path: Path leading to the SAM file.
+    :param sort_memory: The megabytes of memory a chunk of alignments may take.
+    :param temporary_folder: The folder receiving the sorted runs.
+    :param filter_rules: The minimum mapping quality, primary-only and proper-pair rules of the
+    filter, given as a tuple.
+    :param summary_path: Path of the JSON summary of the dropped alignments.
+    :return: The StageResult of the sort, listing the sorted SAM file and the summary.
+    """
+    alignment_filter = SamFilter.AlignmentFilter(*filter_rules)
+    result = SamSort.sort_sam_python(sam_file_path, sort_memory, temporary_folder, True,
+                                     alignment_filter)
+    alignment_filter.save(summary_path)
+    result.output_paths.append(summary_path)
+    return result
+
+
+def sort_sample(sam_file_path, sort_memory=SamSort.SORT_MEMORY_PER_THREAD,
+                temporary_folder=None, build_index=False, sorter='samtools', filter_rules=None,
+                threads=1):
+    """
+    Sorts the SAM file of a single sample straight into a sorted BAM file, with a multi-threaded,
+    memory-bounded samtools sort, or into a sorted SAM file with the single-threaded Python sorter
+    where samtools is not available. When filter rules are given, the alignments are filtered
+    before sorting and a summary of the dropped alignments is saved next to the SAM file.
+
+    :param sam_file_path: Path leading to the SAM file.
+    :param sort_memory: The megabytes of memory each sort thread may use before spilling.
+    :param temporary_folder: The folder receiving the sort's spill files.
+    :param build_index: Whether to index the sorted BAM file.
+    :param sorter: The sorter to use, either 'samtools' or 'python'.
+    :param filter_rules: The minimum mapping quality, primary-only and proper-pair rules of the
+    filter, given as a tuple, or None to not filter.
+    :param threads: The number of threads samtools sort may use.
+    :return: The StageResult of the sort.
+    """
+    summary_path = SamFilter.get_summary_path(sam_file_path)
+    if sorter == 'python' and filter_rules:
+        return call_in_process(sort_filtered_sam_python, (sam_file_path, sort_memory,
+                                                          temporary_folder, filter_rules,
+                                                          summary_path))
+    if sorter == 'python':
+        return call_in_process(SamSort.sort_sam_python,
+                               (sam_file_path, sort_memory, temporary_folder, True))
+    filter_command = None
+    if filter_rules:
+        filter_command = SamFilter.create_filter_command(sam_file_path, *filter_rules,
+                                                         summary_path=summary_path)
+    result = SamSort.sort_sam_threaded(sam_file_path, threads, sort_memory, temporary_folder,
+                                       build_index, True, filter_command)
+    if filter_rules:
+        result.output_paths.append(summary_path)
+    return result
 
 
 def run_cufflinks(sorted_bam_path, annotation, output_folder_path, overwrite=False):
     for file_name in os.listdir(sorted_bam_path):
-        if file_name.endswith('.sorted.bam'):
-            dirname = '%s/%s' % (output_folder_path, re.sub('\.sorted\.bam', '', file_name))
-            make_directory(dirname)
-            cmd = 'python CuffLinks.py %s/%s %s %s %s' % \
-                  (sorted_bam_path, file_name, annotation, dirname, overwrite)
-            execute_on_command_line(cmd)
-
-
-def output_check(file_names, output_folder, extension, overwrite=False):
-    output_files = ['%s%s' % (a_file, extension) for a_file in file_names]
-    exitcode = make_directory(output_folder)
-    if exitcode == 0 or overwrite:
-        return True
-    elif not any(list(a_file for a_file in output_files if a_file in os.listdir(output_folder))):
-        return True
-    else:
-        return False
+        if file_name.endswith(('.sorted.bam', '.sorted.sam')):
+            cufflinks_sample('%s/%s' % (sorted_bam_path, file_name), annotation,
+                             output_folder_path, overwrite)
 
 
-def run_cuff_merge(cufflinks_folder, cuffmerge_folder, run_name, overwrite):
-    cmd = 'python CuffMerge.py %s %s %s %s' % (cufflinks_folder, cuffmerge_folder, run_name,
-                                               overwrite)
-    execute_on_command_line(cmd)
+def cufflinks_sample(sorted_bam_file, annotation, output_folder_path, overwrite=False, shards=1,
+                     threads=4):
+    """
+    Runs cufflinks on the sorted BAM file of a single sample, saving its output in a folder named
+    after the sample. With more than one shard, cufflinks runs on balanced groups of scaffolds
+    side by side, sharing the threads, and their outputs are merged.
+
+    :param sorted_bam_file: Path leading to the sorted BAM file.
+    :param annotation: Path leading to the reference annotation.
+    :param output_folder_path: Path leading to the cufflinks output folder.
+    :param overwrite: Whether to overwrite existing cufflinks output.
+    :param shards: The largest number of scaffold shards; 1 runs a single cufflinks.
+    :param threads: The number of threads cufflinks may use.
+    :return: The StageResult of cufflinks.
+    """
+    file_name = os.path.basename(sorted_bam_file)
+    dirname = '%s/%s' % (output_folder_path, re.sub(r'\.sorted\.(bam|sam)$', '', file_name))
+    if shards > 1:
+        return run_into_folder(dirname, CuffLinksShards.run_sharded_cuff_links,
+                               (sorted_bam_file, annotation), (overwrite, threads, shards))
+    return run_into_folder(dirname, CuffLinks.run_cuff_links,
+                           (sorted_bam_file, annotation), (overwrite, threads))
+
+
+def run_into_folder(output_folder, function, leading_arguments, trailing_arguments):
+    """
+    Function to run a stage writing into a folder through a partial folder, which replaces the
+    output folder only once the stage succeeded, so an interrupted stage never leaves a
+    half-written output folder behind.
+
+    :param output_folder: Path leading to the output folder of the stage.
+    :param function: The function running the stage, taking the output folder between its leading
+    and trailing arguments.
+    :param leading_arguments: The arguments before the output folder, given as a tuple.
+    :param trailing_arguments: The arguments after the output folder, given as a tuple.
+    :return: The StageResult of the stage, listing the output folder.
+    """
+    partial_folder = '%s.partial' % output_folder
+    if os.path.exists(partial_folder):
+        shutil.rmtree(partial_folder)
+    make_directory(partial_folder)
+    try:
+        result = function(*(tuple(leading_arguments) + (partial_folder,) +
+                            tuple(trailing_arguments)))
+    except BaseException:
+        shutil.rmtree(partial_folder)
+        raise
+    if os.path.exists(output_folder):
+        shutil.rmtree(output_folder)
+    os.rename(partial_folder, output_folder)
+    result.output_paths = [re.sub('^%s' % re.escape(partial_folder), output_folder, path)
+                           for path in result.output_paths]
+    return result
+
+
+def run_cuff_merge(cufflinks_folder, cuffmerge_folder, run_name, overwrite, incremental=True,
+                   threads=1):
+    return run_into_folder(cuffmerge_folder, CuffMerge.merge_assemblies, (cufflinks_folder,),
+                           (run_name, overwrite, threads, cuffmerge_folder, incremental))
+
+
+def quantify_sample(sorted_bam_file, transcripts, output_folder_path, overwrite=False,
+                    threads=4):
+    """
+    Quantifies the sorted BAM file of a single sample against the merged transcripts once, saving
+    its abundances.cxb in a folder named after the sample, from which cuffnorm and cuffdiff read
+    the sample instead of its alignments.
+
+    :param sorted_bam_file: Path leading to the sorted BAM file.
+    :param transcripts: Path leading to the merged transcripts gtf file.
+    :param output_folder_path: Path leading to the cuffquant output folder.
+    :param overwrite: Whether to overwrite existing cuffquant output.
+    :param threads: The number of threads cuffquant may use.
+    :return: The StageResult of cuffquant.
+    """
+    file_name = os.path.basename(sorted_bam_file)
+    dirname = '%s/%s' % (output_folder_path, re.sub(r'\.sorted\.(bam|sam)$', '', file_name))
+    return run_into_folder(dirname, CuffQuant.run_cuff_quant, (sorted_bam_file, transcripts),
+                           (overwrite, threads))
+
+
+def run_cuff_norm(transcripts, abundance_paths, output_folder, overwrite, labels=None,
+                  threads=4):
+    return run_into_folder(output_folder, CuffNorm.run_cuff_norm, (transcripts, abundance_paths),
+                           (overwrite, threads, labels))
+
 
+def run_contrast(transcripts, replicate_groups, output_folder, overwrite, labels, threads=4):
+    return run_into_folder(output_folder, CuffDiff.run_cuff_diff, (replicate_groups, transcripts),
+                           (overwrite, threads, labels))
 
-def run_cuff_norm(transcripts, sam_path, output_folder, overwrite):
-    cmd = 'python CuffNorm.py %s %s %s ' % (transcripts, output_folder, overwrite)
-    for sam in sam_path:
-        cmd += "%s " % sam
-    execute_on_command_line(cmd)
+
+def add_cached_stage(graph, cache, name, input_paths, output_paths, tools, function, arguments,
+                     dependencies=(), threads=0, min_threads=1, memory=0):
+    """
+    Function to add a stage to the task graph that is skipped while it is up to date in the cache.
+
+    :param graph: The Scheduler.TaskGraph to add the stage to.
+    :param cache: The StageCache.StageCache deciding whether the stage has to run.
+    :param name: The unique name of the stage, given as a string.
+    :param input_paths: The paths of the files or folders the stage reads, given as a list.
+    :param output_paths: The paths of the files or folders the stage produces, given as a list.
+    :param tools: The names of the command line tools the stage calls, given as a list.
+    :param function: The function running the stage.
+    :param arguments: The arguments of the function, given as a tuple.
+    :param dependencies: The names of the tasks the stage depends on, given as a list.
+    :param threads: The most threads the stage can use, or 0 for a single threaded stage.
+    :param min_threads: The least number of threads the stage can run with.
+    :param memory: The megabytes of memory the stage needs.
+    :return: The name of the task, for use as a dependency.
+    """
+    return graph.add_task(name, cache.run_stage,
+                          (name, input_paths, output_paths, tools, function, arguments),
+                          dependencies, threads, min_threads, memory)
 
 
 def main():
@@ -170,72 +790,231 @@ def main():
                                     '/local/data/BIF30806_2015_2/project/groups/go/RNA_SEQ',
                                     '/local/data/BIF30806_2015_2/project/genomes/Catharanthus_roseus',
                                     '/local/data/BIF30806_2015_2/project/groups/go/Data'])
-    file_names = [i[0:-6] for i in os.listdir(rna_seq_folder) if i.endswith('.fastq')]
+    options = get_command_line_options({'split_workers': 1, 'stream': False,
+                                        'read_statistics': False, 'mapping_threads': 4,
+                                        'profile': 'full', 'quick_fraction': 0.01, 'seed': 0,
+                                        'max_jobs': 1, 'cores': 0, 'memory': 0,
+                                        'mapping_memory': 0, 'cufflinks_threads': 4,
+                                        'cuffnorm_threads': 4, 'cuffquant_threads': 4,
+                                        'cuffdiff_threads': 4, 'sample_sheet': '',
+                                        'contrasts': '', 'incremental_merge': True,
+                                        'cufflinks_shards': 1,
+                                        'force': False,
+                                        'fused_sort': False, 'sort_threads': 4,
+                                        'sort_memory': SamSort.SORT_MEMORY_PER_THREAD,
+                                        'scratch': '', 'index_bam': False, 'sorter': 'auto',
+                                        'filter_mapq': 0, 'primary_only': False,
+                                        'proper_pair': False, 'index_cache': '',
+                                        'resume': False})
+    assert options['profile'] in RUN_PROFILES, 'Unknown run profile "%s".' % options['profile']
+    assert not (options['stream'] and options['fused_sort']), \
+        'Streaming and fused sorting cannot be combined.'
+    assert options['sorter'] in SORTERS, 'Unknown sorter "%s".' % options['sorter']
+    assert not (options['resume'] and options['force']), 'A forced run cannot be resumed.'
+    sorter = options['sorter']
+    if sorter == 'auto':
+        sorter = 'samtools' if SamSort.has_samtools() else 'python'
+        if sorter == 'python':
+            print('samtools not found, sorting alignments in Python into sorted SAM files.')
+    assert not (options['fused_sort'] and sorter == 'python'), 'Fused sorting needs samtools.'
+    assert options['cufflinks_shards'] == 1 or sorter == 'samtools', \
+        'Sharded cufflinks needs samtools.'
+    sorted_extension = 'bam' if sorter == 'samtools' else 'sam'
+    subsample = None
+    if options['profile'] == 'quick':
+        output_folder = '%s%s' % (output_folder, QUICK_OUTPUT_SUFFIX)
+        make_directory(output_folder)
+        subsample = options['quick_fraction']
+        print('Quick run on a %s subsample, saved to %s.' % (subsample, output_folder))
+    fastq_files = sorted(i for i in os.listdir(rna_seq_folder) if i.endswith(FASTQ_EXTENSIONS))
+    file_names = [strip_fastq_extension(i) for i in fastq_files]
     print(file_names)
-    overwrite = [False, True, True, True, True]
 
-    # Splitter
-    print('\nSPLITTING------------------------------------------------------')
+    genome_path = '%s/%s' % (genome_folder, GENOME_FILE)
+    annotation = '%s/%s' % (genome_folder, ANNOTATION_FILE)
     split_folder = '%s/Split_Data' % output_folder
-    print('Split: %s' % output_check(file_names, output_folder, '_forward.fastq'))
-    # if output_check(file_names, output_folder, '_forward.fastq') or overwrite[0]:
-    if overwrite[0]:
-        run_splitter(rna_seq_folder, split_folder)
-    else:
-        print('Spliting aborted.')
-
-    # Mapper
-    print('\nMAPPING--------------------------------------------------------')
     his_hat_output = '%s/Hisat2_Data' % output_folder
-    # if output_check(file_names, his_hat_output, '.sam') or overwrite[1]:
+    make_directory(output_folder)
+    make_directory(split_folder)
     make_directory(his_hat_output)
-    if overwrite[1]:
-        run_his_hat_2(split_folder, genome_folder, his_hat_output)
-    else:
-        print('Mapping aborted.')
-
-    # Sorter
-    print('\nSORTING---------------------------------------------------------')
-    run_samsorter(his_hat_output)
-
-    # Cuff package
     cuff_folder = '%s/Cuff_Data' % output_folder
     make_directory(cuff_folder)
-
-    # Cufflinks
-    print('\nCUFFLINKS-------------------------------------------------------')
     cufflinks_folder = '%s/Cufflinks_Data' % cuff_folder
-    if output_check(file_names, cufflinks_folder, '') or overwrite[2]:
-        run_cufflinks(his_hat_output, '%s/cro_std_maker_anno.final.gff3' %
-                      genome_folder, cufflinks_folder, overwrite[2])
-    else:
-        print cufflinks_folder+'\nCufflinks directory exists'
-
-    # Cuffmerge
-    print('\nCUFFMERGE-------------------------------------------------------')
+    make_directory(cufflinks_folder)
     cuffmerge_folder = '%s/Cuffmerge_Data' % cuff_folder
-    if output_check(['merged'], cuffmerge_folder, '.gtf') or overwrite[3]:
-        run_cuff_merge(cufflinks_folder, cuffmerge_folder, run_name, overwrite[3])
-    else:
-        print cuffmerge_folder+'\nCuffmerge directory exists'
-
-    # Cuffnorm
-    print('\nCUFFNROM--------------------------------------------------------')
+    make_directory(cuffmerge_folder)
+    cuffquant_folder = '%s/Cuffquant_Data' % cuff_folder
+    make_directory(cuffquant_folder)
     cuffnorm_folder = '%s/Cuffnorm_Data' % cuff_folder
     make_directory(cuffnorm_folder)
     norm_run_folder = '%s/%s' % (cuffnorm_folder, run_name)
     make_directory(norm_run_folder)
-    if output_check(norm_run_folder, cuffnorm_folder, '') or overwrite[4]:
-        transcript_path = '%s/merged.gtf' % cuffmerge_folder
-        sam_paths = ['%s/%s.sorted.bam' % (his_hat_output, a_file) for a_file in file_names]
-        cuff_norm_output = '%s/%s' % (cuffnorm_folder, run_name)
-        run_cuff_norm(transcript_path, sam_paths, cuff_norm_output, overwrite[4])
-    else:
-        print('Cuffnorm failed')
+    # Differential expression between the conditions of the sample sheet, if one is given.
+    contrasts = []
+    if options['sample_sheet']:
+        replicates = CuffDiff.read_sample_sheet(options['sample_sheet'])
+        for condition, samples in replicates.items():
+            for sample in samples:
+                assert sample in file_names, 'Sample "%s" of condition "%s" not found in %s.' % (
+                    sample, condition, rna_seq_folder)
+        contrasts = CuffDiff.get_contrasts(list(replicates), options['contrasts'])
+        make_directory('%s/Cuffdiff_Data' % cuff_folder)
+        diff_run_folder = '%s/Cuffdiff_Data/%s' % (cuff_folder, run_name)
+        make_directory(diff_run_folder)
+    # Every stage transition is journaled; --resume restarts at the first unfinished stage.
+    description = dict((name, value) for name, value in options.items()
+                       if name not in SCHEDULING_OPTIONS)
+    description.update({'run_name': run_name, 'rna_seq_folder': rna_seq_folder,
+                        'genome_folder': genome_folder})
+    journal = RunJournal.RunJournal('%s/Run_Journal.jsonl' % output_folder, description,
+                                    options['resume'])
+    # Stages are skipped only while their inputs, parameters, tools and outputs are unchanged.
+    cache = StageCache.StageCache('%s/Stage_Cache' % output_folder, options['force'], journal)
+    # Sorts spill their temporary files to fast local scratch rather than next to the data.
+    scratch_folder = options['scratch'] or None
+    # Alignments failing the filter rules are dropped before sorting, so they are never sorted.
+    filter_rules = None
+    if options['filter_mapq'] or options['primary_only'] or options['proper_pair']:
+        filter_rules = (options['filter_mapq'], options['primary_only'], options['proper_pair'])
+
+    # Per sample: split -> map -> sort -> cufflinks, each sample as soon as its inputs are ready.
+    # Multi-threaded tools draw their threads from one budget of cores (and memory, in MB).
+    budget = Scheduler.ResourceBudget(options['cores'] or None, options['memory'] or None)
+    print('Scheduling on %s cores.' % budget.cores)
+    graph = Scheduler.TaskGraph(budget)
+    mapping_threads = options['mapping_threads']
+    # Indexes live in a shared cache keyed by the genome's content, built once under a lock.
+    index_cache = options['index_cache'] or '%s/%s' % (output_folder, INDEX_FOLDER)
+    genome_hash = HisatIndex.hash_genome(genome_path)
+    index_base = HisatIndex.get_index_base(genome_path, index_cache, genome_hash)
+    index_paths = HisatIndex.get_index_paths(index_base)
+    index_task = add_cached_stage(graph, cache, 'hisat2-build', [genome_path], index_paths,
+                                  ['hisat2-build'], build_genome_index,
+                                  (genome_path, index_cache, genome_hash),
+                                  threads=mapping_threads, memory=options['mapping_memory'])
+    split_tasks, sort_tasks, cufflinks_tasks = collections.OrderedDict(), [], []
+    if not options['stream']:
+        for fastq_file, sample_name in zip(fastq_files, file_names):
+            fastq_path = '%s/%s' % (rna_seq_folder, fastq_file)
+            split_outputs = ['%s/%s_%s.fastq' % (split_folder, sample_name, mate)
+                             for mate in ['forward', 'reverse']]
+            if options['read_statistics']:
+                split_outputs.append(ReadStatistics.get_statistics_path(split_outputs[0]))
+            split_tasks[sample_name] = add_cached_stage(
+                graph, cache, '%s:split' % sample_name, [fastq_path], split_outputs, [],
+                split_sample, (fastq_path, split_folder, False, options['read_statistics'],
+                               subsample, options['seed']), threads=options['split_workers'])
+    # With read statistics, the mapping threads of all samples are divided by their read counts
+    # once every sample is split, so large samples map with more threads than small ones.
+    plan_tasks = []
+    if options['read_statistics'] and split_tasks:
+        plan_tasks = [graph.add_task(
+            'mapping-plan', apply_mapping_plan,
+            (split_folder, mapping_threads * len(split_tasks), graph,
+             dict((sample_name, ('%s:%s' % (sample_name, 'map-sort' if options['fused_sort']
+                                            else 'map'), int(options['fused_sort'])))
+                  for sample_name in split_tasks)), list(split_tasks.values()))]
+    for fastq_file, sample_name in zip(fastq_files, file_names):
+        fastq_path = '%s/%s' % (rna_seq_folder, fastq_file)
+        sam_path = '%s/%s.sam' % (his_hat_output, sample_name)
+        sorted_path = '%s/%s.sorted.%s' % (his_hat_output, sample_name, sorted_extension)
+        filter_outputs = [SamFilter.get_summary_path(sam_path)] if filter_rules else []
+        metrics_outputs = [HisatMetrics.get_summary_path('%s/%s' % (his_hat_output, sample_name))]
+        if options['stream']:
+            map_task = add_cached_stage(
+                graph, cache, '%s:stream' % sample_name, [fastq_path] + index_paths,
+                [sam_path] + metrics_outputs, ['hisat2'], run_streaming_split_map,
+                (fastq_path, index_base, his_hat_output, subsample, options['seed']), [index_task],
+                threads=mapping_threads + 1, min_threads=2, memory=options['mapping_memory'])
+        else:
+            read_paths = ['%s/%s_%s.fastq' % (split_folder, sample_name, mate)
+                          for mate in ['forward', 'reverse']]
+            map_dependencies = [split_tasks[sample_name], index_task] + plan_tasks
+            if options['fused_sort']:
+                # hisat2 pipes straight into samtools sort; no SAM or unsorted BAM is written.
+                map_task = add_cached_stage(
+                    graph, cache, '%s:map-sort' % sample_name, read_paths + index_paths,
+                    [sorted_path] + filter_outputs + metrics_outputs, ['hisat2', 'samtools'],
+                    map_sort_sample,
+                    (sample_name, split_folder, index_base, his_hat_output,
+                     options['sort_memory'], scratch_folder, filter_rules),
+                    map_dependencies, threads=mapping_threads + 1, min_threads=2,
+                    memory=options['mapping_memory'] +
+                    max(1, (mapping_threads + 1) // 4) * options['sort_memory'])
+            else:
+                map_task = add_cached_stage(
+                    graph, cache, '%s:map' % sample_name, read_paths + index_paths,
+                    [sam_path] + metrics_outputs, ['hisat2'], map_sample,
+                    (sample_name, split_folder, index_base, his_hat_output),
+                    map_dependencies, threads=mapping_threads,
+                    memory=options['mapping_memory'])
+        if options['fused_sort']:
+            sort_tasks.append(map_task)
+        else:
+            index_bam = (options['index_bam'] or options['cufflinks_shards'] > 1) and \
+                sorter == 'samtools'
+            sort_threads = options['sort_threads'] if sorter == 'samtools' else 1
+            sort_tasks.append(add_cached_stage(
+                graph, cache, '%s:sort' % sample_name, [sam_path],
+                [sorted_path] + ['%s.bai' % sorted_path] * index_bam + filter_outputs,
+                [sorter] if sorter == 'samtools' else [], sort_sample,
+                (sam_path, options['sort_memory'], scratch_folder, index_bam, sorter,
+                 filter_rules),
+                [map_task], threads=sort_threads, memory=sort_threads * options['sort_memory']))
+        cufflinks_tasks.append(add_cached_stage(
+            graph, cache, '%s:cufflinks' % sample_name, [sorted_path, annotation],
+            ['%s/%s' % (cufflinks_folder, sample_name)],
+            ['cufflinks'] + ['samtools'] * (options['cufflinks_shards'] > 1), cufflinks_sample,
+            (sorted_path, annotation, cufflinks_folder, True, options['cufflinks_shards']),
+            [sort_tasks[-1]],
+            threads=options['cufflinks_threads']))
+
+    # Joins: cuffmerge over all assemblies, cuffquant of every sample against the merged
+    # transcripts, then cuffnorm over the abundances of all samples.
+    transcript_path = '%s/merged.gtf' % cuffmerge_folder
+    merge_task = add_cached_stage(graph, cache, 'cuffmerge', [cufflinks_folder],
+                                  [transcript_path], ['cuffmerge'], run_cuff_merge,
+                                  (cufflinks_folder, cuffmerge_folder, run_name, True,
+                                   options['incremental_merge']),
+                                  cufflinks_tasks, threads=1)
+    quant_tasks, abundance_paths = [], []
+    for a_file, sort_task in zip(file_names, sort_tasks):
+        sorted_path = '%s/%s.sorted.%s' % (his_hat_output, a_file, sorted_extension)
+        abundance_paths.append('%s/%s/abundances.cxb' % (cuffquant_folder, a_file))
+        quant_tasks.append(add_cached_stage(
+            graph, cache, '%s:cuffquant' % a_file, [sorted_path, transcript_path],
+            [abundance_paths[-1]], ['cuffquant'], quantify_sample,
+            (sorted_path, transcript_path, cuffquant_folder, True), [merge_task, sort_task],
+            threads=options['cuffquant_threads']))
+    add_cached_stage(graph, cache, 'cuffnorm', [transcript_path] + abundance_paths,
+                     [norm_run_folder], ['cuffnorm'], run_cuff_norm,
+                     (transcript_path, abundance_paths, norm_run_folder, True, file_names),
+                     quant_tasks, threads=options['cuffnorm_threads'])
+    # Every contrast is its own cuffdiff, reading the abundances quantified once per sample.
+    quantified = dict(zip(file_names, zip(abundance_paths, quant_tasks)))
+    for contrast in contrasts:
+        contrast_name = CuffDiff.get_contrast_name(contrast)
+        samples = replicates[contrast[1]] + replicates[contrast[0]]
+        replicate_groups, labels = CuffDiff.get_replicate_groups(
+            replicates, contrast, dict((sample, quantified[sample][0]) for sample in samples))
+        contrast_folder = '%s/%s' % (diff_run_folder, contrast_name)
+        add_cached_stage(graph, cache, 'cuffdiff:%s' % contrast_name,
+                         [transcript_path] + [quantified[sample][0] for sample in samples],
+                         [contrast_folder], ['cuffdiff'], run_contrast,
+                         (transcript_path, replicate_groups, contrast_folder, True, labels),
+                         [quantified[sample][1] for sample in samples],
+                         threads=options['cuffdiff_threads'])
+    try:
+        graph.run(options['max_jobs'])
+    finally:
+        # Where the time went: a timeline of every task and command, and a summary table.
+        StageTrace.recorder.save_chrome_trace('%s/Pipeline_Trace.json' % output_folder)
+        summary = StageTrace.recorder.format_summary(budget.cores)
+        with open('%s/Pipeline_Summary.txt' % output_folder, 'w') as summary_file:
+            summary_file.write(summary + '\n')
+        print(summary)
 
-    # Find Differential Expression
     # BLAST2GO
 
-
 if __name__ == '__main__':
     main()
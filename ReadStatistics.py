@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A collection of functions designed to collect read statistics of a merged, paired-end FASTQ file
+while it is being split: the number of read pairs, the length distribution and the mean quality
+per position of the forward and reverse mates. Qualities are summed per block of records with
+NumPy when it is installed, and with a slower pure Python fallback otherwise.
+    -Outputs:   [1] A JSON sidecar named <sample>_read_statistics.json, saved next to the split
+                forward and reverse FASTQ files.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import json
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+PHRED_OFFSET = 33
+MATES = ['forward', 'reverse']
+
+
+def sum_quality_columns(qualities, length):
+    """
+    Function to sum the quality values of a group of equally long quality strings per position.
+
+    :param qualities: The quality strings, given as a list of bytes of equal length.
+    :param length: The length of the quality strings, given as an int.
+    :return: The summed raw quality characters per position, given as a list of ints.
+    """
+    if numpy is not None:
+        matrix = numpy.frombuffer(b''.join(qualities), dtype=numpy.uint8)
+        return matrix.reshape(len(qualities), length).sum(axis=0, dtype=numpy.int64).tolist()
+    return [sum(column) for column in zip(*[bytearray(quality) for quality in qualities])]
+
+
+class ReadStatistics(object):
+    """
+    Accumulates the read statistics of the forward and reverse mates of merged FASTQ records.
+    """
+
+    def __init__(self):
+        self.read_pairs = 0
+        self.lengths = dict((mate, {}) for mate in MATES)
+        self.quality_sums = dict((mate, []) for mate in MATES)
+        self.position_counts = dict((mate, []) for mate in MATES)
+
+    def add_columns(self, mate, column_sums, count):
+        """
+        Method to add the summed qualities of a number of reads of one mate.
+
+        :param mate: The mate, either 'forward' or 'reverse'.
+        :param column_sums: The summed raw quality characters per position, given as a list.
+        :param count: The number of reads summed, given as an int.
+        """
+        length = len(column_sums)
+        self.lengths[mate][length] = self.lengths[mate].get(length, 0) + count
+        quality_sums, position_counts = self.quality_sums[mate], self.position_counts[mate]
+        if len(quality_sums) < length:
+            quality_sums.extend([0] * (length - len(quality_sums)))
+            position_counts.extend([0] * (length - len(position_counts)))
+        for position, column_sum in enumerate(column_sums):
+            quality_sums[position] += column_sum
+            position_counts[position] += count
+
+    def update(self, sequences, qualities):
+        """
+        Method to add a block of merged records, whose first half is the forward and second half
+        the reverse mate.
+
+        :param sequences: The merged sequences, given as a list of bytes.
+        :param qualities: The merged qualities, given as a list of bytes.
+        """
+        self.read_pairs += len(sequences)
+        lengths = [len(sequence) for sequence in sequences]
+        if lengths and lengths.count(lengths[0]) == len(lengths):
+            groups = {lengths[0]: qualities}
+        else:
+            groups = {}
+            for length, quality in zip(lengths, qualities):
+                groups.setdefault(length, []).append(quality)
+        for length, group in groups.items():
+            column_sums = sum_quality_columns(group, length)
+            self.add_columns('forward', column_sums[:length // 2], len(group))
+            self.add_columns('reverse', column_sums[length // 2:], len(group))
+
+    def merge(self, other):
+        """
+        Method to add the statistics collected by another ReadStatistics, such as those of another
+        byte range of the same file.
+
+        :param other: The ReadStatistics to be added.
+        """
+        self.read_pairs += other.read_pairs
+        for mate in MATES:
+            for length, count in other.lengths[mate].items():
+                self.lengths[mate][length] = self.lengths[mate].get(length, 0) + count
+            quality_sums, position_counts = self.quality_sums[mate], self.position_counts[mate]
+            for position, (column_sum, count) in enumerate(zip(other.quality_sums[mate],
+                                                               other.position_counts[mate])):
+                if position == len(quality_sums):
+                    quality_sums.append(0)
+                    position_counts.append(0)
+                quality_sums[position] += column_sum
+                position_counts[position] += count
+
+    def to_dictionary(self):
+        """
+        Function to summarise the statistics as a JSON-compatible dictionary.
+
+        :return: The read pair count and, per mate, the read count, length distribution and mean
+        Phred quality per position.
+        """
+        summary = {'read_pairs': self.read_pairs, 'phred_offset': PHRED_OFFSET}
+        for mate in MATES:
+            summary[mate] = {
+                'reads': sum(self.lengths[mate].values()),
+                'length_distribution': dict((str(length), count) for length, count in
+                                            sorted(self.lengths[mate].items())),
+                'mean_quality_per_position': [
+                    round(float(column_sum) / count - PHRED_OFFSET, 2) for column_sum, count in
+                    zip(self.quality_sums[mate], self.position_counts[mate])]}
+        return summary
+
+    def save(self, statistics_path):
+        """
+        Method to write the statistics to a JSON sidecar file.
+
+        :param statistics_path: The path of the JSON file, given as a string.
+        """
+        with open(statistics_path, 'w') as statistics_file:
+            json.dump(self.to_dictionary(), statistics_file, indent=2, sort_keys=True)
+
+
+def get_statistics_path(forward_output_path):
+    """
+    Function to generate the path of the statistics sidecar from the forward output path.
+
+    :param forward_output_path: The path of the split forward FASTQ file, given as a string.
+    :return: The path of the JSON sidecar, given as a string.
+    """
+    return '%s_read_statistics.json' % forward_output_path.rsplit('_forward.', 1)[0]
+
+
+def load_read_statistics(statistics_path):
+    """
+    Function to read a statistics sidecar.
+
+    :param statistics_path: The path of the JSON file, given as a string.
+    :return: The statistics, given as a dictionary.
+    """
+    with open(statistics_path) as statistics_file:
+        return json.load(statistics_file)
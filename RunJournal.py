@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A journal designed to make pipeline runs crash-safe and resumable. Every transition of every
+stage, started, finished, skipped or failed, is appended to a JSON-lines file and synced to disk
+before the run moves on, so the journal of a run that died still tells exactly which stages
+completed.
+    -Outputs:   [1] The journal, one JSON record per line, saved as
+                <output_folder>/Run_Journal.jsonl.
+
+Every run starts with a 'run' record describing its arguments. A resumed run continues the last
+run that was not itself a resumption: stages it finished, whose outputs are still present, are
+skipped without being looked at again, and the leftover partial outputs of the stages it started
+but did not finish are removed, so the resumed run restarts exactly at the first incomplete stage.
+A resumption must be given the same arguments as the run it resumes.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import threading
+import shutil
+import json
+import time
+import os
+
+
+FINISHED_STATES = ('finished', 'skipped', 'resumed')
+
+
+def read_records(journal_path):
+    """
+    Function to read the records of a journal, ignoring a last line cut short by a crash.
+
+    :param journal_path: The path of the journal, given as a string.
+    :return: The records, given as a list of dictionaries.
+    """
+    records = []
+    if not os.path.exists(journal_path):
+        return records
+    with open(journal_path) as journal_file:
+        for line in journal_file:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return records
+
+
+def get_resumed_records(records):
+    """
+    Function to select the records of the run to resume: the last run that was not a resumption,
+    together with all resumptions of it.
+
+    :param records: The records of the journal, given as a list of dictionaries.
+    :return: The 'run' record of the resumed run, or None if there is none, and the stage records
+    written since.
+    """
+    starts = [index for index, record in enumerate(records)
+              if record.get('state') == 'run' and not record.get('resumed')]
+    if not starts:
+        return None, []
+    return records[starts[-1]], [record for record in records[starts[-1] + 1:]
+                                 if record.get('state') != 'run']
+
+
+def remove_partial_outputs(output_paths):
+    """
+    Method to remove the partial files or folders '<output>.partial' left by an interrupted stage.
+
+    :param output_paths: The paths of the outputs of the stage, given as a list.
+    """
+    for output_path in output_paths:
+        partial_path = '%s.partial' % output_path
+        if os.path.isdir(partial_path):
+            shutil.rmtree(partial_path)
+        elif os.path.exists(partial_path):
+            os.remove(partial_path)
+
+
+class RunJournal(object):
+    """
+    The append-only journal of the stage transitions of a run.
+    """
+
+    def __init__(self, journal_path, description, resume=False):
+        """
+        :param journal_path: The path of the JSON-lines journal, given as a string.
+        :param description: The arguments of the run, given as a JSON-compatible dictionary.
+        :param resume: Whether to resume the last run recorded in the journal.
+        """
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.finished = set()
+        self.interrupted = {}
+        if resume:
+            run_record, records = get_resumed_records(read_records(journal_path))
+            if run_record is None:
+                print('No run to resume in %s, starting a new run.' % journal_path)
+                resume = False
+            else:
+                assert run_record['description'] == description, \
+                    'The run in %s was started with other arguments and cannot be resumed.' % \
+                    journal_path
+                for record in records:
+                    if record['state'] in FINISHED_STATES:
+                        self.finished.add(record['stage'])
+                        self.interrupted.pop(record['stage'], None)
+                    else:
+                        self.finished.discard(record['stage'])
+                        if record['state'] == 'started':
+                            self.interrupted[record['stage']] = record['outputs']
+        self.append({'state': 'run', 'description': description, 'resumed': resume})
+
+    def append(self, record):
+        """
+        Method to append a record to the journal and sync it to disk.
+
+        :param record: The record, given as a JSON-compatible dictionary, stamped with the time.
+        """
+        record = dict(record, time=round(time.time(), 3))
+        with self.lock:
+            with open(self.journal_path, 'a') as journal_file:
+                journal_file.write(json.dumps(record, sort_keys=True) + '\n')
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+
+    def record(self, stage, state, **fields):
+        """
+        Method to record a transition of a stage.
+
+        :param stage: The name of the stage, given as a string.
+        :param state: The new state of the stage: started, finished, skipped, resumed or failed.
+        :param fields: Further fields of the record, such as the outputs of a started stage.
+        """
+        self.append(dict(fields, stage=stage, state=state))
+
+    def is_finished(self, stage, output_paths):
+        """
+        Function to check whether the resumed run finished a stage and its outputs are present.
+
+        :param stage: The name of the stage, given as a string.
+        :param output_paths: The paths of the outputs of the stage, given as a list.
+        :return: True if the stage can be skipped, False otherwise.
+        """
+        return stage in self.finished and all(os.path.exists(path) for path in output_paths)
+
+    def start(self, stage, output_paths):
+        """
+        Method to record the start of a stage, first removing what an interrupted attempt of it
+        in the resumed run left behind.
+
+        :param stage: The name of the stage, given as a string.
+        :param output_paths: The paths of the outputs of the stage, given as a list.
+        """
+        if stage in self.interrupted:
+            print('Stage %s was interrupted. Removing its partial outputs.' % stage)
+            remove_partial_outputs(self.interrupted.pop(stage))
+        self.record(stage, 'started', outputs=list(output_paths))
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A task graph designed to run the stages of the pipeline as soon as their inputs are ready. Every
+task names the tasks it depends on; independent tasks, such as the stages of different samples,
+run concurrently in threads up to a limit on the number of concurrent jobs. The stages spend
+their time in external tools, so threads are sufficient to keep them running in parallel.
+
+Tasks running multi-threaded tools draw their thread count from a shared budget of CPU cores,
+and optionally memory, so that concurrent samples fill a node without oversubscribing it. Such a
+task asks for a minimum and maximum number of threads, is started once at least the minimum is
+free, and receives the granted number as its 'threads' keyword argument.
+
+When a task fails, no new tasks are started, the running tasks are allowed to finish and the
+failures are raised together.
+
+Every task is recorded as a span in StageTrace.recorder, together with the number of cores in use,
+so that a run can be exported as a timeline.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import multiprocessing
+import collections
+import threading
+import traceback
+import time
+
+import StageTrace
+
+
+class ResourceBudget(object):
+    """
+    A shared budget of CPU cores and, optionally, memory in megabytes, from which jobs acquire
+    their threads and release them when done.
+    """
+
+    def __init__(self, cores=None, memory=None):
+        """
+        :param cores: The number of cores to hand out, by default all cores of the machine.
+        :param memory: The megabytes of memory to hand out, or None to not account for memory.
+        """
+        self.cores = cores or multiprocessing.cpu_count()
+        self.memory = memory
+        self.free_cores = self.cores
+        self.free_memory = memory
+        self.condition = threading.Condition()
+
+    def try_acquire(self, min_threads, max_threads, memory=0):
+        """
+        Function to acquire as many threads as are free, up to a maximum, without waiting.
+
+        :param min_threads: The least number of threads the job can run with, given as an int.
+        :param max_threads: The most threads the job can use, given as an int.
+        :param memory: The megabytes of memory the job needs, given as an int.
+        :return: The number of granted threads, or 0 if the minimum is not available.
+        """
+        with self.condition:
+            min_threads = min(min_threads, self.cores)
+            if self.free_cores < min_threads:
+                return 0
+            if self.memory is not None and memory and \
+                    memory > self.free_memory and self.free_memory < self.memory:
+                return 0
+            threads = max(min_threads, min(max_threads, self.free_cores))
+            self.free_cores -= threads
+            if self.memory is not None:
+                self.free_memory -= memory
+            return threads
+
+    def acquire(self, min_threads, max_threads, memory=0):
+        """
+        Function to acquire threads, waiting until at least the minimum is free.
+
+        :param min_threads: The least number of threads the job can run with, given as an int.
+        :param max_threads: The most threads the job can use, given as an int.
+        :param memory: The megabytes of memory the job needs, given as an int.
+        :return: The number of granted threads.
+        """
+        with self.condition:
+            threads = self.try_acquire(min_threads, max_threads, memory)
+            while not threads:
+                self.condition.wait()
+                threads = self.try_acquire(min_threads, max_threads, memory)
+            return threads
+
+    def release(self, threads, memory=0):
+        """
+        Method to return threads and memory to the budget.
+
+        :param threads: The number of threads to return, given as an int.
+        :param memory: The megabytes of memory to return, given as an int.
+        """
+        with self.condition:
+            self.free_cores += threads
+            if self.memory is not None:
+                self.free_memory += memory
+            self.condition.notify_all()
+
+
+class Task(object):
+    """
+    A single node of the task graph: a function, its arguments, the names of the tasks that
+    must have finished before it may start and the resources it needs.
+    """
+
+    def __init__(self, name, function, arguments, dependencies, threads=0, min_threads=1,
+                 memory=0):
+        """
+        :param name: The unique name of the task, given as a string.
+        :param function: The function to call.
+        :param arguments: The arguments of the function, given as a tuple.
+        :param dependencies: The names of the tasks this task depends on, given as a list.
+        :param threads: The most threads the task can use, or 0 for a task that runs no
+        multi-threaded tool and is not given a 'threads' argument.
+        :param min_threads: The least number of threads the task can run with.
+        :param memory: The megabytes of memory the task needs.
+        """
+        self.name = name
+        self.function = function
+        self.arguments = tuple(arguments)
+        self.dependencies = list(dependencies)
+        self.threads = threads
+        self.min_threads = min_threads
+        self.memory = memory
+
+
+class TaskGraph(object):
+    """
+    A directed acyclic graph of tasks, run with a limited number of concurrent jobs and a shared
+    budget of cores.
+    """
+
+    def __init__(self, budget=None):
+        """
+        :param budget: The ResourceBudget tasks draw their threads from, by default all cores.
+        """
+        self.budget = budget or ResourceBudget()
+        self.tasks = collections.OrderedDict()
+        self.results = {}
+        self.failures = collections.OrderedDict()
+        self.condition = threading.Condition()
+        self.ready = []
+        self.waiting = {}
+        self.running = 0
+
+    def add_task(self, name, function, arguments=(), dependencies=(), threads=0, min_threads=1,
+                 memory=0):
+        """
+        Method to add a task to the graph. Dependencies must have been added before.
+
+        :param name: The unique name of the task, given as a string.
+        :param function: The function to call.
+        :param arguments: The arguments of the function, given as a tuple.
+        :param dependencies: The names of the tasks this task depends on, given as a list.
+        :param threads: The most threads the task can use, passed to the function as its
+        'threads' keyword argument, or 0 for a task that runs no multi-threaded tool.
+        :param min_threads: The least number of threads the task can run with.
+        :param memory: The megabytes of memory the task needs.
+        :return: The name of the task, for use as a dependency.
+        """
+        assert name not in self.tasks, 'Task "%s" was added twice.' % name
+        for dependency in dependencies:
+            assert dependency in self.tasks, 'Unknown dependency "%s" of task "%s".' % \
+                                             (dependency, name)
+        self.tasks[name] = Task(name, function, arguments, dependencies, threads, min_threads,
+                                memory)
+        return name
+
+    def set_threads(self, name, threads, min_threads=1):
+        """
+        Method to re-plan the threads of a task that has not started yet, such as from a task it
+        depends on that has learned more about the work ahead.
+
+        :param name: The name of the task, given as a string.
+        :param threads: The most threads the task can use, given as an int.
+        :param min_threads: The least number of threads the task can run with.
+        """
+        with self.condition:
+            task = self.tasks[name]
+            assert name not in self.results and name not in self.failures, \
+                'Task "%s" already ran.' % name
+            assert task.threads, 'Task "%s" is not given threads.' % name
+            task.threads = max(1, min(threads, self.budget.cores))
+            task.min_threads = max(1, min(min_threads, task.threads))
+
+    def run_task(self, task, threads):
+        """
+        Method run in a worker thread, calling a task and releasing the tasks depending on it.
+
+        :param task: The Task to run.
+        :param threads: The number of threads granted to the task, given as an int.
+        """
+        start_time = time.time()
+        StageTrace.recorder.begin_task(task.name)
+        try:
+            if task.threads:
+                print('Started task %s with %s threads.' % (task.name, threads))
+                result, error = task.function(*task.arguments, threads=threads), None
+            else:
+                print('Started task %s.' % task.name)
+                result, error = task.function(*task.arguments), None
+        except BaseException:
+            result, error = None, traceback.format_exc()
+        StageTrace.recorder.end_task(task.name, start_time, threads, task.dependencies,
+                                     error is not None)
+        self.budget.release(threads, task.memory)
+        StageTrace.recorder.record_counter('cores in use',
+                                           self.budget.cores - self.budget.free_cores)
+        with self.condition:
+            self.running -= 1
+            if error is not None:
+                print('Task %s failed:\n%s' % (task.name, error))
+                self.failures[task.name] = error
+            else:
+                print('Finished task %s in %.1f seconds.' % (task.name, time.time() - start_time))
+                self.results[task.name] = result
+                for name, dependencies in self.waiting.items():
+                    dependencies.discard(task.name)
+                    if not dependencies:
+                        self.ready.append(name)
+                for name in self.ready:
+                    self.waiting.pop(name, None)
+            self.condition.notify_all()
+
+    def start_ready_tasks(self, max_jobs):
+        """
+        Method to start every ready task for which a job slot and enough threads are free, in the
+        order in which the tasks became ready. Must be called holding the graph's condition.
+
+        :param max_jobs: The maximum number of concurrently running tasks, given as an int.
+        """
+        for name in list(self.ready):
+            if self.running >= max_jobs or self.failures:
+                return
+            task = self.tasks[name]
+            threads = 0
+            if task.threads:
+                threads = self.budget.try_acquire(task.min_threads, task.threads, task.memory)
+                if not threads:
+                    continue
+                StageTrace.recorder.record_counter('cores in use',
+                                                   self.budget.cores - self.budget.free_cores)
+            self.ready.remove(name)
+            self.running += 1
+            worker = threading.Thread(target=self.run_task, args=(task, threads))
+            worker.daemon = True
+            worker.start()
+
+    def run(self, max_jobs=1):
+        """
+        Function to run all tasks of the graph, starting every task as soon as its dependencies
+        have finished, fewer than max_jobs tasks are running and its threads are free.
+
+        :param max_jobs: The maximum number of concurrently running tasks, given as an int.
+        :return: A dictionary of task names and the values returned by their functions.
+        """
+        assert max_jobs >= 1, 'At least one job must be allowed to run.'
+        with self.condition:
+            self.waiting = collections.OrderedDict(
+                (name, set(task.dependencies)) for name, task in self.tasks.items()
+                if task.dependencies)
+            self.ready = [name for name, task in self.tasks.items() if not task.dependencies]
+            while (self.ready and not self.failures) or self.running:
+                self.start_ready_tasks(max_jobs)
+                self.condition.wait()
+        if self.failures:
+            raise RuntimeError('Tasks failed: %s' % ', '.join(self.failures))
+        return self.results
@@ -9,10 +9,17 @@ Contact: henry.ehlers@wur.nl
 A collection of functions designed to split a merged, paired-end FASTQ file into its forward and
 reverse components.
 
-    -Inputs:    [1] Directory of merged, paired-end FASTQ file
+    -Inputs:    [1] Directory of merged, paired-end FASTQ file, plain or gzip/BGZF compressed.
                 [2] Directory of output folder, last level will be created if not present.
                 [3] Overwrite Option: True/False - overwrite existing output files.
-    -Outputs:   [1] Two FASTQ files named output_file_reverse/forward.fastq, saved in the
+                [4] Splitting Engine: block/line - defaults to the block-buffered engine.
+                [5] Workers: number of processes splitting byte ranges in parallel, default 1.
+                [6] Compress Output: True/False - write BGZF compressed .fastq.gz files.
+                [7] Build Index: True/False - save a record offset index (.fqi) of the input.
+                [8] Read Statistics: True/False - save a <sample>_read_statistics.json sidecar.
+                [9] Subsample: None, a fraction below 1 or a number of records to split.
+                [10] Seed: the seed of the subsample, default 0.
+    -Outputs:   [1] Two FASTQ files named output_file_reverse/forward.fastq(.gz), saved in the
                 specified output folder directory.
 
 In order to provide readable and understandable code, the right indentation margin has been
@@ -22,11 +29,40 @@ and function names, as well as more extensive doc-strings.
 """
 
 
+from multiprocessing.pool import ThreadPool
+import multiprocessing
 import subprocess
+import threading
+import binascii
+import struct
+import stat
+import shutil
+import gzip
+import zlib
+import random
 import time
 import sys
 import os
 import re
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import ReadStatistics
+import StageResult
+import FastqIndex
+
+
+BLOCK_SIZE = 1 << 22
+OUTPUT_BUFFER_SIZE = 1 << 22
+CHUNKS_PER_WORKER = 4
+PIPE_QUEUE_DEPTH = 4
+COMPRESSED_EXTENSIONS = ('.gz', '.bgz')
+COMPRESSION_THREADS = 4
+COMPRESSION_LEVEL = 6
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF_MARKER = binascii.unhexlify(b'1f8b08040000000000ff0600424302001b0003000000000000000000')
 
 
 def get_command_line_arguments(default_variable_values):
@@ -96,13 +132,536 @@ def split_record(output_files, header, sequence, quality):
     :param quality: The quality of the merged FASTQ file, given as a string.
     """
     seq_len = len(sequence)
-    header = re.sub(r'length=%s' % seq_len, 'length=%s' % (seq_len/2), header)
-    for index, lengths in enumerate([(0, seq_len/2), (seq_len/2, seq_len)]):
+    header = re.sub(r'length=%s' % seq_len, 'length=%s' % (seq_len // 2), header)
+    for index, lengths in enumerate([(0, seq_len // 2), (seq_len // 2, seq_len)]):
         start, end = lengths
         output = output_files[index]
         output.write('%s\n%s\n+\n%s\n' % (header, sequence[start:end], quality[start:end]))
 
 
+def extract_record_blocks(fast_q_file, block_size=BLOCK_SIZE, byte_count=None,
+                          index_builder=None):
+    """
+    Function to yield the records of a FASTQ file in bulk, reading the file in large binary blocks
+    and cutting each block at its last complete record boundary.
+
+    :param fast_q_file: The open input FASTQ file, opened in binary mode.
+    :param block_size: The number of bytes read from the input file at a time, given as an int.
+    :param byte_count: The number of bytes to read from the current file position, or None to
+    read until the end of the file.
+    :param index_builder: An optional FastqIndexBuilder collecting record offsets on the way.
+    :return: Yields the headers, sequences and qualities of all complete records within a block,
+    as three lists of bytes.
+    """
+    remainder = b''
+    while True:
+        if byte_count is None:
+            block = fast_q_file.read(block_size)
+        else:
+            block = fast_q_file.read(min(block_size, byte_count))
+            byte_count -= len(block)
+        if not block:
+            break
+        lines = (remainder + block).split(b'\n')
+        usable = (len(lines) - 1) // 4 * 4
+        remainder = b'\n'.join(lines[usable:])
+        if usable:
+            if index_builder is not None:
+                index_builder.add_lines(lines[0:usable])
+            yield check_record_block(lines[0:usable])
+    lines = remainder.split(b'\n')
+    while lines and not lines[-1].strip():
+        lines.pop()
+    assert len(lines) % 4 == 0, 'Truncated FASTQ record at the end of the input file.'
+    if lines:
+        if index_builder is not None:
+            index_builder.add_lines(lines)
+        yield check_record_block(lines)
+
+
+def check_record_block(lines):
+    """
+    Function to separate a list of complete FASTQ lines into its headers, sequences and qualities,
+    asserting that every record is well-formed.
+
+    :param lines: The lines of a whole number of FASTQ records, given as a list of bytes.
+    :return: The headers, sequences and qualities of the records, as three lists of bytes.
+    """
+    if b'\r' in lines[0]:
+        lines = [line.rstrip(b'\r') for line in lines]
+    headers, sequences, separators, qualities = lines[0::4], lines[1::4], lines[2::4], lines[3::4]
+    if separators.count(b'+') != len(separators):
+        assert all(line[0:1] == b'+' for line in separators), 'Malformed FASTQ separator line.'
+    assert all(line[0:1] == b'@' for line in headers), 'Malformed FASTQ header line.'
+    return headers, sequences, qualities
+
+
+def split_record_block(output_files, headers, sequences, qualities, length_tokens):
+    """
+    Method to split a block of merged FASTQ records into its forward and reverse components and
+    write each half to its output file in a single call.
+
+    :param output_files: The open forward and reverse output files, opened in binary mode.
+    :param headers: The headers of the merged FASTQ records, given as a list of bytes.
+    :param sequences: The sequences of the merged FASTQ records, given as a list of bytes.
+    :param qualities: The qualities of the merged FASTQ records, given as a list of bytes.
+    :param length_tokens: A dictionary caching the old and new 'length=' header tokens per
+    sequence length, shared between blocks.
+    """
+    forward, reverse = [], []
+    for header, sequence, quality in zip(headers, sequences, qualities):
+        seq_len = len(sequence)
+        try:
+            old_token, new_token = length_tokens[seq_len]
+        except KeyError:
+            old_token, new_token = length_tokens.setdefault(
+                seq_len, (('length=%d' % seq_len).encode('ascii'),
+                          ('length=%d' % (seq_len // 2)).encode('ascii')))
+        header = header.replace(old_token, new_token)
+        half = seq_len // 2
+        forward.extend((header, sequence[:half], b'+', quality[:half]))
+        reverse.extend((header, sequence[half:], b'+', quality[half:]))
+    for output, lines in zip(output_files, (forward, reverse)):
+        lines.append(b'')
+        output.write(b'\n'.join(lines))
+
+
+def compress_bgzf_block(data):
+    """
+    Function to compress a chunk of at most BGZF_BLOCK_SIZE bytes into a single BGZF block, a gzip
+    member carrying its own compressed size in a 'BC' extra field.
+
+    :param data: The uncompressed data, given as bytes.
+    :return: The complete BGZF block, given as bytes.
+    """
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack('<4BI2BH2BHH', 0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6, 66, 67, 2,
+                         len(deflated) + 25)
+    footer = struct.pack('<2I', zlib.crc32(data) & 0xffffffff, len(data))
+    return header + deflated + footer
+
+
+class BgzfWriter(object):
+    """
+    A file-like writer producing BGZF-compressed output. Data is cut into fixed-size blocks that
+    are compressed by a pool of background threads, as zlib releases the GIL, and written to disk
+    in order. The block layout only depends on the data, not on how it was passed to write().
+    """
+
+    def __init__(self, output_path, threads=COMPRESSION_THREADS):
+        """
+        :param output_path: The path of the compressed output file, given as a string.
+        :param threads: The number of compression threads, given as an int.
+        """
+        self.output_file = open(output_path, 'wb', OUTPUT_BUFFER_SIZE)
+        self.pool = ThreadPool(threads)
+        self.max_pending = threads * 4
+        self.pending = []
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        """
+        Method to queue data for compression, submitting every complete block to the thread pool.
+
+        :param data: The uncompressed data, given as bytes.
+        """
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= BGZF_BLOCK_SIZE:
+            data = b''.join(self.buffer)
+            cut = len(data) - len(data) % BGZF_BLOCK_SIZE
+            for start in range(0, cut, BGZF_BLOCK_SIZE):
+                self.submit(data[start:start + BGZF_BLOCK_SIZE])
+            self.buffer = [data[cut:]]
+            self.buffered = len(data) - cut
+
+    def submit(self, block):
+        """
+        Method to hand one block to the compression threads, writing finished blocks in order
+        while too many blocks are in flight.
+
+        :param block: The uncompressed block, given as bytes.
+        """
+        self.pending.append(self.pool.apply_async(compress_bgzf_block, (block,)))
+        while len(self.pending) > self.max_pending:
+            self.output_file.write(self.pending.pop(0).get())
+
+    def close(self):
+        """
+        Method to compress any remaining data, write all pending blocks and the BGZF end-of-file
+        marker, and close the output file.
+        """
+        if self.buffered:
+            self.submit(b''.join(self.buffer))
+            self.buffer, self.buffered = [], 0
+        for result in self.pending:
+            self.output_file.write(result.get())
+        self.pending = []
+        self.pool.close()
+        self.pool.join()
+        self.output_file.write(BGZF_EOF_MARKER)
+        self.output_file.close()
+
+
+class PipeWriter(object):
+    """
+    A file-like writer feeding a named pipe from a background thread. A reader such as hisat2
+    consumes both mates in lockstep, so each pipe needs its own writer: otherwise a full forward
+    pipe would block the splitter while the reader waits for reverse reads. Errors on the pipe,
+    such as the reader exiting, are raised on the next write or on close.
+    """
+
+    def __init__(self, pipe_path):
+        """
+        :param pipe_path: The path of the named pipe, given as a string.
+        """
+        self.pipe_path = pipe_path
+        self.blocks = queue.Queue(PIPE_QUEUE_DEPTH)
+        self.error = None
+        self.thread = threading.Thread(target=self.feed_pipe)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def feed_pipe(self):
+        """
+        Method run by the writer thread, opening the pipe and writing queued blocks until the
+        end-of-data marker None is received.
+        """
+        try:
+            with open(self.pipe_path, 'wb', 0) as pipe:
+                block = self.blocks.get()
+                while block is not None:
+                    pipe.write(block)
+                    block = self.blocks.get()
+        except Exception as error:
+            self.error = error
+
+    def put(self, block):
+        """
+        Method to queue a block for the writer thread, raising the writer's error if it stopped.
+
+        :param block: The data to be written, given as bytes, or None to end the stream.
+        """
+        while True:
+            if self.error is not None:
+                raise IOError('Writing to pipe %s failed: %s' % (self.pipe_path, self.error))
+            try:
+                self.blocks.put(block, True, 1)
+                return
+            except queue.Full:
+                if not self.thread.is_alive():
+                    raise IOError('Writer of pipe %s stopped.' % self.pipe_path)
+
+    def write(self, data):
+        """
+        Method to queue data for the pipe.
+
+        :param data: The data to be written, given as bytes.
+        """
+        self.put(data)
+
+    def close(self):
+        """
+        Method to end the stream and wait until all queued data has been written to the pipe.
+        """
+        self.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise IOError('Writing to pipe %s failed: %s' % (self.pipe_path, self.error))
+
+
+def is_compressed(file_path):
+    """
+    Function to determine whether a FASTQ file is gzip or BGZF compressed.
+
+    :param file_path: The path of the FASTQ file, given as a string.
+    :return: True if the file is compressed, else False.
+    """
+    return file_path.endswith(COMPRESSED_EXTENSIONS)
+
+
+def open_fastq_input(input_path):
+    """
+    Function to open a plain, gzip or BGZF compressed FASTQ file for binary reading.
+
+    :param input_path: The path of the FASTQ file, given as a string.
+    :return: The opened file.
+    """
+    if is_compressed(input_path):
+        return gzip.open(input_path, 'rb')
+    return open(input_path, 'rb', 0)
+
+
+def open_fastq_output(output_path):
+    """
+    Function to open a FASTQ output file for binary writing, compressing to BGZF in background
+    threads if the path has a compressed extension, or feeding it from a background thread if the
+    path is a named pipe.
+
+    :param output_path: The path of the FASTQ file, given as a string.
+    :return: The opened file, BgzfWriter or PipeWriter.
+    """
+    if os.path.exists(output_path) and stat.S_ISFIFO(os.stat(output_path).st_mode):
+        return PipeWriter(output_path)
+    if is_compressed(output_path):
+        return BgzfWriter(output_path)
+    return open(output_path, 'wb', OUTPUT_BUFFER_SIZE)
+
+
+def split_file_by_line(input_path, output_paths):
+    """
+    Method to split a merged FASTQ file line by line, using the original text-based engine.
+
+    :param input_path: The path of the merged, paired-end FASTQ file, given as a string.
+    :param output_paths: The paths of the forward and reverse FASTQ files, given as a list.
+    """
+    output_files = [open(output, 'w') for output in output_paths]
+    input_file = open(input_path, 'r')
+    for header, sequence, quality in extract_record(input_file):
+        split_record(output_files, header, sequence, quality)
+    input_file.close()
+    for single_file in output_files:
+        single_file.close()
+
+
+def keep_sampled_records(headers, sequences, qualities, fraction, seed):
+    """
+    Function to keep a fraction of a block of records. Whether a record is kept only depends on
+    its header and the seed, so both mates stay paired and the sample is the same whichever way
+    the file is divided into blocks or byte ranges.
+
+    :param headers: The headers of the merged FASTQ records, given as a list of bytes.
+    :param sequences: The sequences of the merged FASTQ records, given as a list of bytes.
+    :param qualities: The qualities of the merged FASTQ records, given as a list of bytes.
+    :param fraction: The fraction of records to keep, given as a float between 0 and 1.
+    :param seed: The seed of the sample, given as an int.
+    :return: The headers, sequences and qualities of the kept records, as three lists of bytes.
+    """
+    threshold = int(fraction * 0x100000000)
+    kept = [index for index, header in enumerate(headers)
+            if zlib.crc32(header, seed) & 0xffffffff < threshold]
+    return ([headers[index] for index in kept], [sequences[index] for index in kept],
+            [qualities[index] for index in kept])
+
+
+def reservoir_sample_records(input_path, count, seed):
+    """
+    Function to draw a fixed number of records from a FASTQ file in a single pass, using reservoir
+    sampling. The drawn records are returned in their original file order.
+
+    :param input_path: The path of the merged, paired-end FASTQ file, given as a string.
+    :param count: The number of records to draw, given as an int.
+    :param seed: The seed of the sample, given as an int.
+    :return: The headers, sequences and qualities of the drawn records, as three lists of bytes.
+    """
+    generator = random.Random(seed)
+    reservoir, record_number = [], 0
+    with open_fastq_input(input_path) as input_file:
+        for headers, sequences, qualities in extract_record_blocks(input_file):
+            for record in zip(headers, sequences, qualities):
+                if record_number < count:
+                    reservoir.append((record_number, record))
+                else:
+                    slot = generator.randint(0, record_number)
+                    if slot < count:
+                        reservoir[slot] = (record_number, record)
+                record_number += 1
+    records = [record for _, record in sorted(reservoir, key=lambda item: item[0])]
+    return [list(column) for column in zip(*records)] or [[], [], []]
+
+
+def split_sampled_records(input_path, output_paths, count, seed, collect_statistics=False):
+    """
+    Function to split a fixed number of records, drawn by reservoir sampling, of a merged FASTQ
+    file.
+
+    :param input_path: The path of the merged, paired-end FASTQ file, given as a string.
+    :param output_paths: The paths of the forward and reverse FASTQ files, given as a list.
+    :param count: The number of records to draw, given as an int.
+    :param seed: The seed of the sample, given as an int.
+    :param collect_statistics: Whether to collect the read statistics of the drawn records.
+    :return: The ReadStatistics of the drawn records, or None if not collected.
+    """
+    headers, sequences, qualities = reservoir_sample_records(input_path, count, seed)
+    output_files = [open_fastq_output(output) for output in output_paths]
+    split_record_block(output_files, headers, sequences, qualities, {})
+    for single_file in output_files:
+        single_file.close()
+    if collect_statistics:
+        statistics = ReadStatistics.ReadStatistics()
+        statistics.update(sequences, qualities)
+        return statistics
+
+
+def split_file_by_block(input_path, output_paths, start=0, end=None, index_interval=0,
+                        collect_statistics=False, sample_fraction=None, seed=0):
+    """
+    Function to split a merged FASTQ file using the block-buffered, byte-level engine.
+
+    :param input_path: The path of the merged, paired-end FASTQ file, given as a string.
+    :param output_paths: The paths of the forward and reverse FASTQ files, given as a list.
+    :param start: The byte offset of the first record to split, given as an int.
+    :param end: The byte offset at which to stop splitting, or None to split until the end of the
+    file. Both offsets must lie on record boundaries.
+    :param index_interval: If non-zero, the offset of every N-th record is collected on the way.
+    :param collect_statistics: Whether to collect the read statistics of the split range.
+    :param sample_fraction: If given, only this fraction of the records is split.
+    :param seed: The seed of the sample, given as an int.
+    :return: The FastqIndex of the split range, with record numbers counted from its start, and
+    its ReadStatistics, each None if not collected.
+    """
+    length_tokens = {}
+    byte_count = None if end is None else end - start
+    index_builder, statistics = None, None
+    if index_interval:
+        index_builder = FastqIndex.FastqIndexBuilder(index_interval, start)
+    if collect_statistics:
+        statistics = ReadStatistics.ReadStatistics()
+    output_files = [open_fastq_output(output) for output in output_paths]
+    file_size = end
+    with open_fastq_input(input_path) as input_file:
+        if start:
+            input_file.seek(start)
+        for headers, sequences, qualities in extract_record_blocks(input_file, BLOCK_SIZE,
+                                                                   byte_count, index_builder):
+            if sample_fraction is not None:
+                headers, sequences, qualities = keep_sampled_records(
+                    headers, sequences, qualities, sample_fraction, seed)
+            split_record_block(output_files, headers, sequences, qualities, length_tokens)
+            if statistics is not None:
+                statistics.update(sequences, qualities)
+        if end is None:
+            # The size of the file itself, as the records lack a final newline in some files.
+            file_size = input_file.tell() if is_compressed(input_path) else \
+                os.fstat(input_file.fileno()).st_size
+    for single_file in output_files:
+        single_file.close()
+    index = None
+    if index_builder is not None:
+        index = index_builder.get_index(file_size)
+    return index, statistics
+
+
+def find_record_start(fast_q_file, offset):
+    """
+    Function to move a byte offset forward to the start of the next FASTQ record. A line starting
+    with '@' is only accepted as a header if the line two below it starts with '+' and the sequence
+    and quality lines are of equal length, as quality lines may also start with '@'.
+
+    :param fast_q_file: The open input FASTQ file, opened in binary mode.
+    :param offset: The byte offset from which to search, given as an int.
+    :return: The byte offset of the next record start, or the file size if there is none.
+    """
+    if offset <= 0:
+        return 0
+    fast_q_file.seek(offset - 1)
+    fast_q_file.readline()
+    positions, lines = [], []
+    while True:
+        positions.append(fast_q_file.tell())
+        lines.append(fast_q_file.readline())
+        if len(lines) < 4:
+            if not lines[-1]:
+                return positions[-1]
+            continue
+        header, sequence, separator, quality = lines[-4:]
+        if header[0:1] == b'@' and separator[0:1] == b'+' and \
+                len(sequence.rstrip()) == len(quality.rstrip()):
+            return positions[-4]
+        if not lines[-1]:
+            return positions[-1]
+
+
+def find_chunk_boundaries(input_path, chunk_count):
+    """
+    Function to divide a FASTQ file into byte ranges of roughly equal size, each starting and
+    ending on a record boundary.
+
+    :param input_path: The path of the merged, paired-end FASTQ file, given as a string.
+    :param chunk_count: The number of byte ranges to divide the file into, given as an int.
+    :return: A list of (start, end) byte offsets, given in file order.
+    """
+    file_size = os.path.getsize(input_path)
+    with open(input_path, 'rb') as input_file:
+        starts = [find_record_start(input_file, file_size * index // chunk_count)
+                  for index in range(chunk_count)]
+    boundaries = sorted(set(starts + [file_size]))
+    return [(start, end) for start, end in zip(boundaries[:-1], boundaries[1:])]
+
+
+def split_chunk(arguments):
+    """
+    Function used by the process pool to split a single byte range into its own part files.
+
+    :param arguments: The arguments of split_file_by_block, given as a tuple.
+    :return: The FastqIndex and ReadStatistics of the byte range, each None if not collected.
+    """
+    return split_file_by_block(*arguments)
+
+
+def concatenate_files(part_paths, output_path):
+    """
+    Method to join a list of files, in order, into a single output file and remove the parts.
+
+    :param part_paths: The paths of the files to be joined, given as a list of strings.
+    :param output_path: The path of the joined output file, given as a string.
+    """
+    output_file = open_fastq_output(output_path)
+    for part_path in part_paths:
+        with open(part_path, 'rb') as part_file:
+            shutil.copyfileobj(part_file, output_file, OUTPUT_BUFFER_SIZE)
+        os.remove(part_path)
+    output_file.close()
+
+
+def split_file_in_parallel(input_path, output_paths, workers, index_interval=0,
+                           collect_statistics=False, sample_fraction=None, seed=0):
+    """
+    Function to split a merged FASTQ file with a pool of processes, each running the block engine
+    on its own byte range. The parts are written uncompressed and joined in order, compressing them
+    on the way if requested, so the output is identical to that of split_file_by_block.
+
+    :param input_path: The path of the merged, paired-end FASTQ file, given as a string.
+    :param output_paths: The paths of the forward and reverse FASTQ files, given as a list.
+    :param workers: The number of processes to split with, given as an int.
+    :param index_interval: If non-zero, the offset of every N-th record is collected on the way.
+    :param collect_statistics: Whether to collect the read statistics of the input file.
+    :param sample_fraction: If given, only this fraction of the records is split.
+    :param seed: The seed of the sample, given as an int.
+    :return: The FastqIndex and ReadStatistics of the input file, each None if not collected.
+    """
+    existing_index = FastqIndex.load_fastq_index(input_path)
+    if existing_index is not None:
+        chunks = existing_index.get_chunk_boundaries(workers * CHUNKS_PER_WORKER)
+    else:
+        chunks = find_chunk_boundaries(input_path, workers * CHUNKS_PER_WORKER)
+    part_paths = [['%s.part%04d' % (output, index) for output in output_paths]
+                  for index in range(len(chunks))]
+    tasks = [(input_path, parts, start, end, index_interval, collect_statistics, sample_fraction,
+              seed) for parts, (start, end) in zip(part_paths, chunks)]
+    pool = multiprocessing.Pool(workers)
+    try:
+        chunk_results = pool.map(split_chunk, tasks, 1)
+    finally:
+        pool.close()
+        pool.join()
+    for index, output in enumerate(output_paths):
+        concatenate_files([parts[index] for parts in part_paths], output)
+    index, statistics = None, None
+    if index_interval:
+        index = FastqIndex.FastqIndex.merge([result[0] for result in chunk_results])
+    if collect_statistics:
+        statistics = ReadStatistics.ReadStatistics()
+        for result in chunk_results:
+            statistics.merge(result[1])
+    return index, statistics
+
+
+SPLITTING_ENGINES = {'line': split_file_by_line, 'block': split_file_by_block}
+
+
 def create_empty_folder(folder_path):
     """
     Method to create an empty folder to store the files.
@@ -110,19 +669,25 @@ def create_empty_folder(folder_path):
     :param folder_path: The name of the folder to be created.
     """
     if not os.path.exists(folder_path):
-        execute_on_command_line('mkdir %s' % folder_path)
+        execute_on_command_line('mkdir -p %s' % folder_path)
 
 
-def generate_output_paths(input_path, folder_path):
+def generate_output_paths(input_path, folder_path, compress_output=False):
     """
     Function generate the output paths of the output files using the input file and output folder.
 
     :param input_path: The path of the input file, given as a string.
     :param folder_path: The name of the output folder, given as a string.
+    :param compress_output: Whether the output files are BGZF compressed, adding '.gz'.
     :return: The output paths of forward and reverse FASTQ files, given as a list of strings.
     """
-    split_name = re.split('\.|/', input_path)
+    for compressed_extension in COMPRESSED_EXTENSIONS:
+        if input_path.endswith(compressed_extension):
+            input_path = input_path[0:-len(compressed_extension)]
+    split_name = re.split(r'\.|/', input_path)
     extension = split_name[-1]
+    if compress_output:
+        extension += '.gz'
     output_paths = ['', '']
     for index, name in enumerate(['forward', 'reverse']):
         output_paths[index] = '%s/%s_%s.%s' %\
@@ -130,35 +695,95 @@ def generate_output_paths(input_path, folder_path):
     return output_paths
 
 
-def split_merged_data_set(input_path, output_directory, overwrite=True):
+def split_merged_data_set(input_path, output_directory, overwrite=True, engine='block',
+                          workers=1, compress_output=False, build_index=False,
+                          collect_statistics=False, subsample=None, seed=0):
     """
-    Method to split a merged, paired-end FASTQ read files into separate forward and reverse
+    Function to split a merged, paired-end FASTQ read files into separate forward and reverse
     FASTQ files.
 
     :param input_path: The path of the merged, paired-end FASTQ file, given as a string.
     :param output_directory: The director of the output folder, given as a string.
     :param overwrite: A setting to overwrite existing split data stored in the same path.
+    :param engine: The splitting engine to use, either 'block' (default) or 'line'.
+    :param workers: The number of processes to split with. Values above one split byte ranges of
+    the input in parallel, which requires the block engine and uncompressed input.
+    :param compress_output: Whether to write BGZF compressed forward and reverse files.
+    :param build_index: Whether to save a record offset index of the input file, collected while
+    splitting, next to it as <input_path>.fqi.
+    :param collect_statistics: Whether to collect read statistics while splitting and save them
+    next to the split files as <sample>_read_statistics.json.
+    :param subsample: If given, only a subsample of the records is split: a float below one keeps
+    that fraction of the records, a whole number of one or more draws that many records.
+    :param seed: The seed of the subsample. The same seed always gives the same records.
+    :return: The StageResult of the split, listing the forward and reverse files followed by the
+    index and statistics files, if any.
     """
     assert isinstance(input_path, str), 'Input Path must be of type string.'
     assert isinstance(output_directory, str), 'Output Folder name must be of type string.'
+    assert engine in SPLITTING_ENGINES, 'Unknown splitting engine "%s".' % engine
+    assert workers == 1 or engine == 'block', 'Parallel splitting requires the block engine.'
+    assert engine == 'block' or not (is_compressed(input_path) or compress_output), \
+        'Compressed input and output require the block engine.'
+    assert engine == 'block' or not (build_index or collect_statistics or subsample), \
+        'Indexing, statistics and subsampling require the block engine.'
+    assert subsample is None or subsample > 0, 'The subsample must be a positive number.'
     create_empty_folder(output_directory)
-    output_paths = generate_output_paths(input_path, output_directory)
+    output_paths = generate_output_paths(input_path, output_directory, compress_output)
     print('Checking Directories...')
     if not all(os.path.exists(path) for path in output_paths) or overwrite:
         print('Started paired-end read file splitting.')
-        start_time = time.clock()
-        output_files = [open(output, 'w') for output in output_paths]
-        input_file = open(input_path, 'r')
-        for header, sequence, quality in extract_record(input_file):
-            split_record(output_files, header, sequence, quality)
-        input_file.close()
-        for single_file in output_files:
-            single_file.close()
-        print('Completed paired-end read file splitting in %s seconds.' % (time.clock() - start_time))
-    else:
-        print('Splitting Aborted. Files already present and not overwritten.')
+        start_time = time.time()
+        index_interval = FastqIndex.DEFAULT_INTERVAL if build_index else 0
+        sample_fraction = subsample if subsample is not None and subsample < 1 else None
+        if workers > 1 and is_compressed(input_path):
+            print('Compressed input cannot be split in byte ranges, splitting serially.')
+        # The split files are written to a partial folder and moved into place when complete, so
+        # an interrupted split never leaves truncated files under the final names.
+        partial_folder = '%s/.partial_%s' % (output_directory, os.path.basename(output_paths[0]))
+        if os.path.exists(partial_folder):
+            shutil.rmtree(partial_folder)
+        os.makedirs(partial_folder)
+        partial_paths = ['%s/%s' % (partial_folder, os.path.basename(path))
+                         for path in output_paths]
+        try:
+            if subsample is not None and subsample >= 1:
+                print('Drawing %d records from %s.' % (subsample, input_path))
+                index = None
+                statistics = split_sampled_records(input_path, partial_paths, int(subsample), seed,
+                                                   collect_statistics)
+            elif workers > 1 and not is_compressed(input_path):
+                index, statistics = split_file_in_parallel(input_path, partial_paths, workers,
+                                                           index_interval, collect_statistics,
+                                                           sample_fraction, seed)
+            elif engine == 'block':
+                index, statistics = split_file_by_block(input_path, partial_paths, 0, None,
+                                                        index_interval, collect_statistics,
+                                                        sample_fraction, seed)
+            else:
+                index, statistics = SPLITTING_ENGINES[engine](input_path, partial_paths), None
+            for partial_path, output_path in zip(partial_paths, output_paths):
+                os.rename(partial_path, output_path)
+        finally:
+            shutil.rmtree(partial_folder)
+        if index is not None:
+            output_paths.append(FastqIndex.get_index_path(input_path))
+            index.save(output_paths[-1])
+        if statistics is not None:
+            output_paths.append(ReadStatistics.get_statistics_path(output_paths[0]))
+            statistics.save(output_paths[-1])
+        elapsed_time = time.time() - start_time
+        print('Completed paired-end read file splitting in %s seconds.' % elapsed_time)
+        return StageResult.StageResult('split', output_paths, elapsed_time)
+    print('Splitting Aborted. Files already present and not overwritten.')
+    return StageResult.skip_stage('split', output_paths)
 
 
 if __name__ == '__main__':
-    input_file_path, output_folder_path, overwrite = get_command_line_arguments(['', '', False])
-    split_merged_data_set(input_file_path, output_folder_path, overwrite)
+    input_file_path, output_folder_path, overwrite, engine, workers, compress_output, \
+        build_index, collect_statistics, subsample, seed = \
+        get_command_line_arguments(['', '', False, 'block', 1, False, False, False, 'None', 0])
+    split_merged_data_set(input_file_path, output_folder_path, str(overwrite) == 'True', engine,
+                          int(workers), str(compress_output) == 'True', str(build_index) == 'True',
+                          str(collect_statistics) == 'True',
+                          None if subsample == 'None' else float(subsample), int(seed))
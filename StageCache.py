@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A cache designed to decide whether a stage of the pipeline has to be run, replacing checks for
+the mere existence of its output. Every stage is keyed on a fingerprint of its input files, the
+function and parameters it is run with and the versions of the tools it calls. After a stage has
+run, the key and the fingerprints of the produced files are recorded; the stage is skipped only
+while its key is unchanged and all of its recorded outputs are still present and unchanged.
+    -Outputs:   [1] One JSON record per stage, saved as <cache_folder>/<stage>.json.
+
+A file fingerprint hashes its size, its modification time and a few blocks sampled from its
+start, middle and end, so that large FASTQ and BAM files are fingerprinted without being read in
+full. Folders are fingerprinted by the names and fingerprints of the files they contain.
+
+Given a RunJournal, every transition of a stage is also appended to the run journal, and stages a
+resumed run already finished are skipped without computing their key.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import subprocess
+import threading
+import hashlib
+import json
+import os
+import re
+
+
+SAMPLE_BLOCK_SIZE = 1 << 16
+SAMPLED_BLOCKS = 3
+UNKNOWN_VERSION = 'unknown'
+
+tool_versions = {}
+tool_versions_lock = threading.Lock()
+
+
+def fingerprint_file(file_path):
+    """
+    Function to fingerprint a file from its size, modification time and sampled blocks.
+
+    :param file_path: The path of the file, given as a string.
+    :return: The hexadecimal fingerprint, given as a string.
+    """
+    file_stat = os.stat(file_path)
+    digest = hashlib.sha1(('%s %r' % (file_stat.st_size, file_stat.st_mtime)).encode('ascii'))
+    with open(file_path, 'rb') as input_file:
+        if file_stat.st_size <= SAMPLE_BLOCK_SIZE * SAMPLED_BLOCKS:
+            digest.update(input_file.read())
+        else:
+            last_block = file_stat.st_size - SAMPLE_BLOCK_SIZE
+            for block in range(SAMPLED_BLOCKS):
+                input_file.seek(last_block * block // (SAMPLED_BLOCKS - 1))
+                digest.update(input_file.read(SAMPLE_BLOCK_SIZE))
+    return digest.hexdigest()
+
+
+def fingerprint_path(path):
+    """
+    Function to fingerprint a file, or a folder by the relative names and fingerprints of all
+    files below it.
+
+    :param path: The path of the file or folder, given as a string.
+    :return: The hexadecimal fingerprint, given as a string, or None if the path does not exist.
+    """
+    if os.path.isfile(path):
+        return fingerprint_file(path)
+    if not os.path.isdir(path):
+        return None
+    digest = hashlib.sha1()
+    for folder, folder_names, file_names in os.walk(path):
+        folder_names.sort()
+        for file_name in sorted(file_names):
+            file_path = os.path.join(folder, file_name)
+            digest.update(('%s %s\n' % (os.path.relpath(file_path, path),
+                                        fingerprint_file(file_path))).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_tool_version(tool):
+    """
+    Function to get the version of a command line tool from the first line of its version output
+    mentioning a version, asking each tool only once.
+
+    :param tool: The name of the tool, given as a string.
+    :return: The version line, given as a string, or 'unknown' if the tool could not be run.
+    """
+    with tool_versions_lock:
+        if tool not in tool_versions:
+            try:
+                process = subprocess.Popen([tool, '--version'], stdout=subprocess.PIPE,
+                                           stderr=subprocess.STDOUT)
+                output = process.communicate()[0].decode('utf-8', 'replace')
+                lines = [line.strip() for line in output.splitlines() if line.strip()]
+                version_lines = [line for line in lines if 'version' in line.lower()]
+                tool_versions[tool] = (version_lines or lines or [UNKNOWN_VERSION])[0]
+            except OSError:
+                tool_versions[tool] = UNKNOWN_VERSION
+        return tool_versions[tool]
+
+
+class StageCache(object):
+    """
+    Records the key and produced outputs of every stage that has run, and decides which stages are
+    up to date.
+    """
+
+    def __init__(self, cache_folder, force=False, journal=None):
+        """
+        :param cache_folder: The folder holding the stage records, given as a string.
+        :param force: Whether to run every stage regardless of its record.
+        :param journal: The RunJournal.RunJournal recording the stage transitions, or None.
+        """
+        self.cache_folder = cache_folder
+        self.force = force
+        self.journal = journal
+        if not os.path.exists(cache_folder):
+            os.makedirs(cache_folder)
+
+    def get_record_path(self, name):
+        """
+        Function to generate the path of the record of a stage.
+
+        :param name: The name of the stage, given as a string.
+        :return: The path of the JSON record, given as a string.
+        """
+        return '%s/%s.json' % (self.cache_folder, re.sub(r'[^\w.-]', '_', name))
+
+    @staticmethod
+    def get_key(input_paths, function, arguments, tools):
+        """
+        Function to compute the key of a stage from its inputs, parameters and tool versions.
+
+        :param input_paths: The paths of the input files or folders, given as a list of strings.
+        :param function: The function running the stage.
+        :param arguments: The arguments of the function, given as a tuple.
+        :param tools: The names of the command line tools the stage calls, given as a list.
+        :return: The hexadecimal key, given as a string.
+        """
+        description = {'function': '%s.%s' % (function.__module__, function.__name__),
+                       'arguments': repr(tuple(arguments)),
+                       'inputs': [[path, fingerprint_path(path)] for path in input_paths],
+                       'tools': [[tool, get_tool_version(tool)] for tool in tools]}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def load_record(self, name):
+        """
+        Function to read the record of a stage.
+
+        :param name: The name of the stage, given as a string.
+        :return: The record, given as a dictionary, or None if the stage has no record.
+        """
+        record_path = self.get_record_path(name)
+        if not os.path.exists(record_path):
+            return None
+        with open(record_path) as record_file:
+            return json.load(record_file)
+
+    def is_up_to_date(self, name, key):
+        """
+        Function to check whether a stage ran with the same key and its outputs are unchanged.
+
+        :param name: The name of the stage, given as a string.
+        :param key: The current key of the stage, given as a string.
+        :return: True if the stage can be skipped, False otherwise.
+        """
+        record = self.load_record(name)
+        if self.force or record is None or record['key'] != key:
+            return False
+        return all(fingerprint_path(path) == fingerprint for path, fingerprint in
+                   record['outputs'])
+
+    def save_record(self, name, key, output_paths):
+        """
+        Method to record the key and the fingerprints of the outputs of a stage that has run.
+
+        :param name: The name of the stage, given as a string.
+        :param key: The key the stage ran with, given as a string.
+        :param output_paths: The paths of the produced files or folders, given as a list.
+        """
+        outputs = [[path, fingerprint_path(path)] for path in output_paths]
+        missing = [path for path, fingerprint in outputs if fingerprint is None]
+        if missing:
+            raise IOError('Stage %s did not produce %s.' % (name, ', '.join(missing)))
+        record_path = self.get_record_path(name)
+        with open('%s.tmp' % record_path, 'w') as record_file:
+            json.dump({'name': name, 'key': key, 'outputs': outputs}, record_file, indent=2)
+        os.rename('%s.tmp' % record_path, record_path)
+
+    def invalidate(self, name):
+        """
+        Method to remove the record of a stage, so that it is run again.
+
+        :param name: The name of the stage, given as a string.
+        """
+        record_path = self.get_record_path(name)
+        if os.path.exists(record_path):
+            os.remove(record_path)
+
+    def run_stage(self, name, input_paths, output_paths, tools, function, arguments=(),
+                  **keyword_arguments):
+        """
+        Function to run a stage unless it is up to date, recording its outputs afterwards. Keyword
+        arguments, such as a granted number of threads, are passed to the function but are not
+        part of the key.
+
+        :param name: The name of the stage, given as a string.
+        :param input_paths: The paths of the input files or folders, given as a list of strings.
+        :param output_paths: The paths of the produced files or folders, given as a list.
+        :param tools: The names of the command line tools the stage calls, given as a list.
+        :param function: The function running the stage.
+        :param arguments: The arguments of the function, given as a tuple.
+        :return: The value returned by the function, or None if the stage was skipped.
+        """
+        if self.journal is not None and self.journal.is_finished(name, output_paths):
+            print('Stage %s was finished before the run was resumed. Skipped.' % name)
+            self.journal.record(name, 'resumed')
+            return None
+        key = self.get_key(input_paths, function, arguments, tools)
+        if self.is_up_to_date(name, key):
+            print('Stage %s is up to date. Skipped.' % name)
+            if self.journal is not None:
+                self.journal.record(name, 'skipped')
+            return None
+        self.invalidate(name)
+        if self.journal is not None:
+            self.journal.start(name, output_paths)
+        try:
+            result = function(*arguments, **keyword_arguments)
+            self.save_record(name, key, output_paths)
+        except BaseException as error:
+            if self.journal is not None:
+                self.journal.record(name, 'failed', error=str(error).strip().split('\n')[-1])
+            raise
+        if self.journal is not None:
+            self.journal.record(name, 'finished',
+                                elapsed_time=round(getattr(result, 'elapsed_time', 0.0), 3))
+        return result
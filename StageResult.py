@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A collection of functions designed to give the stages of the pipeline a common, structured
+result: the stage that ran, the files it produced, how long it took, the command it ran, its
+exit status and the resources the command used. The stage scripts return these from their
+importable functions, so the pipeline can call them in-process, while their command lines remain
+thin wrappers around the same functions.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import subprocess
+import time
+
+import StageTrace
+
+
+class StageResult(object):
+    """
+    The outcome of a single run of a stage.
+    """
+
+    def __init__(self, stage, output_paths, elapsed_time=0.0, exit_status=0, command=None,
+                 skipped=False, usage=None):
+        """
+        :param stage: The name of the stage, given as a string.
+        :param output_paths: The paths of the files or folders produced, given as a list.
+        :param elapsed_time: The wall time of the stage in seconds, given as a float.
+        :param exit_status: The exit status of the command, 0 on success.
+        :param command: The command line run by the stage, or None for in-process stages.
+        :param skipped: Whether the stage was skipped because its outputs were already present.
+        :param usage: The CPU time, peak memory and I/O of the command, see StageTrace.get_usage.
+        """
+        self.stage = stage
+        self.output_paths = list(output_paths)
+        self.elapsed_time = elapsed_time
+        self.exit_status = exit_status
+        self.command = command
+        self.skipped = skipped
+        self.usage = usage or {}
+
+    def to_dictionary(self):
+        """
+        Function to summarise the result as a JSON-compatible dictionary.
+
+        :return: The fields of the result, given as a dictionary.
+        """
+        return {'stage': self.stage, 'output_paths': self.output_paths,
+                'elapsed_time': round(self.elapsed_time, 3), 'exit_status': self.exit_status,
+                'command': self.command, 'skipped': self.skipped, 'usage': self.usage}
+
+    def __repr__(self):
+        return 'StageResult(%r, %r, elapsed_time=%.1f, exit_status=%s, skipped=%s)' % (
+            self.stage, self.output_paths, self.elapsed_time, self.exit_status, self.skipped)
+
+
+class StageError(RuntimeError):
+    """
+    Raised when the command of a stage exits with a non-zero status, carrying its StageResult.
+    """
+
+    def __init__(self, result):
+        """
+        :param result: The StageResult of the failed stage.
+        """
+        RuntimeError.__init__(self, 'Stage %s failed with exit status %s: %s' % (
+            result.stage, result.exit_status, result.command))
+        self.result = result
+
+
+def run_command(stage, cmd_string, output_paths):
+    """
+    Function to run the command line of a stage and time it.
+
+    :param stage: The name of the stage, given as a string.
+    :param cmd_string: The formatted string to be executed.
+    :param output_paths: The paths of the files or folders the command produces, given as a list.
+    :return: The StageResult of the command.
+    """
+    assert isinstance(cmd_string, str), 'Command Line String must be of type string.'
+    start_time = time.time()
+    exit_status, usage = StageTrace.wait_for_process(subprocess.Popen(cmd_string, shell=True))
+    end_time = time.time()
+    StageTrace.recorder.record_command(stage, cmd_string, start_time, end_time, usage,
+                                       exit_status)
+    result = StageResult(stage, output_paths, end_time - start_time, exit_status, cmd_string,
+                         usage=usage)
+    if exit_status != 0:
+        raise StageError(result)
+    return result
+
+
+def run_pipe(stage, cmd_strings, output_paths):
+    """
+    Function to run a chain of command lines, each reading the standard output of the previous
+    one, and time it. The chain fails if any of its commands fails.
+
+    :param stage: The name of the stage, given as a string.
+    :param cmd_strings: The formatted strings to be executed, given as a list in pipe order.
+    :param output_paths: The paths of the files or folders the chain produces, given as a list.
+    :return: The StageResult of the chain.
+    """
+    start_time = time.time()
+    processes, previous_output = [], None
+    for index, cmd_string in enumerate(cmd_strings):
+        stdout = subprocess.PIPE if index < len(cmd_strings) - 1 else None
+        processes.append(subprocess.Popen(cmd_string, shell=True, stdin=previous_output,
+                                          stdout=stdout))
+        if previous_output is not None:
+            previous_output.close()
+        previous_output = processes[-1].stdout
+    waits = [StageTrace.wait_for_process(process) for process in reversed(processes)][::-1]
+    end_time = time.time()
+    for cmd_string, (status, usage) in zip(cmd_strings, waits):
+        StageTrace.recorder.record_command(stage, cmd_string, start_time, end_time, usage, status)
+    exit_status = ([status for status, usage in waits if status != 0] or [0])[0]
+    result = StageResult(stage, output_paths, end_time - start_time, exit_status,
+                         ' | '.join(cmd_strings),
+                         usage=StageTrace.add_usages([usage for status, usage in waits]))
+    if exit_status != 0:
+        raise StageError(result)
+    return result
+
+
+def run_parallel(stage, cmd_strings, output_paths):
+    """
+    Function to run independent command lines side by side and time them. The stage fails if
+    any of its commands fails, once all of them have finished.
+
+    :param stage: The name of the stage, given as a string.
+    :param cmd_strings: The formatted strings to be executed, given as a list.
+    :param output_paths: The paths of the files or folders the commands produce, given as a list.
+    :return: The StageResult of the commands.
+    """
+    start_time = time.time()
+    processes = [subprocess.Popen(cmd_string, shell=True) for cmd_string in cmd_strings]
+    waits = []
+    for cmd_string, process in zip(cmd_strings, processes):
+        waits.append(StageTrace.wait_for_process(process))
+        StageTrace.recorder.record_command(stage, cmd_string, start_time, time.time(),
+                                           waits[-1][1], waits[-1][0])
+    end_time = time.time()
+    exit_status = ([status for status, usage in waits if status != 0] or [0])[0]
+    result = StageResult(stage, output_paths, end_time - start_time, exit_status,
+                         '; '.join(cmd_strings),
+                         usage=StageTrace.add_usages([usage for status, usage in waits]))
+    if exit_status != 0:
+        raise StageError(result)
+    return result
+
+
+def skip_stage(stage, output_paths):
+    """
+    Function to describe a stage that was not run because its outputs were already present.
+
+    :param stage: The name of the stage, given as a string.
+    :param output_paths: The paths of the files or folders already present, given as a list.
+    :return: The StageResult of the skipped stage.
+    """
+    return StageResult(stage, output_paths, skipped=True)
@@ -0,0 +1,274 @@
+#!/usr/bin/env python
+
+
+"""
+Author: Henry Ehlers
+WUR_Number: 921013218060
+
+A collection of functions designed to record where the wall time, CPU time, memory and I/O of a
+pipeline run go. Every task of the task graph is recorded as a span, and within it every external
+command and child process with the resources it used, as reported by wait4 and getrusage: CPU
+time, peak resident memory and the bytes read from and written to block devices. The number of
+cores in use is recorded as a counter whenever it changes.
+    -Outputs:   [1] A Chrome trace JSON timeline, to be opened in chrome://tracing or Perfetto.
+                [2] A summary table of the tasks, marking the critical path and the idle cores.
+
+Spans are laid out on numbered slots, a task taking the lowest free slot, so the timeline shows
+at a glance how many tasks ran at once. The critical path is followed backwards from the task that
+finished last, through the dependency of every task that finished last.
+
+In order to provide readable and understandable code, the right indentation margin has been
+increased from 79 to 99 characters, which remains in line with Python-Style-Recommendation (
+https://www.python.org/dev/peps/pep-0008/) .This allows for longer, more descriptive variable
+and function names, as well as more extensive doc-strings.
+"""
+
+
+import threading
+import resource
+import json
+import time
+import os
+
+
+BLOCK_SIZE = 512
+MEGABYTE = 1 << 20
+
+
+def get_usage(rusage, children_rusage=None):
+    """
+    Function to summarise the resource usage of a process, optionally adding that of its children.
+
+    :param rusage: The resource usage, as returned by os.wait4 or resource.getrusage.
+    :param children_rusage: The resource usage of the children of the process, or None.
+    :return: A dictionary of the CPU seconds, the peak resident memory in megabytes and the bytes
+    read and written.
+    """
+    usages = [rusage] + ([children_rusage] if children_rusage is not None else [])
+    return {'cpu_time': round(sum(usage.ru_utime + usage.ru_stime for usage in usages), 3),
+            'max_rss': round(max(usage.ru_maxrss for usage in usages) / 1024.0, 1),
+            'read_bytes': sum(usage.ru_inblock for usage in usages) * BLOCK_SIZE,
+            'write_bytes': sum(usage.ru_oublock for usage in usages) * BLOCK_SIZE}
+
+
+def get_process_usage():
+    """
+    Function to summarise the resource usage of the current process and its finished children,
+    for use in a child process that is about to report back.
+
+    :return: A dictionary of the CPU seconds, peak resident memory and bytes read and written.
+    """
+    return get_usage(resource.getrusage(resource.RUSAGE_SELF),
+                     resource.getrusage(resource.RUSAGE_CHILDREN))
+
+
+def add_usages(usages):
+    """
+    Function to add up the resource usage of processes that ran side by side.
+
+    :param usages: The usage dictionaries, as returned by get_usage, given as a list.
+    :return: The combined usage; as the processes ran at the same time, their peak memory adds up.
+    """
+    total = {'cpu_time': 0.0, 'max_rss': 0.0, 'read_bytes': 0, 'write_bytes': 0}
+    for usage in usages:
+        for name in total:
+            total[name] += usage.get(name, 0)
+    total['cpu_time'] = round(total['cpu_time'], 3)
+    return total
+
+
+def wait_for_process(process, options=0):
+    """
+    Function to wait for a subprocess.Popen with os.wait4, collecting its resource usage.
+
+    :param process: The subprocess.Popen to wait for.
+    :param options: The options of os.wait4, such as os.WNOHANG to not block.
+    :return: The exit status, negative if killed by a signal, and the usage dictionary, or None
+    and None if the process is still running.
+    """
+    pid, status, rusage = os.wait4(process.pid, options)
+    if pid == 0:
+        return None, None
+    if os.WIFSIGNALED(status):
+        process.returncode = -os.WTERMSIG(status)
+    else:
+        process.returncode = os.WEXITSTATUS(status)
+    return process.returncode, get_usage(rusage)
+
+
+class TraceRecorder(object):
+    """
+    Collects the spans and counters of a run from all threads.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start_time = time.time()
+        self.tasks = []
+        self.commands = []
+        self.counters = []
+        self.busy_slots = set()
+
+    def begin_task(self, name):
+        """
+        Method to mark the start of a task in the calling thread, taking the lowest free slot.
+
+        :param name: The name of the task, given as a string.
+        """
+        with self.lock:
+            slot = 0
+            while slot in self.busy_slots:
+                slot += 1
+            self.busy_slots.add(slot)
+        self.local.task, self.local.slot = name, slot
+
+    def end_task(self, name, start_time, threads=0, dependencies=(), failed=False):
+        """
+        Method to record the span of the task running in the calling thread and free its slot.
+
+        :param name: The name of the task, given as a string.
+        :param start_time: The time the task started, as given by time.time().
+        :param threads: The number of threads granted to the task.
+        :param dependencies: The names of the tasks it depended on, given as a list.
+        :param failed: Whether the task raised an exception.
+        """
+        slot = getattr(self.local, 'slot', 0)
+        with self.lock:
+            self.tasks.append({'name': name, 'start_time': start_time, 'end_time': time.time(),
+                               'slot': slot, 'threads': threads,
+                               'dependencies': list(dependencies), 'failed': failed})
+            self.busy_slots.discard(slot)
+        self.local.task, self.local.slot = None, 0
+
+    def record_command(self, name, command, start_time, end_time, usage, exit_status=0):
+        """
+        Method to record an external command or child process run by the calling thread's task.
+
+        :param name: The name of the stage running the command, given as a string.
+        :param command: The command line, or the name of the function run in a child process.
+        :param start_time: The time the command started, as given by time.time().
+        :param end_time: The time the command finished, as given by time.time().
+        :param usage: The resources used by the command, as returned by get_usage.
+        :param exit_status: The exit status of the command.
+        """
+        with self.lock:
+            self.commands.append({'name': name, 'command': command, 'start_time': start_time,
+                                  'end_time': end_time, 'usage': usage or {},
+                                  'exit_status': exit_status,
+                                  'task': getattr(self.local, 'task', None),
+                                  'slot': getattr(self.local, 'slot', 0)})
+
+    def record_counter(self, name, value):
+        """
+        Method to record the current value of a counter, such as the number of cores in use.
+
+        :param name: The name of the counter, given as a string.
+        :param value: The value of the counter, given as a number.
+        """
+        with self.lock:
+            self.counters.append({'name': name, 'time': time.time(), 'value': value})
+
+    def get_microseconds(self, timestamp):
+        """
+        Function to convert a time.time() timestamp to microseconds since the start of the run.
+
+        :param timestamp: The timestamp, given as a float.
+        :return: The microseconds since the recorder was created, given as an int.
+        """
+        return int((timestamp - self.start_time) * 1e6)
+
+    def get_chrome_trace(self):
+        """
+        Function to build a Chrome trace of the recorded spans and counters.
+
+        :return: The trace, given as a JSON-compatible dictionary.
+        """
+        events = []
+        with self.lock:
+            for slot in sorted(set(span['slot'] for span in self.tasks + self.commands)):
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': slot,
+                               'args': {'name': 'Slot %s' % slot}})
+            for task in self.tasks:
+                events.append({'name': task['name'], 'cat': 'task', 'ph': 'X', 'pid': 1,
+                               'tid': task['slot'],
+                               'ts': self.get_microseconds(task['start_time']),
+                               'dur': self.get_microseconds(task['end_time']) -
+                               self.get_microseconds(task['start_time']),
+                               'args': {'threads': task['threads'], 'failed': task['failed'],
+                                        'dependencies': task['dependencies']}})
+            for command in self.commands:
+                arguments = dict(command['usage'], command=command['command'],
+                                 exit_status=command['exit_status'])
+                events.append({'name': command['name'], 'cat': 'command', 'ph': 'X', 'pid': 1,
+                               'tid': command['slot'],
+                               'ts': self.get_microseconds(command['start_time']),
+                               'dur': self.get_microseconds(command['end_time']) -
+                               self.get_microseconds(command['start_time']),
+                               'args': arguments})
+            for counter in self.counters:
+                events.append({'name': counter['name'], 'ph': 'C', 'pid': 1,
+                               'ts': self.get_microseconds(counter['time']),
+                               'args': {'value': counter['value']}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, trace_path):
+        """
+        Method to save the Chrome trace of the run as a JSON file.
+
+        :param trace_path: The path of the JSON file, given as a string.
+        """
+        with open(trace_path, 'w') as trace_file:
+            json.dump(self.get_chrome_trace(), trace_file)
+
+    def get_critical_path(self):
+        """
+        Function to follow the critical path back from the task that finished last, through the
+        dependency of every task that finished last.
+
+        :return: The names of the tasks on the critical path, in the order they ran.
+        """
+        tasks = dict((task['name'], task) for task in self.tasks)
+        if not tasks:
+            return []
+        task = max(tasks.values(), key=lambda task: task['end_time'])
+        path = [task['name']]
+        while True:
+            dependencies = [tasks[name] for name in task['dependencies'] if name in tasks]
+            if not dependencies:
+                return path[::-1]
+            task = max(dependencies, key=lambda dependency: dependency['end_time'])
+            path.append(task['name'])
+
+    def format_summary(self, cores):
+        """
+        Function to format a table of the wall time, CPU time, peak memory and I/O of every task,
+        marking the tasks on the critical path, followed by the use of the cores.
+
+        :param cores: The number of cores the run could use, given as an int.
+        :return: The table, given as a string.
+        """
+        critical_path = set(self.get_critical_path())
+        lines = ['%-32s %9s %9s %9s %10s %10s' % ('Task', 'Wall s', 'CPU s', 'RSS MB',
+                                                  'Read MB', 'Written MB')]
+        busy_time, end_time = 0.0, self.start_time
+        for task in sorted(self.tasks, key=lambda task: task['start_time']):
+            usages = [command['usage'] for command in self.commands
+                      if command['task'] == task['name']]
+            usage = add_usages(usages)
+            usage['max_rss'] = max([single['max_rss'] for single in usages] or [0])
+            wall_time = task['end_time'] - task['start_time']
+            busy_time += wall_time * max(1, task['threads'])
+            end_time = max(end_time, task['end_time'])
+            lines.append('%-32s %9.1f %9.1f %9.1f %10.1f %10.1f' % (
+                ('* ' if task['name'] in critical_path else '  ') + task['name'], wall_time,
+                usage['cpu_time'], usage['max_rss'], usage['read_bytes'] / float(MEGABYTE),
+                usage['write_bytes'] / float(MEGABYTE)))
+        run_time = end_time - self.start_time
+        lines.append('* Critical path. Wall time %.1f seconds on %s cores, %.0f%% of core time '
+                     'idle.' % (run_time, cores,
+                                100 * max(0.0, 1 - busy_time / (run_time * cores or 1))))
+        return '\n'.join(lines)
+
+
+recorder = TraceRecorder()
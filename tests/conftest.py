@@ -0,0 +1,11 @@
+"""
+Makes the pipeline scripts, which live next to each other at the top of the repository,
+importable from the tests.
+"""
+
+
+import sys
+import os
+
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,138 @@
+"""
+Tests of the columnar GTF/GFF3 index and its interval-overlap queries.
+"""
+
+
+import random
+import gzip
+import time
+
+import AnnotationIndex
+
+
+GFF3_LINES = ['##gff-version 3\n',
+              'chr1\tmaker\tgene\t100\t900\t.\t+\t.\tID=gene1;Name=alpha\n',
+              'chr1\tmaker\tmRNA\t100\t900\t.\t+\t.\tID=mrna1;Parent=gene1\n',
+              'chr1\tmaker\texon\t100\t200\t.\t+\t.\tID=exon1;Parent=mrna1\n',
+              'chr1\tmaker\texon\t700\t900\t.\t+\t.\tID=exon2;Parent=mrna1\n',
+              'chr2\tmaker\tgene\t50\t60\t.\t-\t.\tID=gene2\n',
+              'chr1\tmaker\tgene\t1000\t1100\t.\t-\t.\tID=gene3\n',
+              '##FASTA\n', '>chr1\n', 'ACGT\n']
+
+
+def write_annotation(path, lines):
+    with open(str(path), 'w') as annotation_file:
+        annotation_file.writelines(lines)
+    return str(path)
+
+
+def brute_force_query(index, seqid, start, end=None, feature_type=None):
+    rows = []
+    for row in range(len(index)):
+        feature = index.get_feature(row)
+        if feature[0] == seqid and feature[4] >= start and (end is None or feature[3] <= end) \
+                and (feature_type is None or feature[2] == feature_type):
+            rows.append(row)
+    return rows
+
+
+def get_ids(index, rows):
+    return [index.get_attribute(row, 'ID') for row in rows]
+
+
+def test_query_overlaps(tmp_path):
+    index = AnnotationIndex.build_annotation_index(
+        write_annotation(tmp_path / 'anno.gff3', GFF3_LINES))
+    assert len(index) == 6
+    assert get_ids(index, index.query('chr1', 150, 160)) == ['gene1', 'mrna1', 'exon1']
+    assert get_ids(index, index.query('chr1', 200, 700)) == ['gene1', 'mrna1', 'exon1', 'exon2']
+    assert get_ids(index, index.query('chr1', 901, 999)) == []
+    assert index.query('chr3', 1, 100) == []
+
+
+def test_query_feature_type(tmp_path):
+    index = AnnotationIndex.build_annotation_index(
+        write_annotation(tmp_path / 'anno.gff3', GFF3_LINES))
+    assert get_ids(index, index.query('chr1', 1, 2000, 'exon')) == ['exon1', 'exon2']
+    assert get_ids(index, index.query('chr1', 1, 2000, 'gene')) == ['gene1', 'gene3']
+    assert index.query('chr1', 1, 2000, 'CDS') == []
+
+
+def test_query_open_end(tmp_path):
+    index = AnnotationIndex.build_annotation_index(
+        write_annotation(tmp_path / 'anno.gff3', GFF3_LINES))
+    assert get_ids(index, index.query('chr1', 850)) == ['gene1', 'mrna1', 'exon2', 'gene3']
+    assert get_ids(index, index.query(*AnnotationIndex.parse_region('chr2'))) == ['gene2']
+
+
+def test_query_before_first_feature(tmp_path):
+    index = AnnotationIndex.build_annotation_index(
+        write_annotation(tmp_path / 'anno.gff3', GFF3_LINES))
+    assert index.query('chr1', 1, 99) == []
+    assert get_ids(index, index.query('chr1', 1, 100)) == ['gene1', 'mrna1', 'exon1']
+
+
+def test_gtf_attributes(tmp_path):
+    path = str(tmp_path / 'anno.gtf.gz')
+    with gzip.open(path, 'wt') as annotation_file:
+        annotation_file.write('chr1\tCufflinks\texon\t5\t50\t.\t+\t.\tgene_id "XLOC_1"; '
+                              'transcript_id "TCONS_1"; exon_number "1";\n')
+    index = AnnotationIndex.build_annotation_index(path)
+    assert index.get_attributes(0) == {'gene_id': 'XLOC_1', 'transcript_id': 'TCONS_1',
+                                       'exon_number': '1'}
+    assert index.get_locations() == {'XLOC_1': ('chr1', 5, 50, '+')}
+
+
+def test_save_load_round_trip(tmp_path):
+    path = write_annotation(tmp_path / 'anno.gff3', GFF3_LINES)
+    index = AnnotationIndex.load_annotation_index(path)
+    loaded = AnnotationIndex.AnnotationIndex.load(AnnotationIndex.get_index_path(path))
+    assert loaded.is_current(path)
+    assert loaded.strings == index.strings
+    assert loaded.columns == index.columns
+    assert [loaded.format_feature(row) for row in range(len(loaded))] == \
+        [index.format_feature(row) for row in range(len(index))]
+    assert loaded.query('chr1', 150, 160) == index.query('chr1', 150, 160)
+    write_annotation(path, GFF3_LINES[:2])
+    assert len(AnnotationIndex.load_annotation_index(path)) == 1
+
+
+def test_query_matches_brute_force():
+    randomizer = random.Random(7)
+    for trial in range(50):
+        builder = AnnotationIndex.AnnotationIndexBuilder()
+        for number in range(randomizer.randint(0, 100)):
+            start = randomizer.randint(1, 1000)
+            builder.add_line('chr%s\tsrc\t%s\t%s\t%s\t.\t+\t.\tID=f%s\n' % (
+                randomizer.randint(1, 2), randomizer.choice(['exon', 'gene']), start,
+                start + randomizer.choice([0, 1, 10, 50, 800]), number))
+        index = builder.get_index(0, 0.0)
+        for query in range(40):
+            start = randomizer.randint(0, 2000)
+            end = randomizer.choice([None, start + randomizer.randint(0, 100)])
+            feature_type = randomizer.choice([None, 'exon', 'gene'])
+            for seqid in ['chr1', 'chr2']:
+                assert index.query(seqid, start, end, feature_type) == \
+                    brute_force_query(index, seqid, start, end, feature_type)
+
+
+def test_query_with_long_feature_is_fast():
+    builder = AnnotationIndex.AnnotationIndexBuilder()
+    builder.add_line('chr1\tsrc\tgene\t1\t100000000\t.\t+\t.\tID=scaffold\n')
+    for number in range(100000):
+        builder.add_line('chr1\tsrc\texon\t%s\t%s\t.\t+\t.\tID=e%s\n' % (
+            number * 300 + 1, number * 300 + 200, number))
+    index = builder.get_index(0, 0.0)
+    start_time = time.time()
+    for query in range(100):
+        rows = index.query('chr1', 15000000, 15000100)
+    assert get_ids(index, rows) == ['scaffold', 'e50000']
+    assert time.time() - start_time < 0.5
+
+
+def test_old_index_is_rebuilt(tmp_path):
+    path = write_annotation(tmp_path / 'anno.gff3', GFF3_LINES)
+    with open(AnnotationIndex.get_index_path(path), 'wb') as index_file:
+        index_file.write(b'GAI1' + b'\0' * 64)
+    assert len(AnnotationIndex.load_annotation_index(path)) == 6
+    assert AnnotationIndex.is_index_file(AnnotationIndex.get_index_path(path))
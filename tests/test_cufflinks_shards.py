@@ -0,0 +1,78 @@
+"""
+Tests of the balancing of scaffold shards and the merging of their cufflinks outputs.
+"""
+
+
+import os
+
+import CuffLinksShards
+
+
+TRACKING_HEADER = 'tracking_id\tclass_code\tnearest_ref_id\tgene_id\tgene_short_name\ttss_id\t' \
+                  'locus\tlength\tcoverage\tFPKM\tFPKM_conf_lo\tFPKM_conf_hi\tFPKM_status\n'
+
+
+def test_balance_scaffolds_by_reads():
+    scaffold_counts = [('a', 10, 50), ('b', 10, 40), ('c', 10, 30), ('d', 10, 25)]
+    groups = CuffLinksShards.balance_scaffolds(scaffold_counts, 2)
+    assert groups == [[('a', 10, 50), ('d', 10, 25)], [('b', 10, 40), ('c', 10, 30)]]
+
+
+def test_balance_scaffolds_keeps_scaffolds_without_reads():
+    scaffold_counts = [('a', 10, 50), ('b', 10, 0), ('c', 10, 30), ('d', 10, 0), ('e', 10, 0)]
+    groups = CuffLinksShards.balance_scaffolds(scaffold_counts, 4)
+    assert len(groups) == 2
+    assert sorted(scaffold for group in groups for scaffold in group) == sorted(scaffold_counts)
+    assert CuffLinksShards.balance_scaffolds([('a', 10, 0), ('b', 10, 0)], 3) == \
+        [[('a', 10, 0), ('b', 10, 0)]]
+
+
+def test_renumber_identifiers():
+    renumberer = CuffLinksShards.IdentifierRenumberer()
+    assert renumberer.renumber(0, 'CUFF.1') == 'CUFF.1'
+    assert renumberer.renumber(1, 'CUFF.1.2') == 'CUFF.2.2'
+    assert renumberer.renumber(0, 'CUFF.1.1') == 'CUFF.1.1'
+    assert renumberer.renumber(1, 'TSS1,TSS2') == 'TSS1,TSS2'
+    assert renumberer.renumber(0, 'TSS1') == 'TSS3'
+    assert renumberer.renumber(1, 'gene7') == 'gene7'
+
+
+def test_scale_value():
+    assert CuffLinksShards.scale_value('1000', 0.25) == '250'
+    assert CuffLinksShards.scale_value('-', 0.25) == '-'
+
+
+def write_shard_output(folder, scaffold, fpkm):
+    os.makedirs(folder)
+    with open('%s/transcripts.gtf' % folder, 'w') as gtf_file:
+        gtf_file.write('%s\tCufflinks\ttranscript\t1\t100\t1000\t+\t.\tgene_id "CUFF.1"; '
+                       'transcript_id "CUFF.1.1"; FPKM "%s"; conf_lo "%s"; conf_hi "%s";\n' %
+                       (scaffold, fpkm, fpkm / 2, fpkm * 2))
+        gtf_file.write('%s\tCufflinks\ttranscript\t1\t100\t1000\t+\t.\tgene_id "ref1"; '
+                       'transcript_id "ref1.t"; FPKM "0";\n' % scaffold)
+    with open('%s/genes.fpkm_tracking' % folder, 'w') as tracking_file:
+        tracking_file.write(TRACKING_HEADER)
+        tracking_file.write('CUFF.1\t-\t-\tCUFF.1\t-\tTSS1\t%s:0-100\t-\t-\t%s\t%s\t%s\tOK\n' %
+                            (scaffold, fpkm, fpkm / 2, fpkm * 2))
+
+
+def test_merge_shard_outputs(tmp_path):
+    shard_outputs = ['%s/shard%s' % (tmp_path, index) for index in range(2)]
+    write_shard_output(shard_outputs[0], 'chr1', 800.0)
+    write_shard_output(shard_outputs[1], 'chr2', 400.0)
+    output_paths = CuffLinksShards.merge_shard_outputs(shard_outputs, [0.75, 0.25],
+                                                       str(tmp_path))
+    assert output_paths == ['%s/transcripts.gtf' % tmp_path, '%s/genes.fpkm_tracking' % tmp_path]
+    with open(output_paths[0]) as gtf_file:
+        lines = gtf_file.readlines()
+    assert [line.split('\t')[8].rstrip('\n') for line in lines] == [
+        'gene_id "CUFF.1"; transcript_id "CUFF.1.1"; FPKM "600"; conf_lo "300"; conf_hi "1200";',
+        'gene_id "ref1"; transcript_id "ref1.t"; FPKM "0";',
+        'gene_id "CUFF.2"; transcript_id "CUFF.2.1"; FPKM "100"; conf_lo "50"; conf_hi "200";',
+        'gene_id "ref1"; transcript_id "ref1.t"; FPKM "0";']
+    with open(output_paths[1]) as tracking_file:
+        lines = tracking_file.readlines()
+    assert lines[0] == TRACKING_HEADER
+    assert [line.split('\t')[:6] + line.split('\t')[9:12] for line in lines[1:]] == [
+        ['CUFF.1', '-', '-', 'CUFF.1', '-', 'TSS1', '600', '300', '1200'],
+        ['CUFF.2', '-', '-', 'CUFF.2', '-', 'TSS2', '100', '50', '200']]
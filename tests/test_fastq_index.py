@@ -0,0 +1,87 @@
+"""
+Tests of the sparse record offset index of FASTQ files.
+"""
+
+
+import os
+
+import FastqIndex
+import Splitter
+
+
+def make_records(count):
+    records = []
+    for number in range(count):
+        length = 8 + number % 3 * 2
+        records.append(b'@read%d length=%d\n%s\n+\n%s\n' % (
+            number, length, b'ACGT' * (length // 4) + b'AC' * (length % 4 // 2),
+            b'@' + b'I' * (length - 1)))
+    return records
+
+
+def write_fastq(path, records, trailing_newline=True):
+    data = b''.join(records)
+    with open(str(path), 'wb') as fastq_file:
+        fastq_file.write(data if trailing_newline else data[:-1])
+    return str(path)
+
+
+def test_seek_record(tmp_path):
+    records = make_records(25)
+    path = write_fastq(tmp_path / 'reads.fastq', records)
+    index = FastqIndex.build_fastq_index(path, interval=4)
+    assert index.record_count == 25
+    assert index.file_size == os.path.getsize(path)
+    assert list(index.record_numbers) == [0, 4, 8, 12, 16, 20, 24]
+    with open(path, 'rb') as fastq_file:
+        for number in [0, 3, 4, 13, 24]:
+            offset = index.seek_record(fastq_file, number)
+            assert offset == len(b''.join(records[:number]))
+            assert fastq_file.read(len(records[number])) == records[number]
+
+
+def test_seek_offset(tmp_path):
+    records = make_records(10)
+    path = write_fastq(tmp_path / 'reads.fastq', records)
+    index = FastqIndex.build_fastq_index(path, interval=3)
+    third_record = len(b''.join(records[:3]))
+    with open(path, 'rb') as fastq_file:
+        assert index.seek_offset(fastq_file, third_record) == (3, third_record)
+        assert index.seek_offset(fastq_file, third_record + 1) == \
+            (4, third_record + len(records[3]))
+        assert index.seek_offset(fastq_file, index.file_size - 1) == (10, index.file_size)
+
+
+def test_chunk_boundaries(tmp_path):
+    records = make_records(40)
+    path = write_fastq(tmp_path / 'reads.fastq', records)
+    index = FastqIndex.build_fastq_index(path, interval=5)
+    record_starts = set(len(b''.join(records[:number])) for number in range(40))
+    chunks = index.get_chunk_boundaries(4)
+    assert chunks[0][0] == 0 and chunks[-1][1] == os.path.getsize(path)
+    assert all(end == start for (_, end), (start, _) in zip(chunks[:-1], chunks[1:]))
+    assert all(start in record_starts for start, end in chunks)
+    assert len(chunks) == 4
+
+
+def test_save_load_round_trip(tmp_path):
+    path = write_fastq(tmp_path / 'reads.fastq', make_records(12))
+    index = FastqIndex.build_fastq_index(path, interval=5)
+    index.save(FastqIndex.get_index_path(path))
+    loaded = FastqIndex.load_fastq_index(path)
+    assert (loaded.interval, loaded.record_count, loaded.file_size) == (5, 12, index.file_size)
+    assert loaded.record_numbers == index.record_numbers and loaded.offsets == index.offsets
+    write_fastq(path, make_records(13))
+    assert FastqIndex.load_fastq_index(path) is None
+
+
+def test_split_index_without_trailing_newline(tmp_path):
+    records = make_records(9)
+    path = write_fastq(tmp_path / 'reads.fastq', records, trailing_newline=False)
+    output_paths = [str(tmp_path / 'forward.fastq'), str(tmp_path / 'reverse.fastq')]
+    index, statistics = Splitter.split_file_by_block(path, output_paths, index_interval=2)
+    assert index.record_count == 9
+    assert index.file_size == os.path.getsize(path)
+    assert index.offsets == FastqIndex.build_fastq_index(path, interval=2).offsets
+    index.save(FastqIndex.get_index_path(path))
+    assert FastqIndex.load_fastq_index(path) is not None
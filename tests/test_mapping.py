@@ -0,0 +1,31 @@
+"""
+Tests of pairing read files into samples by their mate labels.
+"""
+
+
+import pytest
+
+import Mapping
+
+
+@pytest.mark.parametrize('read1_path, read2_path, sample_name', [
+    ('reads_1.fq', 'reads_2.fq', 'reads'),
+    ('data/S1_L001_R1_001.fastq.gz', 'data/S1_L001_R2_001.fastq.gz', 'S1_L001_001'),
+    ('s.R1.fastq', 's.R2.fastq', 's'),
+    ('leaf_fwd.fq.bgz', 'leaf_rev.fq.bgz', 'leaf')])
+def test_read_pair_sample(read1_path, read2_path, sample_name):
+    assert Mapping.get_read_pair_sample(read1_path, read2_path) == \
+        (sample_name, read1_path, read2_path)
+    assert Mapping.get_read_pair_sample(read2_path, read1_path) == \
+        (sample_name, read1_path, read2_path)
+
+
+@pytest.mark.parametrize('read1_path, read2_path', [
+    ('reads_a.fq', 'reads_b.fq'),
+    ('S1_L001_R1_001.fq', 'S1_L001_R2_002.fq'),
+    ('a_1.fq', 'b_2.fq'),
+    ('reads_R1.fq', 'reads_2.fq'),
+    ('reads_1.fq', 'reads_1.fq')])
+def test_unpaired_read_files(read1_path, read2_path):
+    with pytest.raises(ValueError):
+        Mapping.get_read_pair_sample(read1_path, read2_path)
@@ -0,0 +1,26 @@
+"""
+Tests of dividing the mapping threads over samples by their read counts.
+"""
+
+
+import pytest
+
+import Pipeline
+
+
+@pytest.mark.parametrize('read_counts, total_threads, thread_plan', [
+    ({'a': 1, 'b': 1, 'c': 1000}, 12, {'a': 1, 'b': 1, 'c': 10}),
+    ({'a': 10, 'b': 20, 'c': 30, 'd': 40}, 16, {'a': 2, 'b': 3, 'c': 5, 'd': 6}),
+    ({'a': 5, 'b': 5, 'c': 5}, 8, {'a': 3, 'b': 3, 'c': 2}),
+    ({'a': 0, 'b': 0}, 7, {'a': 4, 'b': 3}),
+    ({'a': 3, 'b': 1, 'c': 2}, 2, {'a': 1, 'b': 1, 'c': 1})])
+def test_plan_mapping_threads(read_counts, total_threads, thread_plan):
+    assert Pipeline.plan_mapping_threads(read_counts, total_threads) == thread_plan
+
+
+def test_plan_sums_to_total_threads():
+    read_counts = dict(('sample%d' % index, index ** 3 + 1) for index in range(7))
+    for total_threads in range(7, 40):
+        thread_plan = Pipeline.plan_mapping_threads(read_counts, total_threads)
+        assert sum(thread_plan.values()) == total_threads
+        assert min(thread_plan.values()) >= 1
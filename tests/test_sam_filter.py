@@ -0,0 +1,72 @@
+"""
+Tests of the rules filtering alignments by flag and mapping quality.
+"""
+
+
+import subprocess
+import json
+import sys
+
+import SamFilter
+
+
+HEADER = b'@HD\tVN:1.0\n@SQ\tSN:chr1\tLN:1000\n'
+
+
+def make_alignment(flag, mapq, name=b'read'):
+    return b'%s\t%d\tchr1\t100\t%d\t10M\t=\t200\t110\tACGTACGTAC\tIIIIIIIIII\n' % (name, flag,
+                                                                                mapq)
+
+
+def test_drop_reasons_in_rule_order():
+    alignment_filter = SamFilter.AlignmentFilter(10, True, True)
+    assert alignment_filter.get_drop_reason(make_alignment(99, 60)) is None
+    assert alignment_filter.get_drop_reason(make_alignment(0x100 | 0x800 | 99, 0)) == 'secondary'
+    assert alignment_filter.get_drop_reason(make_alignment(0x800 | 99, 0)) == 'supplementary'
+    assert alignment_filter.get_drop_reason(make_alignment(97, 9)) == 'low_mapq'
+    assert alignment_filter.get_drop_reason(make_alignment(97, 10)) == 'improper_pair'
+
+
+def test_disabled_rules_keep_everything():
+    alignment_filter = SamFilter.AlignmentFilter()
+    assert not alignment_filter.is_active()
+    for flag in [0x100 | 97, 0x800 | 97, 97, 4]:
+        assert alignment_filter.keep(make_alignment(flag, 0))
+    assert alignment_filter.kept == alignment_filter.alignments == 4
+    assert SamFilter.AlignmentFilter(primary_only=True).is_active()
+
+
+def test_headers_are_kept_and_not_counted():
+    alignment_filter = SamFilter.AlignmentFilter(60, True, True)
+    assert all(alignment_filter.keep(line) for line in HEADER.splitlines(True))
+    assert alignment_filter.alignments == 0
+
+
+def test_filter_sam_file_and_summary(tmp_path):
+    alignments = [make_alignment(99, 60, b'a'), make_alignment(355, 60, b'b'),
+                  make_alignment(2147, 60, b'c'), make_alignment(99, 3, b'd'),
+                  make_alignment(97, 60, b'e'), make_alignment(147, 60, b'f')]
+    input_path, output_path = str(tmp_path / 'in.sam'), str(tmp_path / 'out.sam')
+    summary_path = SamFilter.get_summary_path(input_path)
+    with open(input_path, 'wb') as sam_file:
+        sam_file.write(HEADER + b''.join(alignments))
+    result = SamFilter.filter_sam(input_path, output_path, 10, True, True, summary_path)
+    assert result.output_paths == [output_path, str(tmp_path / 'in.filter_summary.json')]
+    with open(output_path, 'rb') as sam_file:
+        assert sam_file.read() == HEADER + alignments[0] + alignments[5]
+    with open(summary_path) as summary_file:
+        summary = json.load(summary_file)
+    assert summary['alignments'] == 6 and summary['kept'] == 2
+    assert summary['dropped'] == {'secondary': 1, 'supplementary': 1, 'low_mapq': 1,
+                                  'improper_pair': 1}
+
+
+def test_filter_command_in_pipe(tmp_path):
+    summary_path = str(tmp_path / 'summary.json')
+    command = SamFilter.create_filter_command('-', 30, True, False, summary_path)
+    assert command.startswith(sys.executable)
+    data = HEADER + make_alignment(99, 60) + make_alignment(99, 20) + make_alignment(355, 60)
+    output = subprocess.check_output(command, shell=True, input=data)
+    assert output == HEADER + make_alignment(99, 60)
+    with open(summary_path) as summary_file:
+        assert json.load(summary_file)['kept'] == 1
@@ -0,0 +1,105 @@
+"""
+Tests of the SAM sorters: the samtools sort command and the Python external merge sort.
+"""
+
+
+import random
+import os
+
+import SamFilter
+import SamSort
+
+
+HEADER = '@HD\tVN:1.0\tSO:unsorted\n@SQ\tSN:chr2\tLN:1000\n@SQ\tSN:chr1\tLN:1000\n' \
+         '@PG\tID:hisat2\n'
+
+
+def make_alignments(count, seed=5):
+    randomizer = random.Random(seed)
+    alignments = []
+    for number in range(count):
+        reference = randomizer.choice(['chr1', 'chr2', 'chr2', '*'])
+        position = 0 if reference == '*' else randomizer.randint(1, 50)
+        alignments.append('read%d\t%d\t%s\t%d\t%d\t10M\t=\t0\t0\tACGTACGTAC\tIIIIIIIIII\n' % (
+            number, 4 if reference == '*' else randomizer.choice([99, 147, 355]), reference,
+            position, randomizer.choice([0, 60])))
+    return alignments
+
+
+def write_sam(path, alignments):
+    with open(str(path), 'w') as sam_file:
+        sam_file.write(HEADER)
+        sam_file.writelines(alignments)
+    return str(path)
+
+
+def read_sorted(path):
+    with open(path) as sam_file:
+        lines = sam_file.readlines()
+    return [line for line in lines if line.startswith('@')], \
+        [line for line in lines if not line.startswith('@')]
+
+
+def expected_order(alignments):
+    references = {'chr2': 0, 'chr1': 1}
+    return sorted(alignments, key=lambda line: (references.get(line.split('\t')[2], 2),
+                                                int(line.split('\t')[3])))
+
+
+def test_python_sort_in_memory(tmp_path):
+    alignments = make_alignments(200)
+    path = write_sam(tmp_path / 'sample.sam', alignments)
+    result = SamSort.sort_sam_python(path, temporary_folder=str(tmp_path))
+    assert result.output_paths == [str(tmp_path / 'sample.sorted.sam')]
+    header, sorted_alignments = read_sorted(result.output_paths[0])
+    assert header[0] == '@HD\tVN:1.0\tSO:coordinate\n'
+    assert header[1:] == HEADER.splitlines(True)[1:]
+    assert sorted_alignments == expected_order(alignments)
+
+
+def test_python_sort_merges_runs_stably(tmp_path):
+    alignments = make_alignments(500)
+    path = write_sam(tmp_path / 'sample.sam', alignments)
+    # A memory limit of 0 spills every alignment to its own run.
+    SamSort.sort_sam_python(path, 0, str(tmp_path), True)
+    header, sorted_alignments = read_sorted(str(tmp_path / 'sample.sorted.sam'))
+    assert sorted_alignments == expected_order(alignments)
+    assert sorted(os.listdir(str(tmp_path))) == ['sample.sam', 'sample.sorted.sam']
+
+
+def test_python_sort_with_filter(tmp_path):
+    alignments = make_alignments(300)
+    path = write_sam(tmp_path / 'sample.sam', alignments)
+    alignment_filter = SamFilter.AlignmentFilter(min_mapq=1, primary_only=True)
+    SamSort.sort_sam_python(path, 0, str(tmp_path), True, alignment_filter)
+    header, sorted_alignments = read_sorted(str(tmp_path / 'sample.sorted.sam'))
+    kept = [line for line in alignments
+            if int(line.split('\t')[4]) >= 1 and not int(line.split('\t')[1]) & 0x100]
+    assert sorted_alignments == expected_order(kept)
+    assert alignment_filter.kept == len(kept)
+
+
+def test_existing_sorted_file_is_kept(tmp_path):
+    path = write_sam(tmp_path / 'sample.sam', make_alignments(10))
+    with open(str(tmp_path / 'sample.sorted.sam'), 'w') as sorted_file:
+        sorted_file.write('old')
+    assert SamSort.sort_sam_python(path, temporary_folder=str(tmp_path)).skipped
+
+
+def test_sort_command(tmp_path):
+    command = SamSort.create_sort_command('-', 'out/sample.sorted.bam.partial', 4, 512,
+                                          str(tmp_path))
+    assert command == 'samtools sort -@ 4 -m 512M -O bam -T %s/sample.sorted.bam.partial.%s.tmp ' \
+                      '-o out/sample.sorted.bam.partial -' % (tmp_path, os.getpid())
+
+
+def test_remove_partial_sort(tmp_path):
+    partial_path = str(tmp_path / 'sample.sorted.bam.partial')
+    prefix = SamSort.get_temporary_prefix(partial_path, str(tmp_path))
+    for path in [partial_path, '%s.0000.bam' % prefix, '%s.0001.bam' % prefix]:
+        with open(path, 'w') as spill_file:
+            spill_file.write('spill')
+    with open(str(tmp_path / 'other.bam'), 'w') as other_file:
+        other_file.write('kept')
+    SamSort.remove_partial_sort(partial_path, str(tmp_path))
+    assert os.listdir(str(tmp_path)) == ['other.bam']
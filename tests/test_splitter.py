@@ -0,0 +1,104 @@
+"""
+Tests of the engines splitting merged, paired-end FASTQ files into forward and reverse files.
+"""
+
+
+import random
+import gzip
+
+import Splitter
+
+
+def make_merged_records(count, seed=3, quality_start='@'):
+    randomizer = random.Random(seed)
+    records = []
+    for number in range(count):
+        length = randomizer.choice([20, 22, 30])
+        sequence = ''.join(randomizer.choice('ACGTN') for _ in range(length))
+        # Quality lines starting with '@', and holding '+', look like headers and separators.
+        quality = quality_start + ''.join(randomizer.choice('@+ABCDEFGHIJ#')
+                                          for _ in range(length - 1))
+        records.append('@SRR1.%d HWI:%d length=%d\n%s\n+\n%s\n' % (number, number, length,
+                                                                  sequence, quality))
+    return records
+
+
+def write_merged_fastq(path, records):
+    with open(str(path), 'w') as fastq_file:
+        fastq_file.writelines(records)
+    return str(path)
+
+
+def read_file(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as input_file:
+        return input_file.read()
+
+
+def split_records(records):
+    forward, reverse = [], []
+    for record in records:
+        header, sequence, separator, quality = record.split('\n')[:4]
+        half = len(sequence) // 2
+        header = header.replace('length=%d' % len(sequence), 'length=%d' % half)
+        forward.append('%s\n%s\n+\n%s\n' % (header, sequence[:half], quality[:half]))
+        reverse.append('%s\n%s\n+\n%s\n' % (header, sequence[half:], quality[half:]))
+    return [''.join(forward).encode('ascii'), ''.join(reverse).encode('ascii')]
+
+
+def split_with(engine, input_path, folder, **keyword_arguments):
+    output_paths = ['%s/%s_forward.fastq' % (folder, engine),
+                    '%s/%s_reverse.fastq' % (folder, engine)]
+    engine(input_path, output_paths, **keyword_arguments)
+    return [read_file(path) for path in output_paths]
+
+
+def test_block_splitter_matches_line_splitter(tmp_path):
+    # The line engine takes any line starting with '@' for a header, so its qualities must not.
+    records = make_merged_records(200, quality_start='I')
+    path = write_merged_fastq(tmp_path / 'merged.fastq', records)
+    by_line = split_with(Splitter.split_file_by_line, path, tmp_path)
+    assert by_line == split_records(records)
+    assert by_line == split_with(Splitter.split_file_by_block, path, tmp_path)
+
+
+def test_block_splitter_with_header_like_qualities(tmp_path):
+    records = make_merged_records(200)
+    path = write_merged_fastq(tmp_path / 'merged.fastq', records)
+    assert split_with(Splitter.split_file_by_block, path, tmp_path) == split_records(records)
+
+
+def test_parallel_splitter_matches_block_splitter(tmp_path):
+    records = make_merged_records(300)
+    path = write_merged_fastq(tmp_path / 'merged.fastq', records)
+    assert split_with(Splitter.split_file_in_parallel, path, tmp_path, workers=2) == \
+        split_records(records)
+
+
+def test_block_splitter_reads_compressed_input(tmp_path):
+    records = make_merged_records(50)
+    with gzip.open(str(tmp_path / 'merged.fastq.gz'), 'wt') as fastq_file:
+        fastq_file.writelines(records)
+    assert split_with(Splitter.split_file_by_block, str(tmp_path / 'merged.fastq.gz'),
+                      tmp_path) == split_records(records)
+
+
+def test_find_record_start(tmp_path):
+    records = make_merged_records(40)
+    path = write_merged_fastq(tmp_path / 'merged.fastq', records)
+    record_starts = [sum(len(record) for record in records[:number])
+                     for number in range(len(records) + 1)]
+    with open(path, 'rb') as fastq_file:
+        for offset in range(record_starts[-1] + 1):
+            expected = min(start for start in record_starts if start >= offset)
+            assert Splitter.find_record_start(fastq_file, offset) == expected
+
+
+def test_chunk_boundaries_fall_on_records(tmp_path):
+    records = make_merged_records(100)
+    path = write_merged_fastq(tmp_path / 'merged.fastq', records)
+    record_starts = set(sum(len(record) for record in records[:number])
+                        for number in range(len(records)))
+    chunks = Splitter.find_chunk_boundaries(path, 7)
+    assert chunks[0][0] == 0 and chunks[-1][1] == sum(len(record) for record in records)
+    assert all(start in record_starts for start, end in chunks)
@@ -0,0 +1,123 @@
+"""
+Tests of the stage cache deciding which stages of the pipeline are up to date.
+"""
+
+
+import os
+
+import StageCache
+
+
+def copy_stage(input_path, output_path, suffix=''):
+    with open(input_path) as input_file, open(output_path, 'w') as output_file:
+        output_file.write(input_file.read() + suffix)
+    return output_path
+
+
+def other_stage(input_path, output_path, suffix=''):
+    return copy_stage(input_path, output_path, suffix)
+
+
+def write_file(path, text, modification_time=None):
+    with open(str(path), 'w') as output_file:
+        output_file.write(text)
+    if modification_time is not None:
+        os.utime(str(path), (modification_time, modification_time))
+    return str(path)
+
+
+class CountingStage(object):
+
+    def __init__(self, function=copy_stage):
+        self.function = function
+        self.calls = 0
+
+    def __call__(self, cache, input_path, output_path, suffix=''):
+        def run(*arguments, **keyword_arguments):
+            self.calls += 1
+            return self.function(*arguments)
+        run.__module__, run.__name__ = self.function.__module__, self.function.__name__
+        return cache.run_stage('copy', [input_path], [output_path], [], run,
+                               (input_path, output_path, suffix), threads=2)
+
+
+def test_unchanged_stage_is_skipped(tmp_path):
+    cache = StageCache.StageCache(str(tmp_path / 'cache'))
+    input_path = write_file(tmp_path / 'input.txt', 'reads')
+    output_path = str(tmp_path / 'output.txt')
+    stage = CountingStage()
+    assert stage(cache, input_path, output_path) == output_path
+    assert stage(cache, input_path, output_path) is None
+    assert stage.calls == 1
+
+
+def test_key_changes_with_inputs_arguments_and_function(tmp_path):
+    input_path = write_file(tmp_path / 'input.txt', 'reads', 1000000000)
+    key = StageCache.StageCache.get_key([input_path], copy_stage, (input_path, 'out'), [])
+    assert key == StageCache.StageCache.get_key([input_path], copy_stage, (input_path, 'out'), [])
+    assert key != StageCache.StageCache.get_key([input_path], copy_stage, (input_path, 'o2'), [])
+    assert key != StageCache.StageCache.get_key([input_path], other_stage, (input_path, 'out'),
+                                                [])
+    write_file(input_path, 'reads', 1000000001)
+    assert key != StageCache.StageCache.get_key([input_path], copy_stage, (input_path, 'out'), [])
+    write_file(input_path, 'rEads', 1000000000)
+    assert key != StageCache.StageCache.get_key([input_path], copy_stage, (input_path, 'out'), [])
+
+
+def test_key_changes_with_tool_version(tmp_path):
+    input_path = write_file(tmp_path / 'input.txt', 'reads')
+    StageCache.tool_versions.update({'tool_a': 'tool_a version 1', 'tool_b': 'tool_b version 2'})
+    assert StageCache.StageCache.get_key([input_path], copy_stage, (), ['tool_a']) != \
+        StageCache.StageCache.get_key([input_path], copy_stage, (), ['tool_b'])
+    assert StageCache.get_tool_version('surely-not-an-installed-tool') == \
+        StageCache.UNKNOWN_VERSION
+
+
+def test_changed_input_or_argument_reruns_stage(tmp_path):
+    cache = StageCache.StageCache(str(tmp_path / 'cache'))
+    input_path = write_file(tmp_path / 'input.txt', 'reads', 1000000000)
+    output_path = str(tmp_path / 'output.txt')
+    stage = CountingStage()
+    stage(cache, input_path, output_path)
+    write_file(input_path, 'more reads', 1000000000)
+    stage(cache, input_path, output_path)
+    stage(cache, input_path, output_path, suffix='!')
+    assert stage.calls == 3
+    with open(output_path) as output_file:
+        assert output_file.read() == 'more reads!'
+
+
+def test_changed_or_missing_output_reruns_stage(tmp_path):
+    cache = StageCache.StageCache(str(tmp_path / 'cache'))
+    input_path = write_file(tmp_path / 'input.txt', 'reads')
+    output_path = str(tmp_path / 'output.txt')
+    stage = CountingStage()
+    stage(cache, input_path, output_path)
+    write_file(output_path, 'edited')
+    stage(cache, input_path, output_path)
+    os.remove(output_path)
+    stage(cache, input_path, output_path)
+    assert stage.calls == 3
+
+
+def test_folder_fingerprint(tmp_path):
+    folder = tmp_path / 'folder'
+    os.makedirs(str(folder / 'sub'))
+    write_file(folder / 'sub' / 'a.txt', 'a', 1000000000)
+    fingerprint = StageCache.fingerprint_path(str(folder))
+    assert fingerprint == StageCache.fingerprint_path(str(folder))
+    write_file(folder / 'b.txt', 'b', 1000000000)
+    assert fingerprint != StageCache.fingerprint_path(str(folder))
+    assert StageCache.fingerprint_path(str(tmp_path / 'missing')) is None
+
+
+def test_force_and_invalidate(tmp_path):
+    input_path = write_file(tmp_path / 'input.txt', 'reads')
+    output_path = str(tmp_path / 'output.txt')
+    stage = CountingStage()
+    stage(StageCache.StageCache(str(tmp_path / 'cache')), input_path, output_path)
+    stage(StageCache.StageCache(str(tmp_path / 'cache'), force=True), input_path, output_path)
+    cache = StageCache.StageCache(str(tmp_path / 'cache'))
+    cache.invalidate('copy')
+    stage(cache, input_path, output_path)
+    assert stage.calls == 3